@@ -39,6 +39,18 @@ class _Config(object):
     typingDelay(float):
     The delay after a character is typed on the keyboard.
 
+    typingMode(str):
+    How Node.typeText() enters text: 'keys' (a key event per character,
+    each followed by typingDelay), 'burst' (key events typingChunkSize
+    characters at a time without delays, waiting for the application to
+    report inserting each chunk), 'insert' (inserting the text directly
+    through the EditableText interface) or 'auto' (insert if the node is
+    editable and the text has no tabs or newlines, which are meant as key
+    presses, else burst for long texts, else keys).
+
+    typingChunkSize(int):
+    Number of characters typed at once in the 'burst' typingMode.
+
     runInterval(float):
     The interval at which dogtail.utils.run() and dogtail.procedural.run()
     check to see if the application has started up.
@@ -56,13 +68,98 @@ class _Config(object):
     searchCutoffCount (int):
     Number of times to retry when a search fails.
 
+    eventDrivenSearch (boolean):
+    Whether a failed search should wait for the application to report a
+    change in its accessible tree (children added or removed, names or
+    states changing) before retrying, rather than sleeping for
+    searchBackoffDuration. The number of retries is then bounded by
+    searchTimeout instead of searchCutoffCount.
+
+    searchTimeout (float):
+    Total time in seconds an event-driven search keeps waiting before it
+    gives up. Also the deadline of the 'exponential' and 'adaptive' retry
+    policies.
+
+    searchRetryPolicy (str):
+    How failed searches are retried: 'fixed' (every searchBackoffDuration
+    seconds, searchCutoffCount times), 'exponential' (short delays growing
+    up to searchBackoffDuration, until searchTimeout) or 'adaptive'
+    (polling densely around the time searches in the same application
+    usually take to succeed). A dogtail.retry.RetryPolicy instance can be
+    given instead. See dogtail.retry.
+
+    cacheSearches (boolean):
+    Whether Node.findChild() should remember where it found each node, and
+    look there first the next time the same search is made from the same
+    node (see dogtail.tree.SearchCache).
+
+    searchCacheSize (int):
+    Number of searches remembered when cacheSearches is True.
+
+    persistentLocators (boolean):
+    Like cacheSearches, but where nodes were found is also saved in
+    dataDir, per application and version, for the next runs to try first
+    (see dogtail.locators).
+
+    guardedDesktopSearch (boolean):
+    Whether searches below the desktop (e.g. root.application() or
+    recursive searches from root) should fetch the applications' trees in
+    parallel, and be guarded against hung applications: every call to an
+    application times out after applicationTimeout, and an application
+    that doesn't answer is left out of the search (see
+    dogtail.tree.DesktopSearch).
+
+    searchThreads (int):
+    Number of applications whose trees a guarded desktop search fetches at
+    once.
+
+    applicationTimeout (float):
+    Time in seconds after which a guarded desktop search gives up waiting
+    for an application to answer a call, and searches the others. It
+    should be no longer than libatspi's own timeout (0.8 seconds).
+
+    applicationSkipThreshold (int):
+    Number of guarded desktop searches in a row an application can fail to
+    answer before it is skipped by the next ones.
+
+    applicationSkipDuration (float):
+    Time in seconds for which an application is skipped by guarded desktop
+    searches once it has reached applicationSkipThreshold.
+
     defaultDelay (float):
     Default time in seconds to sleep when delaying.
 
+    settleDelays (boolean):
+    Whether the delays after actions and input (dogtail.utils.doDelay)
+    should end as soon as the application has sent no AT-SPI events for
+    settleQuietPeriod seconds, the usual delay only being the longest
+    they can take.
+
+    settleQuietPeriod (float):
+    Time in seconds without events after which an application is
+    considered settled, when settleDelays is True.
+
     childrenLimit (int):
     When there are a very large number of children of a node, only return
     this many, starting with the first.
 
+    compileTranslations (boolean):
+    Whether dogtail.i18n.loadTranslationsFromPackageMoFiles() should compile
+    the translations of the package into an index file in dataDir, which
+    is memory-mapped and reused by later runs and parallel processes,
+    instead of parsing every mo-file in every process.
+
+    translationCacheSize (int):
+    Number of mo-files whose translations are kept loaded (as memory-mapped
+    indexes, or parsed if they can't be indexed) at a time, the least
+    recently used being dropped first.
+
+    propertyCacheLifetime (float):
+    Time in seconds for which the properties fetched by Node.fetch() (and
+    the Node properties built on it, such as position, size and the
+    states) are reused before being queried again. The cache is also
+    dropped whenever dogtail acts on the UI. 0 disables it.
+
     debugSearching (boolean):
     Whether to write info on search backoff and retry to the debug log.
 
@@ -105,6 +202,24 @@ class _Config(object):
 
     logDebugToStdOut (boolean):
     Whether to print log output to console or not (default True).
+
+    logLevel (str):
+    The least important messages logged: 'debug' (everything, the
+    default), 'info', 'warning' or 'error'. See dogtail.logging.
+
+    logInBackground (boolean):
+    Whether log files should be written by a background thread, in
+    batches, rather than written and flushed line by line. Whatever is
+    queued is still written when the script exits or crashes (see
+    dogtail.logging.LogWriter).
+
+    logQueueSize (int):
+    Number of log lines that can wait to be written in the background;
+    logging blocks when that many are waiting.
+
+    logFlushInterval (float):
+    Time in seconds after which lines written in the background are
+    flushed to disk at the latest.
     """
     @property
     def scriptName(self):
@@ -127,13 +242,31 @@ class _Config(object):
         # Timing and Limits
         'actionDelay': 1.0,
         'typingDelay': 0.075,
+        'typingMode': 'keys',
+        'typingChunkSize': 64,
         'runInterval': 0.5,
         'runTimeout': 30,
         'searchBackoffDuration': 0.5,
         'searchWarningThreshold': 3,
         'searchCutoffCount': 20,
+        'eventDrivenSearch': False,
+        'searchTimeout': 10.0,
+        'searchRetryPolicy': 'fixed',
+        'cacheSearches': False,
+        'searchCacheSize': 256,
+        'persistentLocators': False,
+        'guardedDesktopSearch': False,
+        'searchThreads': 8,
+        'applicationTimeout': 0.5,
+        'applicationSkipThreshold': 2,
+        'applicationSkipDuration': 60.0,
         'defaultDelay': 0.5,
+        'settleDelays': False,
+        'settleQuietPeriod': 0.1,
         'childrenLimit': 100,
+        'compileTranslations': False,
+        'translationCacheSize': 32,
+        'propertyCacheLifetime': 0.1,
 
         # Debug
         'debugSearching': False,
@@ -148,7 +281,11 @@ class _Config(object):
         'checkForA11y': True,
 
         # Logging
-        'logDebugToFile': True
+        'logDebugToFile': True,
+        'logLevel': 'debug',
+        'logInBackground': False,
+        'logQueueSize': 10000,
+        'logFlushInterval': 1.0
     }
 
     options = {}
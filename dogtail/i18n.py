@@ -11,7 +11,13 @@ import config
 
 import os
 import re
+import errno
+import mmap
+import struct
+import hashlib
 import gettext
+import tempfile
+from collections import OrderedDict
 
 from logging import debugLogger as logger
 from __builtin__ import unicode
@@ -59,6 +65,24 @@ class TranslationDb(object):
         raise NotImplementedError
 
 
+def mnemonicVariants(msgid):
+    """
+    Typical UI definitions in GTK etc contain strings with underscores to
+    denote accelerators. For example, the stock GTK "Add" item has text
+    "_Add" which e.g. translates to "A_jouter" in French.
+
+    Since these underscores have been stripped out before we see these
+    strings, we need to look up "Add" and find "Ajouter". So messages
+    containing underscores are also indexed under each of the strings
+    obtained by removing one of the underscores (except a trailing one),
+    which this generates.
+    """
+    position = msgid.find('_')
+    while position != -1 and position < len(msgid) - 1:
+        yield msgid[:position] + msgid[position + 1:]
+        position = msgid.find('_', position + 1)
+
+
 class GettextTranslationDb(TranslationDb):
 
     """
@@ -69,6 +93,20 @@ class GettextTranslationDb(TranslationDb):
     def __init__(self, moFile):
         self.__moFile = moFile
         self.__gnutranslations = gettext.GNUTranslations(open(moFile))
+        self.__mnemonicIndex = self.__indexMnemonics()
+
+    def __indexMnemonics(self):
+        """
+        Indexes the translations of the messages containing underscores
+        (see mnemonicVariants()), with the underscores stripped out.
+        """
+        index = {}
+        for (msgid, msgstr) in self.__gnutranslations._catalog.items():
+            if not isinstance(msgid, basestring) or msgstr == msgid:
+                continue
+            for stripped in mnemonicVariants(msgid):
+                index.setdefault(stripped, set()).add(msgstr.replace('_', ''))
+        return index
 
     def getTranslationsOf(self, srcName):
         srcName = safeDecode(srcName)
@@ -78,35 +116,258 @@ class GettextTranslationDb(TranslationDb):
         result = self.__gnutranslations.ugettext(srcName)
         if result != srcName:
             results[result] = None
+        for result in self.__mnemonicIndex.get(srcName, ()):
+            results[result] = True
+        return results.keys()
 
-        # Hack alert:
-        #
-        # Note that typical UI definition in GTK etc contains strings with
-        # underscores to denote accelerators.
-        # For example, the stock GTK "Add" item has text "_Add" which e.g.
-        # translates to "A_jouter" in French
-        #
-        # Since these underscores have been stripped out before we see these strings,
-        # we are looking for a translation of "Add" into "Ajouter" in this case, so
-        # we need to fake it, by looking up the string multiple times, with underscores
-        # inserted in all possible positions, stripping underscores out of the result.
-        # Ugly, but it works.
-
-        for index in range(len(srcName)):
-            candidate = srcName[:index] + "_" + srcName[index:]
-            result = self.__gnutranslations.ugettext(candidate)
-            if result != candidate:
-                # Strip out the underscore, and add to the result:
-                results[result.replace('_', '')] = True
 
-        return results.keys()
+# The loaded translation databases of the LazyTranslationDbs, by mo-file,
+# least recently used first:
+loadedCatalogs = OrderedDict()
+
+
+class LazyTranslationDb(TranslationDb):
+
+    """
+    Implementation of TranslationDb standing for the translations of a
+    mo-file, which are only loaded the first time a translation is looked
+    up in it.
+
+    The mo-file is compiled into an index of its own (see
+    getCompiledTranslationDb()), once for all processes and runs, and
+    looked up in through the memory-mapped index rather than parsed; it is
+    only parsed (see GettextTranslationDb) if the index can't be written.
+    At most config.translationCacheSize of them are kept loaded at a time,
+    the least recently used being dropped first.
+    """
+
+    def __init__(self, moFile):
+        self.moFile = moFile
+        self.broken = False
+
+    def load(self):
+        """
+        The index of the mo-file, or, failing that, the parsed mo-file, or
+        None if it can't be loaded.
+        """
+        try:
+            return getCompiledTranslationDb(os.path.basename(self.moFile),
+                                            'catalog', [self.moFile])
+        except (IOError, OSError, ValueError) as e:
+            if config.config.debugTranslation:
+                logger.log("Can't index %s (%s); parsing it" % (self.moFile, e))
+        try:
+            return GettextTranslationDb(self.moFile)
+        except (AttributeError, IndexError, IOError):
+            if config.config.debugTranslation:
+                logger.log(
+                    "Warning: Failed to load mo-file for translation: " + self.moFile)
+            return None
+
+    def getTranslationDb(self):
+        """
+        The loaded translation database, or None if the mo-file can't be
+        loaded.
+        """
+        if self.broken:
+            return None
+        try:
+            db = loadedCatalogs.pop(self.moFile)
+        except KeyError:
+            db = self.load()
+            if db is None:
+                self.broken = True
+                return None
+            while len(loadedCatalogs) >= max(config.config.translationCacheSize, 1):
+                loadedCatalogs.popitem(last=False)
+        loadedCatalogs[self.moFile] = db
+        return db
+
+    def getTranslationsOf(self, srcName):
+        db = self.getTranslationDb()
+        if db is None:
+            return []
+        return db.getTranslationsOf(srcName)
+
+
+class CompiledTranslationDb(TranslationDb):
+
+    """
+    Implementation of TranslationDb reading a compiled translation index,
+    which holds the translations of several mo-files (see
+    getCompiledTranslationDb()). The index is memory-mapped rather than
+    parsed, so that processes using the same index share its pages.
+
+    The file starts with a header (magic, format version, number of
+    entries), followed by the entries, sorted by message, each being the
+    offsets and lengths of the message and of its translations, followed
+    by the strings themselves: the messages (UTF-8) and the translations
+    (UTF-8, separated by NUL characters).
+    """
+
+    magic = 'DTTI'
+    version = 1
+    header = struct.Struct('<4sII')
+    entry = struct.Struct('<IIII')
+
+    def __init__(self, indexFile):
+        self.indexFile = indexFile
+        with open(indexFile, 'rb') as f:
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.__count = self.header.unpack_from(self.__map, 0)
+        if magic != self.magic or version != self.version:
+            raise ValueError("%s is not a translation index" % indexFile)
+
+    def __entry(self, index):
+        return self.entry.unpack_from(
+            self.__map, self.header.size + index * self.entry.size)
+
+    def getTranslationsOf(self, srcName):
+        key = safeDecode(srcName).encode('utf-8')
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            keyOffset, keyLength, valueOffset, valueLength = self.__entry(middle)
+            if self.__map[keyOffset:keyOffset + keyLength] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.__count:
+            return []
+        keyOffset, keyLength, valueOffset, valueLength = self.__entry(low)
+        if self.__map[keyOffset:keyOffset + keyLength] != key:
+            return []
+        values = self.__map[valueOffset:valueOffset + valueLength]
+        return [value.decode('utf-8') for value in values.split('\0')]
+
+    @classmethod
+    def write(cls, indexFile, translations):
+        """
+        Writes an index of translations (a dictionary from unicode messages
+        to sets of unicode translations).
+        """
+        keys = sorted([key.encode('utf-8') for key in translations.keys()])
+        strings = []
+        entries = []
+        offset = cls.header.size + len(keys) * cls.entry.size
+        for key in keys:
+            value = '\0'.join(sorted([translation.encode('utf-8') for translation
+                                      in translations[key.decode('utf-8')]]))
+            entries.append(cls.entry.pack(offset, len(key),
+                                          offset + len(key), len(value)))
+            strings.append(key)
+            strings.append(value)
+            offset += len(key) + len(value)
+        # Written under a name of its own, as other processes may be
+        # compiling the same index at the same time.
+        handle, temporary = tempfile.mkstemp(
+            prefix=os.path.basename(indexFile) + '.',
+            dir=os.path.dirname(indexFile))
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(cls.header.pack(cls.magic, cls.version, len(keys)))
+                f.write(''.join(entries))
+                f.write(''.join(strings))
+            # Other processes may be reading the previous index; they keep
+            # their mapping of it.
+            os.rename(temporary, indexFile)
+        except Exception:
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+            raise
+
+
+def compileTranslations(moFiles):
+    """
+    Parses the given mo-files, returning the dictionary from messages (and
+    their variants without mnemonics) to sets of translations that
+    CompiledTranslationDb indexes.
+    """
+    translations = {}
+    for moFile in moFiles:
+        try:
+            catalog = gettext.GNUTranslations(open(moFile))._catalog
+        except (AttributeError, IndexError, IOError):
+            if config.config.debugTranslation:
+                logger.log(
+                    "Warning: Failed to load mo-file for translation: " + moFile)
+            continue
+        for (msgid, msgstr) in catalog.items():
+            if not isinstance(msgid, basestring) or not msgid or msgstr == msgid:
+                continue
+            translations.setdefault(msgid, set()).add(msgstr)
+            for stripped in mnemonicVariants(msgid):
+                translations.setdefault(stripped, set()).add(
+                    msgstr.replace('_', ''))
+    return translations
+
+
+def getCompiledTranslationDb(packageName, language, moFiles, directories=None):
+    """
+    Returns a CompiledTranslationDb for the given mo-files of a package,
+    compiling the index into config.dataDir first unless a process has
+    already done so for the same package, language and versions of the
+    mo-files (the index is keyed by their modification times and sizes).
+
+    If the directories holding the mo-files are given, the index is keyed
+    by their modification times instead (no mo-file can be added, removed
+    or replaced by a package update without changing them), and moFiles
+    may be a function returning the mo-files, which is then only called
+    when the index has to be compiled.
+    """
+    stamps = []
+    if directories is not None:
+        paths = sorted(directories)
+    else:
+        paths = sorted(moFiles)
+    for path in paths:
+        try:
+            info = os.stat(path)
+            stamps.append((path, int(info.st_mtime), info.st_size))
+        except OSError:
+            pass
+    digest = hashlib.sha1(repr(stamps)).hexdigest()[:16]
+    name = re.sub(r'[^\w.-]', '_', '%s-%s' % (packageName, language or 'all'))
+    directory = os.path.join(config.config.dataDir, 'translations')
+    indexFile = os.path.join(directory, '%s-%s.idx' % (name, digest))
+    if not os.path.exists(indexFile):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # Another process may have just made it.
+            if e.errno != errno.EEXIST:
+                raise
+        if config.config.debugTranslation:
+            logger.log("Compiling translation index %s" % indexFile)
+        if callable(moFiles):
+            moFiles = moFiles()
+        CompiledTranslationDb.write(indexFile, compileTranslations(moFiles))
+    return CompiledTranslationDb(indexFile)
+
+
+# Memo of translate(), and the translation databases it is valid for:
+translationMemo = {}
+translationMemoDbs = ()
 
 
 def translate(srcString):
     """
     Look up srcString in the various translation databases (if any), returning
     a list of all matches found (potentially the empty list)
+
+    The results are remembered for as long as translationDbs doesn't change.
     """
+    global translationMemoDbs
+    if len(translationDbs) != len(translationMemoDbs) or \
+            tuple(translationDbs) != translationMemoDbs:
+        translationMemo.clear()
+        translationMemoDbs = tuple(translationDbs)
+    try:
+        return list(translationMemo[srcString])
+    except KeyError:
+        pass
     # Use a dict to get uniqueness:
     results = {}
     # Try to translate the string:
@@ -119,14 +380,50 @@ def translate(srcString):
     if len(results) == 0:
         if config.config.debugTranslation:
             logger.log('Translation not found for "%s"' % srcString)
+    translationMemo[srcString] = results.keys()
     return results.keys()
 
 
+# Characters giving a pattern regular expression semantics. Parentheses are
+# always escaped, since grouping will never be needed here, so they don't
+# count; nor does a leading '*', which is escaped too.
+regexChars = re.compile(r'[.^$*+?{}\[\]\\|]')
+
+
+def classifyPattern(pattern):
+    """
+    Works out how a script string has to be matched against the names the
+    application reports. Returns one of:
+
+    ('literal', string): the name must be equal to the string;
+    ('prefix', string): the name must start with the string (the pattern
+    was the string followed by '.*');
+    ('regex', compiledRegex): the name must match the regular expression.
+    """
+    pattern = safeDecode(pattern)
+    if pattern.startswith('*'):
+        lead, body = u'*', pattern[1:]
+    else:
+        lead, body = u'', pattern
+    if not regexChars.search(body):
+        return ('literal', lead + body)
+    if body.endswith('.*') and not regexChars.search(body[:-2]):
+        return ('prefix', lead + body[:-2])
+    if lead:
+        pattern = u'\\' + pattern
+    # Escape all parentheses, since grouping will never be needed here
+    pattern = re.sub(r'([\(\)])', r'\\\1', pattern)
+    return ('regex', re.compile(pattern + u'$'))
+
+
 class TranslatableString(object):
 
     """
     Class representing a string that we want to match strings against, handling
     translation for us, by looking it up once at construction time.
+
+    The string and its translations are compiled into matchers at the same
+    time, so that matching a name is mostly a set lookup.
     """
 
     def __init__(self, untranslatedString):
@@ -140,49 +437,83 @@ class TranslatableString(object):
             untranslatedString = safeDecode(untranslatedString)
         self.untranslatedString = untranslatedString
         self.translatedStrings = translate(untranslatedString)
+        self.__compile()
+
+    def __compile(self):
+        # Names are matched as the bindings give them to us (UTF-8 encoded
+        # byte strings) or as unicode, so literals and prefixes are kept in
+        # both forms; only regular expressions need the name decoded.
+        # 'x$' also matches 'x\n', hence the extra literals.
+        self.__literalText = set()
+        self.__literalBytes = set()
+        self.__prefixes = []
+        self.__regexes = []
+        for string in list(self.translatedStrings) + [self.untranslatedString]:
+            kind, matcher = classifyPattern(string)
+            if kind == 'literal':
+                for literal in (matcher, matcher + u'\n'):
+                    self.__literalText.add(literal)
+                    self.__literalBytes.add(literal.encode('utf-8'))
+            elif kind == 'prefix':
+                self.__prefixes.append(matcher)
+                self.__prefixes.append(matcher.encode('utf-8'))
+            else:
+                self.__regexes.append(matcher)
+        self.__literal = not self.__prefixes and not self.__regexes
+
+    def getLiteralStrings(self):
+        """
+        If neither the original string nor any of its translations use
+        regular expression syntax, returns the list of strings that match
+        (i.e. they can only be matched exactly). Otherwise returns None.
+        """
+        if not self.__literal:
+            return None
+        return list(self.translatedStrings) + [self.untranslatedString]
+
+    def matches(self, name):
+        """
+        Does the name reported by the application match the original string
+        or one of its translations?
+        """
+        if name is None:
+            return False
+        if isinstance(name, unicode):
+            if name in self.__literalText:
+                return True
+        elif name in self.__literalBytes:
+            return True
+        if self.__literal:
+            return False
+        for prefix in self.__prefixes:
+            if type(prefix) is type(name) and name.startswith(prefix):
+                # '.*$' doesn't match across lines:
+                if '\n' not in name[len(prefix):-1]:
+                    return True
+        if self.__regexes:
+            name = safeDecode(name)
+            for regex in self.__regexes:
+                if regex.match(name):
+                    return True
+        return False
 
     def matchedBy(self, string):
         """
         Compare the test string against either the translation of the original
         string (or simply the original string, if no translation was found).
         """
-        # print "comparing %s against %s"%(string, self)
-        def stringsMatch(inS, outS):
-            """
-            Compares a regular expression to a string
-
-            inS: the regular expression (or normal string)
-            outS: the normal string to be compared against
-            """
-            inString = str(inS)
-            outString = outS
-            if inString == outString:
-                return True
-            inString = inString + '$'
-            inString = safeDecode(inString)
-            outString = safeDecode(outString)
-            if inString[0] == '*':
-                inString = "\\" + inString
-            # Escape all parentheses, since grouping will never be needed here
-            inString = re.sub('([\(\)])', r'\\\1', inString)
-            match = re.match(inString, outString)
-            matched = match is not None
-            return matched
-
-        matched = False
-        # the 'ts' variable keeps track of whether we're working with
-        # translated strings. it's only used for debugging purposes.
-        #ts = 0
-        # print string, str(self)
-        for translatedString in self.translatedStrings:
-            #ts = ts + 1
-            matched = stringsMatch(translatedString, string)
-            if not matched:
-                matched = translatedString == string
-            if matched:
-                return matched
-        # ts=0
-        return stringsMatch(self.untranslatedString, string)
+        return self.matches(string)
+
+    def __eq__(self, other):
+        if not isinstance(other, TranslatableString):
+            return False
+        return self.untranslatedString == other.untranslatedString
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.untranslatedString)
 
     def __str__(self):
         """
@@ -220,10 +551,38 @@ def isMoFile(filename, language=''):
         return False
 
 
+def getLocaleDirectories(language):
+    """
+    The directories the mo-files of the given language are found in (see
+    PackageDb.getMoFiles()), found without listing the mo-files themselves.
+    """
+    import distro
+    directories = []
+    for localePrefix in distro.packageDb.localePrefixes:
+        top = localePrefix + '/' + language
+        try:
+            names = os.listdir(top)
+        except OSError:
+            continue
+        directories.append(top)
+        # e.g. LC_MESSAGES, which isn't listed itself, having the mo-files:
+        directories.extend([top + '/' + name for name in names
+                            if os.path.isdir(top + '/' + name)])
+    return directories
+
+
 def loadAllTranslationsForLanguage(language):
     import distro
-    for moFile in distro.packageDb.getMoFiles(language):
-        translationDbs.append(GettextTranslationDb(moFile))
+    if config.config.compileTranslations:
+        # Keyed by the locale directories, so that the mo-files are only
+        # looked for when the index has to be compiled.
+        translationDbs.append(getCompiledTranslationDb(
+            'all', language, lambda: distro.packageDb.getMoFiles(language),
+            getLocaleDirectories(language)))
+        return
+    moFiles = distro.packageDb.getMoFiles(language)
+    for moFile in moFiles:
+        translationDbs.append(LazyTranslationDb(moFile))
 
 
 def getMoFilesForPackage(packageName, language='', getDependencies=True):
@@ -253,9 +612,16 @@ def loadTranslationsFromPackageMoFiles(packageName, getDependencies=True):
     """
     Helper function which appends all of the gettext translation mo-files used by
     the package (and its dependencies) to the translation database list.
+
+    The mo-files are only parsed when translations are first looked up in
+    them (see LazyTranslationDb). If config.compileTranslations is True, a
+    single CompiledTranslationDb holding all of their translations is
+    appended instead.
     """
     # Keep a list of mo-files that are already in use to avoid duplicates.
     moFiles = {}
+    # The mo-files to load, in order:
+    toLoad = []
 
     def load(packageName, language='', getDependencies=True):
         for moFile in getMoFilesForPackage(packageName, language, getDependencies):
@@ -263,15 +629,8 @@ def loadTranslationsFromPackageMoFiles(packageName, getDependencies=True):
             # so we ignore them here. This is
             # https://bugzilla.redhat.com/bugzilla/show_bug.cgi?id=172155 .
             if not('popt.mo' in moFile or moFile in moFiles):
-                try:
-                    translationDbs.append(GettextTranslationDb(moFile))
-                    moFiles[moFile] = None
-                except (AttributeError, IndexError):
-                    if config.config.debugTranslation:
-                        #import traceback
-                        # logger.log(traceback.format_exc())
-                        logger.log(
-                            "Warning: Failed to load mo-file for translation: " + moFile)
+                toLoad.append(moFile)
+                moFiles[moFile] = None
 
     # Hack alert:
     #
@@ -285,3 +644,11 @@ def loadTranslationsFromPackageMoFiles(packageName, getDependencies=True):
     if isinstance(distro.distro, distro.Ubuntu):
         load('language-pack-gnome-%s' % language, language)
     load(packageName, language, getDependencies)
+
+    if config.config.compileTranslations:
+        translationDbs.append(
+            getCompiledTranslationDb(packageName, language, toLoad))
+        return
+    for moFile in toLoad:
+        # The mo-file is only parsed when it is first needed:
+        translationDbs.append(LazyTranslationDb(moFile))
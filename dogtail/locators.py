@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent locators
+
+With config.persistentLocators set, Node.findChild() records where it found
+each node (the child indexes leading to it from the node the search started
+at) in a locator file per application and version, in config.dataDir. Later
+runs against the same build of the application load that file and follow
+the recorded paths before falling back to a full search, so that a test
+suite run over and over doesn't keep paying for cold searches.
+
+The version of an application is taken from its executable (size and
+modification time), so that the locators of one build are not used for
+another. The files are written when the script exits.
+"""
+
+import os
+import re
+import json
+import atexit
+from config import config
+from logging import debugLogger as logger
+
+formatVersion = 1
+
+# LocatorStores by (application name, version), and by live application:
+stores = {}
+storesByApplication = {}
+
+
+def applicationVersion(application):
+    """
+    A string identifying the build of the given application.
+    """
+    try:
+        exe = os.path.realpath('/proc/%d/exe' % application.get_process_id())
+        info = os.stat(exe)
+        return "%s-%d-%d" % (os.path.basename(exe), info.st_size,
+                             int(info.st_mtime))
+    except Exception:
+        pass
+    try:
+        return "toolkit-%s" % application.get_toolkit_version()
+    except Exception:
+        return "unknown"
+
+
+def storeFor(application):
+    """
+    The LocatorStore of the given live application.
+    """
+    try:
+        return storesByApplication[application]
+    except KeyError:
+        pass
+    key = (application.name, applicationVersion(application))
+    store = stores.get(key)
+    if store is None:
+        store = LocatorStore(*key)
+        store.load()
+        stores[key] = store
+    storesByApplication[application] = store
+    return store
+
+
+def indexPath(node, top):
+    """
+    The list of child indexes leading from top down to node, or None if
+    node isn't below top.
+    """
+    path = []
+    while node != top:
+        if node is None or node.roleName == 'application':
+            return None
+        path.append(node.indexInParent)
+        node = node.parent
+    path.reverse()
+    return path
+
+
+def locatorKey(node, pred, recursive):
+    """
+    Returns the (store, key) under which a search is recorded, or
+    (None, None) if it can't be (e.g. searches on the desktop).
+    """
+    try:
+        if node.parent is None:
+            return (None, None)
+        application = node.getApplication()
+        start = indexPath(node, application)
+    except Exception:
+        return (None, None)
+    if start is None:
+        return (None, None)
+    key = "%s %s %s" % ('/'.join([str(i) for i in start]),
+                        recursive and 'recursive' or 'children',
+                        pred.getIdentityString())
+    return (storeFor(application), key)
+
+
+def lookup(node, pred, recursive):
+    """
+    The recorded child-index path of a search, or None.
+    """
+    store, key = locatorKey(node, pred, recursive)
+    if store is None:
+        return None
+    return store.lookup(key)
+
+
+def record(node, pred, recursive, path):
+    """
+    Records the child-index path at which a search found its node.
+    """
+    store, key = locatorKey(node, pred, recursive)
+    if store is not None:
+        store.record(key, path, pred.describeSearchResult())
+
+
+def forget(node, pred, recursive):
+    """
+    Forgets a recorded search, whose path turned out to be stale.
+    """
+    store, key = locatorKey(node, pred, recursive)
+    if store is not None:
+        store.forget(key)
+
+
+def saveAll():
+    for store in stores.values():
+        try:
+            store.save()
+        except (IOError, OSError) as e:
+            logger.log("Couldn't save locators to %s: %s" % (store.fileName, e))
+
+atexit.register(saveAll)
+
+
+class LocatorStore(object):
+
+    """
+    The locators of one version of an application. Each locator gives the
+    child-index path to the node a search found, the depth of that node
+    below the starting node, and a description of the search (for people
+    reading the file).
+    """
+
+    def __init__(self, appName, version):
+        self.appName = appName
+        self.version = version
+        self.locators = {}
+        self.forgotten = set()
+        self.dirty = False
+
+    @property
+    def fileName(self):
+        name = re.sub(r'[^\w.-]', '_', "%s-%s" % (self.appName, self.version))
+        return os.path.join(config.dataDir, 'locators', name + '.json')
+
+    def read(self):
+        try:
+            with open(self.fileName) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if data.get('format') != formatVersion:
+            return {}
+        return data.get('locators', {})
+
+    def load(self):
+        self.locators = self.read()
+        if config.debugSearching:
+            logger.log("Loaded %d locators from %s" % (len(self.locators),
+                                                       self.fileName))
+
+    def lookup(self, key):
+        locator = self.locators.get(key)
+        if locator is None:
+            return None
+        return locator['path']
+
+    def record(self, key, path, description):
+        locator = {'path': path, 'depth': len(path), 'search': description}
+        if self.locators.get(key) != locator:
+            self.locators[key] = locator
+            self.forgotten.discard(key)
+            self.dirty = True
+
+    def forget(self, key):
+        if self.locators.pop(key, None) is not None:
+            self.forgotten.add(key)
+            self.dirty = True
+
+    def save(self):
+        """
+        Writes the locators out, merged with those other processes may have
+        written in the meantime.
+        """
+        if not self.dirty:
+            return
+        locators = self.read()
+        for key in self.forgotten:
+            locators.pop(key, None)
+        locators.update(self.locators)
+        directory = os.path.dirname(self.fileName)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = "%s.%d" % (self.fileName, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump({'format': formatVersion, 'application': self.appName,
+                       'version': self.version, 'locators': locators},
+                      f, indent=1, sort_keys=True)
+        os.rename(temporary, self.fileName)
+        self.dirty = False
@@ -12,6 +12,10 @@ David Malcolm <dmalcolm@redhat.com>
 import os
 import sys
 import time
+import atexit
+import signal
+import Queue
+import threading
 from config import config
 import codecs
 
@@ -86,6 +90,173 @@ class TimeStamp(object):
         return self.now
 
 
+# Log levels, from the most verbose one:
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+levels = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+
+def getLevel():
+    """
+    The level below which messages are dropped (see config.logLevel).
+    """
+    level = config.logLevel
+    if isinstance(level, int):
+        return level
+    return levels.get(str(level).lower(), DEBUG)
+
+
+class LogWriter(object):
+
+    """
+    Writes log files from a worker thread. Lines are queued (up to
+    config.logQueueSize of them, after which writing blocks until the
+    worker catches up), and the worker writes them in batches, flushing
+    the files when it runs out of lines, after a batch of maxBatch lines,
+    or config.logFlushInterval seconds after the last flush at the
+    latest.
+
+    Everything queued is written and flushed when an exception goes
+    uncaught, and at exit, where the worker is stopped. Scripts that want
+    the same on a signal can ask for it with flushOnSignal().
+    """
+
+    maxBatch = 1000
+    # Queued to make the worker write out what's before it and return:
+    stopMarker = object()
+
+    def __init__(self):
+        self.queue = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.queue = Queue.Queue(max(config.logQueueSize or 0, 0))
+            self.thread = threading.Thread(target=self.__run,
+                                           name='dogtail log writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, file, text):
+        """
+        Queues text to be written to file.
+        """
+        if self.thread is None:
+            self.start()
+        self.queue.put((file, text))
+
+    def flush(self, timeout=5.0):
+        """
+        Waits (up to timeout seconds) for everything queued so far to be
+        written and flushed.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        done = threading.Event()
+        try:
+            self.queue.put((None, done), timeout=timeout)
+        except Queue.Full:
+            return
+        done.wait(timeout)
+
+    def stop(self, timeout=5.0):
+        """
+        Writes and flushes everything queued so far, then stops the worker
+        (waiting for it up to timeout seconds). Writing again starts a new
+        one.
+        """
+        with self.lock:
+            thread = self.thread
+            if thread is None:
+                return
+            if thread.is_alive():
+                try:
+                    self.queue.put((None, self.stopMarker), timeout=timeout)
+                except Queue.Full:
+                    return
+                thread.join(timeout)
+            if not thread.is_alive():
+                self.thread = None
+
+    def __run(self):
+        dirty = set()
+        lastFlush = time.time()
+        while True:
+            interval = config.logFlushInterval or 1.0
+            try:
+                batch = [self.queue.get(timeout=interval)]
+            except Queue.Empty:
+                batch = []
+            while len(batch) < self.maxBatch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            markers = []
+            stopping = False
+            for (file, text) in batch:
+                if text is self.stopMarker:
+                    stopping = True
+                    continue
+                if file is None:
+                    markers.append(text)
+                    continue
+                try:
+                    file.write(text)
+                    dirty.add(file)
+                except Exception:
+                    pass
+            if markers or self.queue.empty() or len(batch) >= self.maxBatch \
+                    or time.time() - lastFlush >= interval:
+                for file in dirty:
+                    try:
+                        file.flush()
+                    except Exception:
+                        pass
+                dirty.clear()
+                lastFlush = time.time()
+            for marker in markers:
+                marker.set()
+            if stopping:
+                return
+
+logWriter = LogWriter()
+atexit.register(logWriter.stop)
+
+
+def flushOnSignal(signalNumber):
+    """
+    Makes the signal flush the log files first, then do what it did
+    before. Nothing installs this by itself; call it from the main thread,
+    e.g. flushOnSignal(signal.SIGTERM), if a script is likely to be
+    killed while logging in the background.
+    """
+    try:
+        previous = signal.getsignal(signalNumber)
+    except ValueError:
+        return
+    if previous in (None, signal.SIG_IGN):
+        return
+
+    def handler(number, frame):
+        logWriter.flush()
+        if callable(previous):
+            return previous(number, frame)
+        signal.signal(number, signal.SIG_DFL)
+        os.kill(os.getpid(), number)
+
+    try:
+        signal.signal(signalNumber, handler)
+    except ValueError:
+        # Not in the main thread.
+        pass
+
+
 class Logger(object):
 
     """
@@ -141,14 +312,38 @@ class Logger(object):
         self.file.write("##### " + os.path.basename(self.fileName) + '\n')
         self.file.flush()
 
-    def log(self, message, newline=True, force=False):
+    def isEnabledFor(self, level=INFO, force=False):
+        """
+        Would a message of the given level be written anywhere?
+        """
+        if force:
+            return True
+        if level < getLevel():
+            return False
+        return bool(config.logDebugToFile or
+                    (self.stdOut and config.logDebugToStdOut))
+
+    def log(self, message, newline=True, force=False, level=INFO, args=()):
         """
         Hook used for logging messages. Might eventually be a virtual
         function, but nice and simple for now.
 
-        If force is True, log to a file irrespective of config.logDebugToFile.
+        If force is True, log to a file irrespective of config.logDebugToFile
+        and config.logLevel.
+
+        Messages below config.logLevel, or that would go nowhere, are
+        dropped before being built: message can be a callable returning
+        the message, and args the values to %-format it with, so that
+        nothing is computed for them.
         """
-        message = message.decode('utf-8', 'replace')
+        if not self.isEnabledFor(level, force):
+            return
+        if callable(message):
+            message = message()
+        if args:
+            message = message % args
+        if not isinstance(message, unicode):
+            message = message.decode('utf-8', 'replace')
 
         # Try to open and write the result to the log file.
         if isinstance(self.file, bool) and (force or config.logDebugToFile):
@@ -156,10 +351,14 @@ class Logger(object):
 
         if force or config.logDebugToFile:
             if newline:
-                self.file.write(message + '\n')
+                line = message + '\n'
+            else:
+                line = message + ' '
+            if config.logInBackground:
+                logWriter.write(self.file, line)
             else:
-                self.file.write(message + ' ')
-            self.file.flush()
+                self.file.write(line)
+                self.file.flush()
 
         if self.stdOut and config.logDebugToStdOut:
             if newline:
@@ -167,6 +366,18 @@ class Logger(object):
             else:
                 print(message)
 
+    def debug(self, message, *args):
+        self.log(message, level=DEBUG, args=args)
+
+    def info(self, message, *args):
+        self.log(message, level=INFO, args=args)
+
+    def warning(self, message, *args):
+        self.log(message, level=WARNING, args=args)
+
+    def error(self, message, *args):
+        self.log(message, level=ERROR, args=args)
+
 
 class ResultsLogger(Logger):
 
@@ -209,6 +420,7 @@ def exceptionHook(exc, value, tb):  # pragma: no cover
     tbStringList = traceback.format_exception(exc, value, tb)
     tbString = ''.join(tbStringList)
     debugLogger.log(tbString)
+    logWriter.flush()
     sys.exc_clear()
 
 sys.excepthook = exceptionHook
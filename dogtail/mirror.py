@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Live mirrors of accessible trees
+
+A TreeMirror keeps an in-process copy of one application's accessible tree,
+starting from a snapshot and patching it as the application reports changes
+(children added or removed, names, descriptions and states changing). While
+a mirror is running, Node.findChild() and Node.findChildren() on nodes of
+that application are answered from the mirror, so repeated searches only
+cost D-Bus round trips for the nodes that match and for the parts of the
+tree that changed in a way the mirror couldn't patch.
+
+Mirrors are opt-in:
+
+    mirror = TreeMirror(app)
+    mirror.start()
+    ...
+    mirror.stop()
+"""
+
+import pyatspi
+import predicate
+import snapshot
+
+from gi.repository import GLib
+from config import config
+from logging import debugLogger as logger
+
+# Running mirrors, by application node:
+mirrors = {}
+
+mirrorEvents = ('object:children-changed',
+                'object:property-change:accessible-name',
+                'object:property-change:accessible-description',
+                'object:state-changed')
+
+
+def mirrorFor(node):
+    """
+    The running TreeMirror covering the given node, or None.
+    """
+    if not mirrors:
+        return None
+    try:
+        return mirrors.get(node.getApplication())
+    except Exception:
+        return None
+
+
+class TreeMirror(object):
+
+    """
+    An incrementally updated copy of an application's accessible tree.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.snapshot = None
+        self.listening = False
+
+    def start(self):
+        """
+        Takes the initial snapshot and starts following the application's
+        events.
+        """
+        from pyatspi import Registry as registry
+        registry.registerEventListener(self.__onEvent, *mirrorEvents)
+        self.listening = True
+        self.snapshot = snapshot.Snapshot(self.application)
+        mirrors[self.application] = self
+
+    def stop(self):
+        """
+        Stops following the application; the mirror won't be used by
+        searches anymore.
+        """
+        if self.listening:
+            from pyatspi import Registry as registry
+            registry.deregisterEventListener(self.__onEvent, *mirrorEvents)
+            self.listening = False
+        if mirrors.get(self.application) is self:
+            del mirrors[self.application]
+
+    def sync(self):
+        """
+        Applies the events the application has sent so far.
+        """
+        context = GLib.MainContext.default()
+        while context.pending():
+            context.iteration(False)
+
+    def rebuild(self):
+        """
+        Throws the mirror away and takes a new snapshot.
+        """
+        if config.debugSearching:
+            logger.log("Rebuilding the tree mirror of %s" % self.application)
+        self.snapshot = snapshot.Snapshot(self.application)
+
+    def markDirty(self, record):
+        """
+        Forgets the children of a record, so that they get fetched from the
+        live tree the next time they are needed.
+        """
+        for child in record._children:
+            self.snapshot.forget(child)
+        del record._children[:]
+        record.complete = False
+
+    def __recordFor(self, accessible):
+        try:
+            return self.snapshot.recordFor(accessible)
+        except Exception:
+            return None
+
+    def __onEvent(self, event):
+        try:
+            if event.host_application != self.application:
+                return
+        except AttributeError:
+            pass
+        if self.snapshot is None:
+            return
+        record = self.__recordFor(event.source)
+        if record is None:
+            # Not something we have mirrored (yet).
+            return
+        try:
+            if event.type.startswith('object:children-changed'):
+                self.__childrenChanged(record, event)
+            elif event.type == 'object:property-change:accessible-name':
+                self.snapshot.rename(record, event.source.name)
+            elif event.type == 'object:property-change:accessible-description':
+                record.description = event.source.description
+            elif event.type.startswith('object:state-changed:'):
+                self.__stateChanged(record, event)
+        except Exception:
+            # The source went away while we were looking at it.
+            self.markDirty(record.parent or record)
+
+    def __childrenChanged(self, record, event):
+        if not record.complete:
+            # The children will be fetched when needed anyway.
+            return
+        index = event.detail1
+        if event.type.endswith(':add'):
+            child = event.any_data
+            if child is None or index < 0 or index > len(record._children):
+                self.markDirty(record)
+                return
+            childRecord = self.snapshot.addRecord(
+                self.snapshot.recordFromNode(child))
+            childRecord.parent = record
+            childRecord.complete = False
+            record._children.insert(index, childRecord)
+        elif event.type.endswith(':remove'):
+            if index < 0 or index >= len(record._children):
+                self.markDirty(record)
+                return
+            self.snapshot.forget(record._children.pop(index))
+        else:
+            self.markDirty(record)
+            return
+        for i, childRecord in enumerate(record._children):
+            childRecord.indexInParent = i
+        record.childCount = len(record._children)
+
+    def __stateChanged(self, record, event):
+        stateName = event.type.split(':')[2]
+        state = getattr(pyatspi, 'STATE_' + stateName.upper().replace('-', '_'),
+                        None)
+        if state is None:
+            return
+        if event.detail1:
+            record.states.add(int(state))
+        else:
+            record.states.discard(int(state))
+
+    def __liveMatches(self, records, pred):
+        """
+        Resolves matching records to live nodes, checking that they do
+        still match.
+        """
+        if isinstance(pred, predicate.Predicate):
+            pred = pred.satisfiedByNode
+        nodes = []
+        for record in records:
+            try:
+                node = record.node
+                if node is not None and pred(node):
+                    nodes.append(node)
+                    continue
+            except Exception:
+                pass
+            return None
+        return nodes
+
+    def findChildren(self, node, pred, recursive=True, first=False):
+        """
+        Searches below the live node, returning a list of live nodes, or
+        None if the mirror doesn't cover that node or turned out to be out
+        of date (the caller should then fall back to a live search).
+
+        If first is True, the search stops at the first match.
+        """
+        self.sync()
+        for attempt in range(2):
+            record = self.__recordFor(node)
+            if record is None:
+                return None
+            records = self.snapshot.search(record, pred, recursive, first)
+            nodes = self.__liveMatches(records, pred)
+            if nodes is not None:
+                return nodes
+            # We missed a change somewhere; start afresh.
+            self.rebuild()
+        return None
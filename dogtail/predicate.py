@@ -9,7 +9,7 @@ from i18n import TranslatableString
 def stringMatches(scriptName, reportedName):
     assert isinstance(scriptName, TranslatableString)
 
-    return scriptName.matchedBy(reportedName)
+    return scriptName.matches(reportedName)
 
 
 def makeScriptRecursiveArgument(isRecursive, defaultValue):
@@ -45,6 +45,102 @@ def makeCamel(string):
     return result
 
 
+# Relative costs of the checks a predicate is made of, used to order them so
+# that the cheap ones rule out most nodes before the expensive ones are made:
+ROLE_COST = 0      # an integer comparison of the role
+LITERAL_COST = 1   # a string (dictionary) lookup
+REGEX_COST = 2     # a regular expression match
+RELATION_COST = 3  # following a relation to another node
+OTHER_COST = 4     # arbitrary code
+
+# Role numbers by role name, filled in on first use:
+roleNumbers = {}
+
+
+def getRoleNumbers():
+    """
+    The dictionary of AT-SPI role numbers by role name, or an empty one if
+    the bindings aren't available.
+    """
+    if not roleNumbers:
+        try:
+            import pyatspi
+            for number in range(int(pyatspi.ROLE_LAST_DEFINED)):
+                name = pyatspi.Atspi.role_get_name(pyatspi.Atspi.Role(number))
+                roleNumbers[name] = number
+        except Exception:
+            pass
+    return roleNumbers
+
+
+def roleCheck(test):
+    """
+    Returns a (cost, check) pair checking that a node's role name satisfies
+    test (a function of the role name). The role names are turned into
+    role numbers once, so that the check is an integer comparison.
+    """
+    numbers = frozenset([number for (name, number) in getRoleNumbers().items()
+                         if test(name)])
+
+    def check(node):
+        try:
+            role = node.role
+        except AttributeError:
+            role = None
+        if role is None or not numbers:
+            return test(node.roleName)
+        return int(role) in numbers
+    return (ROLE_COST, check)
+
+
+def roleNamed(roleName):
+    return roleCheck(lambda name: name == roleName)
+
+
+def nameCheck(scriptName, attribute='name'):
+    """
+    Returns a (cost, check) pair checking the given attribute of a node
+    against a TranslatableString: a lookup if the string and its
+    translations are literals, a pattern match otherwise.
+    """
+    if scriptName.getLiteralStrings() is not None:
+        cost = LITERAL_COST
+    else:
+        cost = REGEX_COST
+    return (cost, lambda node: scriptName.matches(getattr(node, attribute)))
+
+
+def labelCheck(labelText):
+    """
+    Returns a (cost, check) pair checking that a node is labelled by a
+    node whose name matches labelText.
+    """
+    def check(node):
+        labeller = node.labeller
+        if labeller:
+            return stringMatches(labelText, labeller.name)
+        return False
+    return (RELATION_COST, check)
+
+
+def compilePlan(checks):
+    """
+    Turns a list of (cost, check) pairs into a function that is true for a
+    node if all the checks are, making the cheapest checks first and
+    stopping at the first that fails.
+    """
+    checks = [check for (cost, check) in sorted(checks, key=lambda c: c[0])]
+    if len(checks) == 1:
+        return checks[0]
+
+    def plan(node):
+        for check in checks:
+            if not check(node):
+                return False
+        return True
+    return plan
+
+
 class Predicate(object):
 
     """Abstract base class representing a predicate function on nodes.
@@ -58,6 +154,28 @@ class Predicate(object):
     def describeSearchResult(self, node):
         raise NotImplementedError
 
+    def getChecks(self):
+        """
+        Returns the list of (cost, check) pairs the predicate is made of,
+        where check is a function of a node. A node satisfies the
+        predicate if it passes every check. Predicates whose checks are
+        known are compiled into a plan which makes the cheapest checks
+        first (see compilePlan); by default there is a single check, the
+        predicate itself.
+        """
+        return [(OTHER_COST, self.satisfiedByNode)]
+
+    def getIndexHints(self):
+        """
+        Returns a (roleName, names) pair describing what any node satisfying
+        the predicate must look like, so that searches on an indexed tree
+        (see dogtail.snapshot) only need to test the nodes having that role
+        name and one of those names.
+
+        Either may be None, meaning that nothing is known about it.
+        """
+        return (None, None)
+
     def makeScriptMethodCall(self, isRecursive):
         """
         Method to generate a string containing a (hopefully) readable search
@@ -75,6 +193,33 @@ class Predicate(object):
         """
         raise NotImplementedError
 
+    def __identity(self):
+        """
+        The data identifying the predicate: its attributes, apart from
+        the functions generated from them (e.g. satisfiedByNode).
+        """
+        return tuple(sorted((name, value) for (name, value) in self.__dict__.items()
+                            if not callable(value)))
+
+    def getIdentityString(self):
+        """
+        A string identifying the predicate, which is the same for equal
+        predicates in different processes (see dogtail.locators).
+        """
+        def identityString(value):
+            # Nested predicates (in And, Or and Not) go by their own
+            # identity, not by their repr(), which has their address.
+            if isinstance(value, Predicate):
+                return value.getIdentityString()
+            if isinstance(value, (tuple, list)):
+                return "(%s)" % ", ".join([identityString(item)
+                                           for item in value])
+            return repr(getattr(value, 'untranslatedString', value))
+
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            ["%s=%s" % (name, identityString(value))
+             for (name, value) in self.__identity()]))
+
     def __eq__(self, other):
         """
         Predicates are considered equal if they are of the same subclass and
@@ -88,7 +233,22 @@ class Predicate(object):
         if type(self) != type(other):
             return False
         else:
-            return self.__dict__ == other.__dict__
+            return self.__identity() == other.__identity()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        """
+        Equal predicates hash the same, so they can be used as dictionary
+        keys (e.g. by dogtail.tree.SearchCache).
+        """
+        identity = self.__identity()
+        try:
+            return hash((type(self), identity))
+        except TypeError:
+            # Some of the data isn't hashable; the names will have to do.
+            return hash((type(self), tuple(name for (name, value) in identity)))
 
 
 class IsAnApplicationNamed(Predicate):
@@ -101,9 +261,13 @@ class IsAnApplicationNamed(Predicate):
         self.satisfiedByNode = self._genCompareFunc()
 
     def _genCompareFunc(self):
-        def satisfiedByNode(node):
-            return node.roleName == 'application' and stringMatches(self.appName, node.name)
-        return satisfiedByNode
+        return compilePlan(self.getChecks())
+
+    def getChecks(self):
+        return [roleNamed('application'), nameCheck(self.appName)]
+
+    def getIndexHints(self):
+        return ('application', self.appName.getLiteralStrings())
 
     def describeSearchResult(self):
         return '%s application' % self.appName
@@ -150,29 +314,37 @@ class GenericPredicate(Predicate):
         self.satisfiedByNode = self._genCompareFunc()
 
     def _genCompareFunc(self):
-        def satisfiedByNode(node):
-            # labelled nodes are handled specially:
-            if self.label:
-                # this reverses the search; we're looking for a node with LABELLED_BY
-                # and then checking the label, rather than looking for a label and
-                # then returning whatever LABEL_FOR targets
-                if node.labeller:
-                    return stringMatches(self.label, node.labeller.name)
-                else:
-                    return False
-            else:
-                # Ensure the node matches any criteria that were set:
-                if self.name:
-                    if not stringMatches(self.name, node.name):
-                        return False
-                if self.roleName:
-                    if self.roleName != node.roleName:
-                        return False
-                if self.description:
-                    if self.description != node.description:
-                        return False
-                return True
-        return satisfiedByNode
+        return compilePlan(self.getChecks())
+
+    def getChecks(self):
+        # labelled nodes are handled specially:
+        if self.label:
+            # this reverses the search; we're looking for a node with LABELLED_BY
+            # and then checking the label, rather than looking for a label and
+            # then returning whatever LABEL_FOR targets
+            return [labelCheck(self.label)]
+        # Ensure the node matches any criteria that were set:
+        checks = []
+        if self.roleName:
+            checks.append(roleNamed(self.roleName))
+        if self.name:
+            checks.append(nameCheck(self.name))
+        if self.description:
+            description = self.description
+            checks.append((LITERAL_COST,
+                           lambda node: description == node.description))
+        if not checks:
+            checks.append((ROLE_COST, lambda node: True))
+        return checks
+
+    def getIndexHints(self):
+        if self.label:
+            # The label is on another node.
+            return (None, None)
+        names = None
+        if self.name:
+            names = self.name.getLiteralStrings()
+        return (self.roleName or None, names)
 
     def describeSearchResult(self):
         return self.debugName
@@ -213,9 +385,13 @@ class IsNamed(Predicate):
         self.satisfiedByNode = self._genCompareFunc()
 
     def _genCompareFunc(self):
-        def satisfiedByNode(node):
-            return stringMatches(self.name, node.name)
-        return satisfiedByNode
+        return compilePlan(self.getChecks())
+
+    def getChecks(self):
+        return [nameCheck(self.name)]
+
+    def getIndexHints(self):
+        return (None, self.name.getLiteralStrings())
 
     def describeSearchResult(self):
         return "named %s" % self.name
@@ -237,9 +413,13 @@ class IsAWindowNamed(Predicate):
         self.satisfiedByNode = self._genCompareFunc()
 
     def _genCompareFunc(self):
-        def satisfiedByNode(node):
-            return node.roleName == 'frame' and stringMatches(self.windowName, node.name)
-        return satisfiedByNode
+        return compilePlan(self.getChecks())
+
+    def getChecks(self):
+        return [roleNamed('frame'), nameCheck(self.windowName)]
+
+    def getIndexHints(self):
+        return ('frame', self.windowName.getLiteralStrings())
 
     def describeSearchResult(self):
         return "%s window" % self.windowName
@@ -256,7 +436,13 @@ class IsAWindow(Predicate):
     """Predicate subclass that looks for top-level windows"""
 
     def __init__(self):
-        self.satisfiedByNode = lambda node: node.roleName == 'frame'
+        self.satisfiedByNode = compilePlan(self.getChecks())
+
+    def getChecks(self):
+        return [roleNamed('frame')]
+
+    def getIndexHints(self):
+        return ('frame', None)
 
     def describeSearchResult(self):
         return "window"
@@ -272,9 +458,13 @@ class IsADialogNamed(Predicate):
         self.satisfiedByNode = self._genCompareFunc()
 
     def _genCompareFunc(self):
-        def satisfiedByNode(node):
-            return node.roleName == 'dialog' and stringMatches(self.dialogName, node.name)
-        return satisfiedByNode
+        return compilePlan(self.getChecks())
+
+    def getChecks(self):
+        return [roleNamed('dialog'), nameCheck(self.dialogName)]
+
+    def getIndexHints(self):
+        return ('dialog', self.dialogName.getLiteralStrings())
 
     def describeSearchResult(self):
         return '%s dialog' % self.dialogName
@@ -302,13 +492,11 @@ class IsLabelledAs(Predicate):
         self.satisfiedByNode = self._genCompareFunc()
 
     def _genCompareFunc(self):
-        def satisfiedByNode(node):
-            # FIXME
-            if node.labeller:
-                return stringMatches(self.labelText, node.labeller.name)
-            else:
-                return False
-        return satisfiedByNode
+        return compilePlan(self.getChecks())
+
+    def getChecks(self):
+        # FIXME
+        return [labelCheck(self.labelText)]
 
     def describeSearchResult(self):
         return 'labelled %s' % self.labelText
@@ -327,8 +515,13 @@ class IsAMenuNamed(Predicate):
     def __init__(self, menuName):
         self.menuName = TranslatableString(menuName)
         self.debugName = self.describeSearchResult()
-        self.satisfiedByNode = lambda node: node.roleName == 'menu' and \
-            stringMatches(self.menuName, node.name)
+        self.satisfiedByNode = compilePlan(self.getChecks())
+
+    def getChecks(self):
+        return [roleNamed('menu'), nameCheck(self.menuName)]
+
+    def getIndexHints(self):
+        return ('menu', self.menuName.getLiteralStrings())
 
     def describeSearchResult(self):
         return '%s menu' % (self.menuName)
@@ -347,9 +540,15 @@ class IsAMenuItemNamed(Predicate):
     def __init__(self, menuItemName):
         self.menuItemName = TranslatableString(menuItemName)
         self.debugName = self.describeSearchResult()
-        self.satisfiedByNode = lambda node: \
-            node.roleName.endswith('menu item') and \
-            stringMatches(self.menuItemName, node.name)
+        self.satisfiedByNode = compilePlan(self.getChecks())
+
+    def getChecks(self):
+        return [roleCheck(lambda name: name.endswith('menu item')),
+                nameCheck(self.menuItemName)]
+
+    def getIndexHints(self):
+        # There are several kinds of menu items.
+        return (None, self.menuItemName.getLiteralStrings())
 
     def describeSearchResult(self):
         return '%s menuitem' % (self.menuItemName)
@@ -368,8 +567,13 @@ class IsATextEntryNamed(Predicate):
     def __init__(self, textEntryName):
         self.textEntryName = TranslatableString(textEntryName)
         self.debugName = self.describeSearchResult()
-        self.satisfiedByNode = lambda node: node.roleName == 'text' and \
-            stringMatches(self.textEntryName, node.name)
+        self.satisfiedByNode = compilePlan(self.getChecks())
+
+    def getChecks(self):
+        return [roleNamed('text'), nameCheck(self.textEntryName)]
+
+    def getIndexHints(self):
+        return ('text', self.textEntryName.getLiteralStrings())
 
     def describeSearchResult(self):
         return '%s textentry' % (self.textEntryName)
@@ -388,8 +592,13 @@ class IsAButtonNamed(Predicate):
     def __init__(self, buttonName):
         self.buttonName = TranslatableString(buttonName)
         self.debugName = self.describeSearchResult()
-        self.satisfiedByNode = lambda node: node.roleName == 'push button' \
-            and stringMatches(self.buttonName, node.name)
+        self.satisfiedByNode = compilePlan(self.getChecks())
+
+    def getChecks(self):
+        return [roleNamed('push button'), nameCheck(self.buttonName)]
+
+    def getIndexHints(self):
+        return ('push button', self.buttonName.getLiteralStrings())
 
     def describeSearchResult(self):
         return '%s button' % (self.buttonName)
@@ -408,8 +617,13 @@ class IsATabNamed(Predicate):
     def __init__(self, tabName):
         self.tabName = TranslatableString(tabName)
         self.debugName = self.describeSearchResult()
-        self.satisfiedByNode = lambda node: node.roleName == 'page tab' and \
-            stringMatches(self.tabName, node.name)
+        self.satisfiedByNode = compilePlan(self.getChecks())
+
+    def getChecks(self):
+        return [roleNamed('page tab'), nameCheck(self.tabName)]
+
+    def getIndexHints(self):
+        return ('page tab', self.tabName.getLiteralStrings())
 
     def describeSearchResult(self):
         return '%s tab' % (self.tabName)
@@ -419,3 +633,89 @@ class IsATabNamed(Predicate):
 
     def makeScriptVariableName(self):
         return makeCamel(self.tabName) + "Tab"
+
+
+class And(Predicate):
+
+    """Predicate satisfied by the nodes satisfying all of the given predicates"""
+
+    def __init__(self, *predicates):
+        assert predicates
+        self.predicates = predicates
+        self.debugName = self.describeSearchResult()
+        self.satisfiedByNode = compilePlan(self.getChecks())
+
+    def getChecks(self):
+        # All the checks are pooled, so that the cheapest ones are made
+        # first whichever predicate they come from:
+        checks = []
+        for pred in self.predicates:
+            checks.extend(pred.getChecks())
+        return checks
+
+    def getIndexHints(self):
+        roleName, names = (None, None)
+        for pred in self.predicates:
+            predRoleName, predNames = pred.getIndexHints()
+            roleName = roleName or predRoleName
+            if predNames is not None:
+                if names is None:
+                    names = predNames
+                else:
+                    names = [name for name in names if name in predNames]
+        return (roleName, names)
+
+    def describeSearchResult(self):
+        return "(%s)" % " and ".join([pred.describeSearchResult()
+                                      for pred in self.predicates])
+
+
+class Or(Predicate):
+
+    """Predicate satisfied by the nodes satisfying any of the given predicates"""
+
+    def __init__(self, *predicates):
+        assert predicates
+        self.predicates = predicates
+        self.debugName = self.describeSearchResult()
+        self.satisfiedByNode = compilePlan(self.getChecks())
+
+    def getChecks(self):
+        # Try the cheapest alternatives first:
+        alternatives = []
+        for pred in self.predicates:
+            checks = pred.getChecks()
+            cost = max([c for (c, check) in checks])
+            alternatives.append((cost, compilePlan(checks)))
+        alternatives.sort(key=lambda alternative: alternative[0])
+        plans = [plan for (cost, plan) in alternatives]
+
+        def check(node):
+            for plan in plans:
+                if plan(node):
+                    return True
+            return False
+        return [(alternatives[-1][0], check)]
+
+    def describeSearchResult(self):
+        return "(%s)" % " or ".join([pred.describeSearchResult()
+                                     for pred in self.predicates])
+
+
+class Not(Predicate):
+
+    """Predicate satisfied by the nodes not satisfying the given predicate"""
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+        self.debugName = self.describeSearchResult()
+        self.satisfiedByNode = compilePlan(self.getChecks())
+
+    def getChecks(self):
+        checks = self.predicate.getChecks()
+        cost = max([c for (c, check) in checks])
+        plan = compilePlan(checks)
+        return [(cost, lambda node: not plan(node))]
+
+    def describeSearchResult(self):
+        return "not %s" % self.predicate.describeSearchResult()
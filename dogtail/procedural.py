@@ -19,6 +19,7 @@ import tree
 import predicate
 from config import config
 from utils import Lock
+from retry import Attempts
 import rawinput
 
 #FocusError = "FocusError: %s not found"
@@ -75,8 +76,7 @@ class FocusApplication (FocusBase):
         """
         try:
             pred = predicate.IsAnApplicationNamed(name)
-            app = self.desktop.findChild(
-                pred, recursive=False, retry=False)
+            app = self.desktop.findChild(pred, recursive=False)
         except tree.SearchError:
             if config.fatalErrors:
                 raise FocusError(name)
@@ -164,46 +164,41 @@ class FocusWidget (FocusBase):
     Keeps track of which widget is currently focused.
     """
 
-    def findByPredicate(self, pred):
-        result = None
-        try:
-            result = FocusWidget.node.findChild(
-                pred, requireResult=False, retry=False)
-        except AttributeError:
-            pass
-        if result:
-            FocusWidget.node = result
-        else:
-            try:
-                result = FocusDialog.node.findChild(
-                    pred, requireResult=False, retry=False)
-            except AttributeError:
-                pass
-        if result:
-            FocusWidget.node = result
-        else:
+    def __search(self, pred):
+        """
+        Makes one attempt at finding the widget below the focused widget,
+        dialog, window and application, in that order.
+        """
+        for focused in (FocusWidget, FocusDialog, FocusWindow):
             try:
-                result = FocusWindow.node.findChild(
+                result = focused.node.findChild(
                     pred, requireResult=False, retry=False)
             except AttributeError:
-                pass
-        if result:
-            FocusWidget.node = result
-        else:
-            try:
-                result = FocusApplication.node.findChild(
-                    pred, requireResult=False, retry=False)
+                continue
+            if result:
+                return result
+        return FocusApplication.node.findChild(
+            pred, requireResult=False, retry=False)
+
+    def findByPredicate(self, pred):
+        result = None
+        key = getattr(FocusApplication.node, 'name', None)
+        attempts = Attempts(key)
+        try:
+            for numAttempts in attempts:
+                result = self.__search(pred)
                 if result:
-                    FocusWidget.node = result
-            except AttributeError:
-                if config.fatalErrors:
-                    raise FocusError(pred)
-                else:
-                    focusFailed(pred)
-                    return False
+                    attempts.succeeded()
+                    break
+        except AttributeError:
+            if config.fatalErrors:
+                raise FocusError(pred)
+            else:
+                focusFailed(pred)
+                return False
 
+        FocusWidget.node = result
         if result is None:
-            FocusWidget.node = result
             if config.fatalErrors:
                 raise FocusError(pred.debugName)
             else:
@@ -415,9 +410,11 @@ class Select (Action):
         func()
 
 
-def type(text):
+def type(text, mode=None):
     if focus.widget.node:
-        focus.widget.node.typeText(text)
+        focus.widget.node.typeText(text, mode)
+    elif (mode or config.typingMode) == 'burst':
+        rawinput.typeTextBurst(text)
     else:
         rawinput.typeText(text)
 
@@ -431,8 +428,15 @@ def keyCombo(combo):
 
 def run(application, arguments='', appName=''):
     from utils import run as utilsRun
-    pid = utilsRun(application + ' ' + arguments, appName=appName)
-    focus.application(application)
+    pid, app = utilsRun(application + ' ' + arguments, appName=appName,
+                        returnApplication=True)
+    if app is None:
+        focus.application(application)
+    else:
+        FocusApplication.node = app
+        FocusDialog.node = None
+        FocusWindow.node = None
+        FocusWidget.node = None
     return pid
 
 import os
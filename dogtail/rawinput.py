@@ -19,10 +19,15 @@ gi.require_version('Gdk', '3.0')
 from gi.repository import Gdk
 from config import config
 from utils import doDelay
+from utils import aboutToAct
+from utils import forgetFetchedProperties
 from logging import debugLogger as logger
 from pyatspi import Registry as registry
 from pyatspi import (KEY_SYM, KEY_PRESS, KEY_PRESSRELEASE, KEY_RELEASE)
 from exceptions import ValueError
+from gi.repository import GLib
+from threading import Thread
+from time import sleep
 from __builtin__ import unicode, unichr
 
 
@@ -30,6 +35,24 @@ def doTypingDelay():
     doDelay(config.typingDelay)
 
 
+def generateMouseEvent(x, y, name):
+    """
+    Generates a mouse event, every one of which goes through here or through
+    InputSequence (see utils.aboutToAct()).
+    """
+    aboutToAct()
+    registry.generateMouseEvent(x, y, name)
+
+
+def generateKeyboardEvent(keyCode, keyString, kind):
+    """
+    Generates a keyboard event, every one of which goes through here or
+    through InputSequence (see utils.aboutToAct()).
+    """
+    aboutToAct()
+    registry.generateKeyboardEvent(keyCode, keyString, kind)
+
+
 def checkCoordinates(x, y):
     if x < 0 or y < 0:
         raise ValueError(
@@ -42,8 +65,8 @@ def click(x, y, button=1, check=True):
     """
     if check:
         checkCoordinates(x, y)
-    logger.log("Mouse button %s click at (%s,%s)" % (button, x, y))
-    registry.generateMouseEvent(x, y, 'b%sc' % button)
+    logger.info("Mouse button %s click at (%s,%s)", button, x, y)
+    generateMouseEvent(x, y, 'b%sc' % button)
     doDelay(config.actionDelay)
 
 
@@ -53,8 +76,8 @@ def doubleClick(x, y, button=1, check=True):
     """
     if check:
         checkCoordinates(x, y)
-    logger.log("Mouse button %s doubleclick at (%s,%s)" % (button, x, y))
-    registry.generateMouseEvent(x, y, 'b%sd' % button)
+    logger.info("Mouse button %s doubleclick at (%s,%s)", button, x, y)
+    generateMouseEvent(x, y, 'b%sd' % button)
     doDelay()
 
 
@@ -64,8 +87,8 @@ def press(x, y, button=1, check=True):
     """
     if check:
         checkCoordinates(x, y)
-    logger.log("Mouse button %s press at (%s,%s)" % (button, x, y))
-    registry.generateMouseEvent(x, y, 'b%sp' % button)
+    logger.info("Mouse button %s press at (%s,%s)", button, x, y)
+    generateMouseEvent(x, y, 'b%sp' % button)
     doDelay()
 
 
@@ -75,8 +98,8 @@ def release(x, y, button=1, check=True):
     """
     if check:
         checkCoordinates(x, y)
-    logger.log("Mouse button %s release at (%s,%s)" % (button, x, y))
-    registry.generateMouseEvent(x, y, 'b%sr' % button)
+    logger.info("Mouse button %s release at (%s,%s)", button, x, y)
+    generateMouseEvent(x, y, 'b%sr' % button)
     doDelay()
 
 
@@ -86,8 +109,8 @@ def absoluteMotion(x, y, mouseDelay=None, check=True):
     """
     if check:
         checkCoordinates(x, y)
-    logger.log("Mouse absolute motion to (%s,%s)" % (x, y))
-    registry.generateMouseEvent(x, y, 'abs')
+    logger.info("Mouse absolute motion to (%s,%s)", x, y)
+    generateMouseEvent(x, y, 'abs')
     if mouseDelay:
         doDelay(mouseDelay)
     else:
@@ -95,19 +118,30 @@ def absoluteMotion(x, y, mouseDelay=None, check=True):
 
 
 def relativeMotion(x, y, mouseDelay=None):
-    logger.log("Mouse relative motion of (%s,%s)" % (x, y))
-    registry.generateMouseEvent(x, y, 'rel')
+    logger.info("Mouse relative motion of (%s,%s)", x, y)
+    generateMouseEvent(x, y, 'rel')
     if mouseDelay:
         doDelay(mouseDelay)
     else:
         doDelay()
 
 
-def drag(fromXY, toXY, button=1, check=True):
+def drag(fromXY, toXY, button=1, check=True, duration=None):
     """
     Synthesize a mouse press, drag, and release on the screen.
+
+    If duration is given, the pointer moves smoothly from one point to the
+    other in that many seconds (see InputSequence), instead of jumping
+    there with delays before and after.
     """
-    logger.log("Mouse button %s drag from %s to %s" % (button, fromXY, toXY))
+    if duration is not None:
+        sequence = InputSequence(check)
+        sequence.press(fromXY[0], fromXY[1], button)
+        sequence.motion(toXY[0], toXY[1], duration)
+        sequence.release(toXY[0], toXY[1], button)
+        sequence.run()
+        return
+    logger.info("Mouse button %s drag from %s to %s", button, fromXY, toXY)
 
     (x, y) = fromXY
     press(x, y, button, check)
@@ -121,6 +155,169 @@ def drag(fromXY, toXY, button=1, check=True):
     doDelay()
 
 
+class InputSequence(object):
+
+    """
+    A script of timed mouse and keyboard events, e.g.
+
+        sequence = InputSequence()
+        sequence.press(100, 100).motion(300, 200, duration=0.5)
+        sequence.release(300, 200).wait(0.2).keyCombo('<Control>z')
+        sequence.run()
+
+    Each method adds events after the ones added so far (wait() leaves a
+    gap), and returns the sequence. run() injects the events from a
+    separate thread, each at its time from the start as measured by the
+    monotonic clock, and logs one line for the whole sequence rather than
+    one per event.
+    """
+
+    # Events per second in interpolated motions:
+    motionRate = 60
+
+    def __init__(self, check=True):
+        self.check = check
+        self.events = []
+        self.time = 0.0
+        self.position = None
+        self.thread = None
+        self.error = None
+        self.lateness = 0.0
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, function, *args):
+        """
+        Adds a call of function(*args) at the current time of the sequence.
+        """
+        self.events.append((self.time, function, args))
+        return self
+
+    def wait(self, seconds):
+        self.time += seconds
+        return self
+
+    def __mouse(self, x, y, name):
+        if self.check:
+            checkCoordinates(x, y)
+        self.position = (x, y)
+        return self.add(registry.generateMouseEvent, x, y, name)
+
+    def press(self, x, y, button=1):
+        return self.__mouse(x, y, 'b%sp' % button)
+
+    def release(self, x, y, button=1):
+        return self.__mouse(x, y, 'b%sr' % button)
+
+    def click(self, x, y, button=1):
+        return self.__mouse(x, y, 'b%sc' % button)
+
+    def doubleClick(self, x, y, button=1):
+        return self.__mouse(x, y, 'b%sd' % button)
+
+    def motion(self, x, y, duration=0, steps=None):
+        """
+        Moves the pointer to (x, y) over duration seconds, through steps
+        intermediate points (by default motionRate per second) on the line
+        from the last position of the sequence.
+        """
+        if self.position is None or duration <= 0:
+            return self.__mouse(x, y, 'abs')
+        if steps is None:
+            steps = int(duration * self.motionRate)
+        steps = max(steps, 1)
+        (fromX, fromY) = self.position
+        for step in range(1, steps + 1):
+            self.wait(float(duration) / steps)
+            self.__mouse(int(round(fromX + (x - fromX) * step / float(steps))),
+                         int(round(fromY + (y - fromY) * step / float(steps))),
+                         'abs')
+        return self
+
+    def key(self, keyName):
+        """
+        Presses and releases a key, as pressKey() does.
+        """
+        return self.add(registry.generateKeyboardEvent,
+                        keyNameToKeySym(keyName), None, KEY_SYM)
+
+    def keyCombo(self, comboString):
+        """
+        Presses a key combo, as keyCombo() does.
+        """
+        modifierCodes, finalCode = keyTables.combo(comboString)
+        for code in modifierCodes:
+            self.add(registry.generateKeyboardEvent, code, None, KEY_PRESS)
+        self.add(registry.generateKeyboardEvent, finalCode, None, KEY_PRESSRELEASE)
+        for code in modifierCodes:
+            self.add(registry.generateKeyboardEvent, code, None, KEY_RELEASE)
+        return self
+
+    def type(self, string, interval=0):
+        """
+        Types a string, a key every interval seconds.
+        """
+        if not isinstance(string, unicode):
+            string = string.decode('utf-8')
+        for index, char in enumerate(string):
+            if index and interval:
+                self.wait(interval)
+            self.key(char)
+        return self
+
+    def __inject(self):
+        try:
+            start = GLib.get_monotonic_time()
+            for (offset, function, args) in self.events:
+                delay = start + int(offset * 1000000) - GLib.get_monotonic_time()
+                if delay > 0:
+                    sleep(delay / 1000000.0)
+                else:
+                    self.lateness = max(self.lateness, -delay / 1000000.0)
+                function(*args)
+        except Exception as e:
+            self.error = e
+
+    def start(self):
+        """
+        Starts injecting the events in a separate thread.
+        """
+        aboutToAct()
+        self.error = None
+        self.lateness = 0.0
+        self.thread = Thread(target=self.__inject)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def join(self):
+        """
+        Waits for all the events to be injected, raising the error that
+        stopped the injection, if any.
+        """
+        self.thread.join()
+        self.thread = None
+        # Whatever was fetched while the events were going in may be stale.
+        forgetFetchedProperties()
+        if self.error is not None:
+            raise self.error
+
+    def run(self, delay=True):
+        """
+        Injects the events, returning once they all are, and followed
+        (unless delay is False) by the usual delay after input.
+        """
+        start = GLib.get_monotonic_time()
+        self.start()
+        self.join()
+        elapsed = (GLib.get_monotonic_time() - start) / 1000000.0
+        logger.info("Injected %d input events in %.3fs (scripted: %.3fs, "
+                    "at most %.1fms late)", len(self.events), elapsed,
+                    self.time, self.lateness * 1000)
+        if delay:
+            doDelay()
+
+
 def typeText(string):
     """
     Types the specified string, one character at a time.
@@ -130,6 +327,23 @@ def typeText(string):
     for char in string:
         pressKey(char)
 
+
+def typeTextBurst(string, chunkSize=None, afterChunk=None):
+    """
+    Types the specified string without any delay between the keys, chunkSize
+    characters (config.typingChunkSize by default) at a time. If given,
+    afterChunk(typed) is called after each chunk with the number of
+    characters typed so far, e.g. to let the application catch up.
+    """
+    if not isinstance(string, unicode):
+        string = string.decode('utf-8')
+    chunkSize = max(chunkSize or config.typingChunkSize or len(string), 1)
+    for start in range(0, len(string), chunkSize):
+        for char in string[start:start + chunkSize]:
+            generateKeyboardEvent(keyNameToKeySym(char), None, KEY_SYM)
+        if afterChunk is not None:
+            afterChunk(min(start + chunkSize, len(string)))
+
 keyNameAliases = {
     'enter': 'Return',
     'esc': 'Escape',
@@ -147,6 +361,124 @@ keyNameAliases = {
 }
 
 
+class KeyTables(object):
+
+    """
+    Tables of the keysyms of key names and characters, and of the keycodes
+    of key names and key combos in the keymap of the default display, so
+    that typing only takes dictionary lookups.
+
+    The keysyms don't depend on the keymap, and are kept for good. The
+    keycodes are dropped when the keymap signals keys-changed, or when a
+    keycode that isn't known yet is looked up and the default display
+    turns out to have changed.
+    """
+
+    def __init__(self):
+        self.keySyms = {}
+        self.uniCharKeySyms = {}
+        self.keyCodes = {}
+        self.combos = {}
+        self.display = None
+        self.keymap = None
+
+    def precompute(self):
+        """
+        Fills the keysym tables in for the printable ASCII characters and
+        the key name aliases.
+        """
+        for i in range(0x20, 0x7f):
+            try:
+                self.keySym(unichr(i))
+            except KeyError:
+                pass
+        for name in keyNameAliases:
+            self.keySym(name)
+
+    def keySym(self, keyName):
+        try:
+            return self.keySyms[keyName]
+        except KeyError:
+            keySym = self.keySyms[keyName] = computeKeySym(keyName)
+            return keySym
+
+    def uniCharKeySym(self, uniChar):
+        try:
+            return self.uniCharKeySyms[uniChar]
+        except KeyError:
+            keySym = Gdk.unicode_to_keyval(ord(uniChar))
+            self.uniCharKeySyms[uniChar] = keySym
+            return keySym
+
+    def getKeymap(self):
+        """
+        The keymap of the default display, dropping the keycodes if that
+        display changed.
+        """
+        display = Gdk.Display.get_default()
+        if display is not self.display or self.keymap is None:
+            self.display = display
+            self.keymap = Gdk.Keymap.get_for_display(display)
+            self.keymap.connect('keys-changed', self.__keysChanged)
+            self.invalidate()
+        return self.keymap
+
+    def __keysChanged(self, keymap):
+        if keymap is self.keymap:
+            self.invalidate()
+
+    def invalidate(self):
+        """
+        Drops the keycodes, e.g. as the keymap changed.
+        """
+        self.keyCodes.clear()
+        self.combos.clear()
+
+    def keyCode(self, keyName):
+        try:
+            return self.keyCodes[keyName]
+        except KeyError:
+            pass
+        entries = self.getKeymap().get_entries_for_keyval(
+            Gdk.keyval_from_name(keyName))
+        try:
+            keyCode = entries[1][0].keycode
+        except (TypeError, IndexError):
+            return None
+        self.keyCodes[keyName] = keyCode
+        return keyCode
+
+    def combo(self, comboString):
+        """
+        The keycodes of the modifiers and of the final key of a key combo.
+        """
+        try:
+            return self.combos[comboString]
+        except KeyError:
+            pass
+        strings = []
+        for s in comboString.split('<'):
+            if s:
+                for S in s.split('>'):
+                    if S:
+                        S = keyNameAliases.get(S.lower(), S)
+                        strings.append(S)
+        for s in strings:
+            if not hasattr(Gdk, s):
+                if not hasattr(Gdk, 'KEY_' + s):
+                    raise ValueError("Cannot find key %s" % s)
+        # Get the keymap first, as that may drop the combos.
+        self.getKeymap()
+        combo = ([self.keyCode(modifier) for modifier in strings[:-1]],
+                 self.keyCode(strings[-1]))
+        if None not in combo[0] and combo[1] is not None:
+            self.combos[comboString] = combo
+        return combo
+
+keyTables = KeyTables()
+keyTables.precompute()
+
+
 # TODO: Dead code
 def keySymToUniChar(keySym):  # pragma: no cover
     i = Gdk.keyval_to_unicode(keySym)
@@ -161,9 +493,7 @@ def uniCharToKeySym(uniChar):
     # OK, if it's not actually unicode we can fix that, right?
     if not isinstance(uniChar, unicode):
         uniChar = unicode(uniChar)
-    i = ord(uniChar)
-    keySym = Gdk.unicode_to_keyval(i)
-    return keySym
+    return keyTables.uniCharKeySym(uniChar)
 
 
 # dead code
@@ -172,6 +502,13 @@ def keySymToKeyName(keySym):  # pragma: no cover
 
 
 def keyNameToKeySym(keyName):
+    return keyTables.keySym(keyName)
+
+
+def computeKeySym(keyName):
+    """
+    Looks the keysym of a key name up in Gdk; see keyNameToKeySym().
+    """
     try:
         keyName = keyNameAliases.get(keyName.lower(), keyName)
         keySym = Gdk.keyval_from_name(keyName)
@@ -195,13 +532,7 @@ def keyNameToKeyCode(keyName):
     Generally you should use uniCharToKeySym() and should only need this
     function for nonprintable keys anyway.
     """
-    keymap = Gdk.Keymap.get_for_display(Gdk.Display.get_default())
-    entries = keymap.get_entries_for_keyval(
-        Gdk.keyval_from_name(keyName))
-    try:
-        return entries[1][0].keycode
-    except TypeError:
-        pass
+    return keyTables.keyCode(keyName)
 
 
 def pressKey(keyName):
@@ -212,7 +543,7 @@ def pressKey(keyName):
     looked up by uniCharToKeySym().
     """
     keySym = keyNameToKeySym(keyName)
-    registry.generateKeyboardEvent(keySym, None, KEY_SYM)
+    generateKeyboardEvent(keySym, None, KEY_SYM)
     doTypingDelay()
 
 
@@ -224,26 +555,10 @@ def keyCombo(comboString):
     comboString is the representation of the key combo to be generated.
     e.g. '<Control><Alt>p' or '<Control><Shift>PageUp' or '<Control>q'
     """
-    strings = []
-    for s in comboString.split('<'):
-        if s:
-            for S in s.split('>'):
-                if S:
-                    S = keyNameAliases.get(S.lower(), S)
-                    strings.append(S)
-    for s in strings:
-        if not hasattr(Gdk, s):
-            if not hasattr(Gdk, 'KEY_' + s):
-                raise ValueError("Cannot find key %s" % s)
-    modifiers = strings[:-1]
-    finalKey = strings[-1]
-    for modifier in modifiers:
-
-        code = keyNameToKeyCode(modifier)
-        registry.generateKeyboardEvent(code, None, KEY_PRESS)
-    code = keyNameToKeyCode(finalKey)
-    registry.generateKeyboardEvent(code, None, KEY_PRESSRELEASE)
-    for modifier in modifiers:
-        code = keyNameToKeyCode(modifier)
-        registry.generateKeyboardEvent(code, None, KEY_RELEASE)
+    modifierCodes, finalCode = keyTables.combo(comboString)
+    for code in modifierCodes:
+        generateKeyboardEvent(code, None, KEY_PRESS)
+    generateKeyboardEvent(finalCode, None, KEY_PRESSRELEASE)
+    for code in modifierCodes:
+        generateKeyboardEvent(code, None, KEY_RELEASE)
     doDelay()
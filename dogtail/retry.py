@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Retry policies
+
+When a search fails, dogtail waits a little and tries again, since the UI may
+simply not have caught up yet. A retry policy decides how long to wait before
+each new attempt, and when to give up:
+
+FixedRetryPolicy waits config.searchBackoffDuration seconds between attempts,
+config.searchCutoffCount times. This is the traditional behaviour.
+
+ExponentialRetryPolicy starts with very short waits, so that fast UIs are
+found quickly, and doubles them (with some random jitter) up to a maximum,
+until a wall-clock deadline (config.searchTimeout by default) has passed.
+
+AdaptiveRetryPolicy learns how long searches in each application usually
+take to succeed, and polls densely around that time, sparsely before it, and
+with exponential backoff after it.
+
+The policy in use is set by config.searchRetryPolicy, which is either the name
+of one of the above ('fixed', 'exponential' or 'adaptive') or a RetryPolicy
+instance.
+"""
+
+import random
+from time import sleep, time
+from config import config
+from logging import debugLogger as logger
+
+
+class RetryPolicy(object):
+
+    """
+    Base class of retry policies.
+    """
+
+    # Whether delays() and record() make use of their key; if not,
+    # Attempts doesn't bother working it out.
+    usesKey = True
+
+    def delays(self, key=None, interval=None, timeout=None):
+        """
+        Generates the successive delays, in seconds, to wait before each
+        retry. The retries stop when the generator is exhausted.
+
+        key identifies what is being waited for (usually the name of the
+        application), for policies that learn from past searches.
+        interval is the typical delay between retries, and timeout the
+        total time after which to give up; each policy has its own
+        defaults for them.
+        """
+        raise NotImplementedError
+
+    def record(self, key, elapsed):
+        """
+        Tells the policy that a search for key succeeded after elapsed
+        seconds.
+        """
+        pass
+
+
+class FixedRetryPolicy(RetryPolicy):
+
+    """
+    Waits interval (by default config.searchBackoffDuration) seconds between
+    attempts, config.searchCutoffCount times, or until timeout seconds have
+    passed if a timeout is given.
+    """
+
+    usesKey = False
+
+    def delays(self, key=None, interval=None, timeout=None):
+        if interval is None:
+            interval = config.searchBackoffDuration
+        if timeout is None:
+            for attempt in range(config.searchCutoffCount):
+                yield interval
+            return
+        deadline = time() + timeout
+        while time() < deadline:
+            yield interval
+
+
+class ExponentialRetryPolicy(RetryPolicy):
+
+    """
+    Starts by waiting initial seconds, and multiplies the delay by factor
+    after each attempt, up to interval seconds (by default
+    config.searchBackoffDuration), until timeout (by default
+    config.searchTimeout) seconds have passed.
+
+    Each delay is randomly spread by up to jitter times its value, so that
+    several scripts polling the same application don't do it in lockstep.
+    """
+
+    usesKey = False
+
+    def __init__(self, initial=0.05, factor=2.0, jitter=0.25):
+        self.initial = initial
+        self.factor = factor
+        self.jitter = jitter
+
+    def spread(self, delay):
+        """
+        Applies the jitter to a delay.
+        """
+        if not self.jitter:
+            return delay
+        return delay * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+
+    def backoff(self, start, interval, deadline):
+        """
+        Generates exponentially growing delays from start, capped at
+        interval, until the deadline.
+        """
+        delay = start
+        while True:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return
+            yield min(self.spread(delay), remaining)
+            delay = min(delay * self.factor, interval)
+
+    def delays(self, key=None, interval=None, timeout=None):
+        if interval is None:
+            interval = config.searchBackoffDuration
+        if timeout is None:
+            timeout = config.searchTimeout
+        return self.backoff(min(self.initial, interval), interval,
+                            time() + timeout)
+
+
+class AdaptiveRetryPolicy(ExponentialRetryPolicy):
+
+    """
+    Remembers, for each key, how long the last few successful searches took
+    (up to history of them), and expects the next one to succeed within the
+    same window: it waits at most interval seconds at a time before the
+    window, polls every initial seconds within it, and backs off
+    exponentially after it. Keys without any history are handled like
+    ExponentialRetryPolicy does.
+    """
+
+    usesKey = True
+
+    def __init__(self, initial=0.05, factor=2.0, jitter=0.25, history=20):
+        ExponentialRetryPolicy.__init__(self, initial, factor, jitter)
+        self.history = history
+        self.latencies = {}
+
+    def record(self, key, elapsed):
+        latencies = self.latencies.setdefault(key, [])
+        latencies.append(elapsed)
+        del latencies[:-self.history]
+
+    def window(self, key):
+        """
+        The (earliest, latest) times after which searches for key are
+        expected to succeed, or None if we don't know yet. Outliers (the
+        slowest and fastest tenth) are left out.
+        """
+        latencies = sorted(self.latencies.get(key, ()))
+        if not latencies:
+            return None
+        outliers = len(latencies) // 10
+        return (latencies[outliers], latencies[-1 - outliers])
+
+    def delays(self, key=None, interval=None, timeout=None):
+        if interval is None:
+            interval = config.searchBackoffDuration
+        if timeout is None:
+            timeout = config.searchTimeout
+        fine = min(self.initial, interval)
+        window = self.window(key)
+        start = time()
+        deadline = start + timeout
+        if window is None:
+            for delay in self.backoff(fine, interval, deadline):
+                yield delay
+            return
+        earliest, latest = window
+        # Allow for the slowest search we've seen taking a bit longer.
+        latest = latest * 1.5 + fine
+        while True:
+            now = time()
+            if now >= deadline:
+                return
+            elapsed = now - start
+            if elapsed + fine < earliest:
+                delay = min(earliest - fine - elapsed, interval)
+            elif elapsed < latest:
+                delay = fine
+            else:
+                break
+            yield min(delay, deadline - now)
+        for delay in self.backoff(fine * self.factor, interval, deadline):
+            yield delay
+
+
+policies = {
+    'fixed': FixedRetryPolicy(),
+    'exponential': ExponentialRetryPolicy(),
+    'adaptive': AdaptiveRetryPolicy(),
+}
+
+
+def getPolicy():
+    """
+    The retry policy configured by config.searchRetryPolicy.
+    """
+    policy = config.searchRetryPolicy
+    if isinstance(policy, RetryPolicy):
+        return policy
+    return policies.get(policy or 'fixed', policies['fixed'])
+
+
+class Attempts(object):
+
+    """
+    Iterating over an Attempts object generates the numbers of the successive
+    attempts at something (starting at 0), waiting between them as the retry
+    policy says. The caller stops iterating when it succeeds, and should then
+    call succeeded() so that the policy can learn from it.
+
+    If retry is False, there is only one attempt. The waiting is done by
+    sleeping, or, if a waiter is given, by calling its wait(delay) method,
+    which may return early (see utils.EventWaiter).
+
+    key may be a function returning the key, in which case it is only
+    called if the policy uses keys and a retry is needed. Searches that
+    succeed at the first attempt aren't recorded.
+    """
+
+    def __init__(self, key=None, retry=True, interval=None, timeout=None,
+                 waiter=None, policy=None):
+        if policy is None:
+            policy = getPolicy()
+        self.key = key
+        self.retry = retry
+        self.interval = interval
+        self.timeout = timeout
+        self.waiter = waiter
+        self.policy = policy
+        self.start = None
+        self.retried = False
+
+    def getKey(self):
+        """
+        The key, worked out the first time it's needed.
+        """
+        if not self.policy.usesKey:
+            return None
+        if callable(self.key):
+            self.key = self.key()
+        return self.key
+
+    def __iter__(self):
+        self.start = time()
+        yield 0
+        if not self.retry:
+            return
+        self.retried = True
+        delays = self.policy.delays(self.getKey(), self.interval, self.timeout)
+        for numAttempts, delay in enumerate(delays):
+            self.wait(delay)
+            yield numAttempts + 1
+
+    def wait(self, delay):
+        if self.waiter is not None:
+            if config.debugSearching or config.debugSleep:
+                logger.log("waiting up to %f for changes" % delay)
+            self.waiter.wait(delay)
+        else:
+            if config.debugSearching or config.debugSleep:
+                logger.log("sleeping for %f" % delay)
+            sleep(delay)
+
+    def close(self):
+        """
+        Stops the waiter, if any. To be called when done with the attempts.
+        """
+        if self.waiter is not None:
+            self.waiter.stop()
+
+    @property
+    def elapsed(self):
+        if self.start is None:
+            return 0.0
+        return time() - self.start
+
+    def succeeded(self):
+        """
+        Records that the last attempt succeeded.
+        """
+        if self.retried:
+            self.policy.record(self.getKey(), self.elapsed)
@@ -0,0 +1,584 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshots of accessible trees
+
+Every property of a live Node (name, roleName, its children...) is a separate
+synchronous D-Bus round trip, so walking a big application costs tens of
+thousands of calls. A Snapshot instead pulls a whole application in a single
+call to the AT-SPI Cache interface (org.a11y.atspi.Cache.GetItems), and keeps
+the result as a tree of lightweight SnapshotNode records that can be searched
+locally using the usual predicates.
+
+Applications which don't implement the Cache interface are snapshotted by
+walking the live tree once.
+
+Snapshots are not updated when the application changes. Use
+Node.snapshot() again to get a fresh one.
+"""
+
+import pyatspi
+import predicate
+
+from i18n import safeDecode
+from gi.repository import Gio
+from gi.repository import GLib
+from config import config
+from logging import debugLogger as logger
+
+cachePath = '/org/a11y/atspi/cache'
+cacheInterface = 'org.a11y.atspi.Cache'
+
+# Role names by role number, filled in as they are needed so that we never
+# need a round trip to get a role name.
+roleNames = {}
+
+
+def roleName(role):
+    """
+    The role name (e.g. 'push button') for the given role number.
+    """
+    role = int(role)
+    try:
+        return roleNames[role]
+    except KeyError:
+        name = pyatspi.Atspi.role_get_name(pyatspi.Atspi.Role(role))
+        roleNames[role] = name
+        return name
+
+
+def statesFromBitfield(bitfield):
+    """
+    Converts the AT-SPI state bitfield (a list of 32 bit integers) to a set
+    of state numbers.
+    """
+    states = set()
+    for word, bits in enumerate(bitfield):
+        for bit in range(32):
+            if bits & (1 << bit):
+                states.add(word * 32 + bit)
+    return states
+
+
+def objectReference(accessible):
+    """
+    The (bus name, object path) pair identifying a live accessible on the
+    accessibility bus, or None if the bindings don't tell us.
+    """
+    try:
+        return (accessible.app.bus_name, accessible.path)
+    except AttributeError:
+        return None
+
+
+def indexName(name):
+    """
+    The key of a name in the name index. Names are matched with or without
+    a trailing newline (see i18n.TranslatableString), so it is dropped.
+    """
+    name = safeDecode(name)
+    if name.endswith(u'\n'):
+        return name[:-1]
+    return name
+
+
+def connectToA11yBus():
+    """
+    Opens a new connection to the accessibility bus.
+    """
+    session = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+    reply = session.call_sync('org.a11y.Bus', '/org/a11y/bus', 'org.a11y.Bus',
+                              'GetAddress', None, GLib.VariantType.new('(s)'),
+                              Gio.DBusCallFlags.NONE, -1, None)
+    address = reply.unpack()[0]
+    flags = Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT | \
+        Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION
+    return Gio.DBusConnection.new_for_address_sync(address, flags, None, None)
+
+sharedA11yBus = None
+
+
+def a11yBus():
+    """
+    The shared connection to the accessibility bus.
+    """
+    global sharedA11yBus
+    if sharedA11yBus is None or sharedA11yBus.is_closed():
+        sharedA11yBus = connectToA11yBus()
+    return sharedA11yBus
+
+
+def getCacheItems(busName, connection=None, timeout=-1):
+    """
+    Calls GetItems on the Cache interface of the application owning the
+    given bus name, returning the list of raw items.
+
+    timeout is in milliseconds, -1 meaning the D-Bus default.
+    """
+    if connection is None:
+        connection = a11yBus()
+    reply = connection.call_sync(busName, cachePath, cacheInterface,
+                                 'GetItems', None, None,
+                                 Gio.DBusCallFlags.NONE, timeout, None)
+    return reply.unpack()[0]
+
+
+class StateSet(object):
+
+    """
+    Minimal stand-in for pyatspi's StateSet, for snapshot records.
+    """
+
+    def __init__(self, states):
+        self.states = states
+
+    def contains(self, state):
+        return int(state) in self.states
+
+    def getStates(self):
+        return sorted(self.states)
+
+
+class SnapshotNode(object):
+
+    """
+    A record describing one accessible at the time the snapshot was taken.
+
+    It has the attributes of a Node that predicates look at (name, roleName,
+    description...), so searches can be done on it without any D-Bus
+    traffic. The corresponding live Node can be obtained through the 'node'
+    attribute.
+    """
+
+    def __init__(self, snapshot, name='', role=0, description='',
+                 states=(), interfaces=(), childCount=0, reference=None,
+                 accessible=None):
+        self.snapshot = snapshot
+        self.name = name
+        self.role = role
+        self.description = description
+        self.states = set(states)
+        self.interfaces = list(interfaces)
+        self.childCount = childCount
+        self.reference = reference
+        self.accessible = accessible
+        self.parent = None
+        self.indexInParent = -1
+        self._children = []
+        self._complete = True
+
+    def complete():
+        doc = """False if the cache didn't tell us about all of our children;
+        they are then fetched from the live node when first needed."""
+
+        def fget(self):
+            return self._complete
+
+        def fset(self, complete):
+            self._complete = complete
+            if complete:
+                self.snapshot.incomplete.discard(self)
+            else:
+                self.snapshot.incomplete.add(self)
+
+        return property(**locals())
+    complete = complete()
+
+    @property
+    def roleName(self):
+        return roleName(self.role)
+
+    @property
+    def children(self):
+        if not self.complete:
+            self.snapshot.loadChildren(self)
+        return self._children
+
+    def __len__(self):
+        return len(self.children)
+
+    def __getitem__(self, index):
+        return self.children[index]
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __str__(self):
+        return "[snapshot | %s | %s]" % (self.roleName, self.name)
+
+    def getLogString(self):
+        return str(self)
+
+    def getIndexPath(self):
+        """
+        The list of child indexes leading from the root of the snapshot to
+        this record.
+        """
+        path = []
+        record = self
+        while record.parent is not None:
+            path.append(record.indexInParent)
+            record = record.parent
+        path.reverse()
+        return path
+
+    @property
+    def node(self):
+        """
+        The live Node this record was taken from. It is looked up by
+        following the child indexes from the root of the snapshot, so it
+        may not be the same accessible if the application has changed since.
+        """
+        if self.accessible is None:
+            if self.parent is None:
+                raise LookupError("%s has no live counterpart" % self)
+            parent = self.parent.node
+            self.accessible = parent[self.indexInParent]
+        return self.accessible
+
+    def getState(self):
+        return StateSet(self.states)
+
+    @property
+    def sensitive(self):
+        return int(pyatspi.STATE_SENSITIVE) in self.states
+
+    @property
+    def showing(self):
+        return int(pyatspi.STATE_SHOWING) in self.states
+
+    @property
+    def focusable(self):
+        return int(pyatspi.STATE_FOCUSABLE) in self.states
+
+    @property
+    def focused(self):
+        return int(pyatspi.STATE_FOCUSED) in self.states
+
+    @property
+    def checked(self):
+        return int(pyatspi.STATE_CHECKED) in self.states
+
+    @property
+    def labeller(self):
+        # Relations aren't cached, so ask the live node.
+        return self.node.labeller
+    labeler = labeller
+
+    def satisfies(self, pred):
+        """
+        Does this record satisfy the given predicate?
+        """
+        return pred.satisfiedByNode(self)
+
+    def iterDescendants(self):
+        """
+        Generates all the descendants of this record, depth first, in the
+        same order as a search on the live tree would visit them.
+        """
+        stack = [iter(self.children)]
+        while stack:
+            try:
+                record = stack[-1].next()
+            except StopIteration:
+                stack.pop()
+                continue
+            yield record
+            stack.append(iter(record.children))
+
+    def findChild(self, pred, recursive=True):
+        """
+        Returns the first record below this one satisfying the predicate, or
+        None.
+        """
+        matches = self.snapshot.search(self, pred, recursive, first=True)
+        if matches:
+            return matches[0]
+
+    def findChildren(self, pred, recursive=True):
+        """
+        Returns all the records below this one satisfying the predicate.
+        """
+        return self.snapshot.search(self, pred, recursive)
+
+
+class Snapshot(object):
+
+    """
+    A snapshot of the accessible tree below a live node. The records are
+    reachable from the 'root' attribute.
+
+    The records are indexed by role name and by name, so that searches for
+    predicates which tell what role or literal name they want (see
+    Predicate.getIndexHints()) only need to look at the records with that
+    role or name, instead of walking the tree.
+
+    items, if given, are the Cache items of node's application, already
+    fetched (see getCacheItems()).
+    """
+
+    def __init__(self, node, useCache=True, items=None):
+        self.node = node
+        self.root = None
+        self.byReference = {}
+        self.byRoleName = {}
+        self.byName = {}
+        self.incomplete = set()
+        self.fromCache = False
+        if useCache:
+            try:
+                self.fromCache = self.loadFromCache(items)
+            except GLib.GError as e:
+                if config.debugSearching:
+                    logger.log("Cache.GetItems failed for %s: %s" % (node, e))
+        if not self.fromCache:
+            self.loadFromTree()
+
+    def recordFromNode(self, node):
+        """
+        Makes a record by querying a live node.
+        """
+        try:
+            interfaces = node.get_interfaces()
+        except AttributeError:
+            interfaces = ()
+        return SnapshotNode(self, name=node.name, role=node.role,
+                            description=node.description,
+                            states=[int(s) for s in node.getState().getStates()],
+                            interfaces=interfaces,
+                            childCount=node.childCount,
+                            reference=objectReference(node),
+                            accessible=node)
+
+    def addRecord(self, record):
+        if record.reference is not None:
+            self.byReference[record.reference] = record
+        self.byRoleName.setdefault(record.roleName, set()).add(record)
+        self.byName.setdefault(indexName(record.name), set()).add(record)
+        return record
+
+    def forget(self, record):
+        """
+        Removes a record and the records below it from the snapshot.
+        """
+        if record.reference is not None and \
+                self.byReference.get(record.reference) is record:
+            del self.byReference[record.reference]
+        self.byRoleName.get(record.roleName, set()).discard(record)
+        self.byName.get(indexName(record.name), set()).discard(record)
+        self.incomplete.discard(record)
+        for child in record._children:
+            self.forget(child)
+
+    def rename(self, record, name):
+        """
+        Changes the name of a record, keeping the name index up to date.
+        """
+        self.byName.get(indexName(record.name), set()).discard(record)
+        record.name = name
+        self.byName.setdefault(indexName(name), set()).add(record)
+
+    def isIndexable(self, top):
+        """
+        Do the indexes cover everything below the given record? They don't if
+        some of the records there haven't had their children loaded yet.
+        """
+        for record in self.incomplete:
+            while record is not None:
+                if record is top:
+                    return False
+                record = record.parent
+        return True
+
+    def search(self, top, pred, recursive=True, first=False):
+        """
+        Returns the list of records below top satisfying the predicate, in
+        tree order. If first is True, only the first match is returned.
+
+        The indexes are used when the predicate gives hints and they cover
+        the records below top; otherwise the records are walked.
+        """
+        hints = (None, None)
+        if isinstance(pred, predicate.Predicate):
+            hints = pred.getIndexHints()
+            pred = pred.satisfiedByNode
+        roleNameHint, namesHint = hints
+        if (roleNameHint is None and namesHint is None) or \
+                not self.isIndexable(top):
+            if recursive:
+                candidates = top.iterDescendants()
+            else:
+                candidates = top.children
+            matches = []
+            for record in candidates:
+                if pred(record):
+                    matches.append(record)
+                    if first:
+                        break
+            return matches
+
+        candidates = None
+        if roleNameHint is not None:
+            candidates = set(self.byRoleName.get(roleNameHint, ()))
+        if namesHint is not None:
+            named = set()
+            for name in namesHint:
+                # A name ending with a newline also matches names with a
+                # second one, which are indexed under the first.
+                named.update(self.byName.get(indexName(name), ()))
+                named.update(self.byName.get(safeDecode(name), ()))
+            if candidates is None:
+                candidates = named
+            else:
+                candidates &= named
+
+        def isBelowTop(record):
+            if not recursive:
+                return record.parent is top
+            record = record.parent
+            while record is not None:
+                if record is top:
+                    return True
+                record = record.parent
+            return False
+
+        candidates = [r for r in candidates if isBelowTop(r)]
+        # Child index paths sort in the order a depth-first walk visits them:
+        candidates.sort(key=lambda record: record.getIndexPath())
+        matches = []
+        for record in candidates:
+            if pred(record):
+                matches.append(record)
+                if first:
+                    break
+        return matches
+
+    def loadChildren(self, record):
+        """
+        Fills in the children of a record from its live node.
+        """
+        record.complete = True
+        node = record.node
+        childCount = min(node.childCount, config.childrenLimit)
+        for index in range(childCount):
+            try:
+                child = node[index]
+            except LookupError:
+                child = None
+            if child is None:
+                continue
+            childRecord = self.addRecord(self.recordFromNode(child))
+            childRecord.parent = record
+            childRecord.indexInParent = index
+            childRecord.complete = False
+            record._children.append(childRecord)
+
+    def loadFromTree(self):
+        """
+        Builds the records by walking the live tree below self.node. Only
+        the root is queried here; the rest is done as the records are
+        visited.
+        """
+        self.root = self.addRecord(self.recordFromNode(self.node))
+        self.root.complete = False
+
+    def loadFromCache(self, items=None):
+        """
+        Builds the records from the Cache interface of self.node's
+        application (or from its items, if already fetched). Returns False
+        if that's not possible.
+        """
+        node = self.node
+        if node.roleName == 'application':
+            application = node
+        else:
+            application = node.getApplication()
+        appReference = objectReference(application)
+        if appReference is None:
+            return False
+        if items is None:
+            items = getCacheItems(appReference[0])
+        if not items:
+            return False
+
+        parents = {}
+        explicitChildren = {}
+        for item in items:
+            reference, parentReference = tuple(item[0]), tuple(item[2])
+            rest = item[3:]
+            if isinstance(rest[0], list):
+                # Older AT-SPI: references to the children are listed.
+                explicitChildren[reference] = [tuple(c) for c in rest[0]]
+                indexInParent = -1
+                childCount = len(rest[0])
+                rest = rest[1:]
+            else:
+                indexInParent, childCount = rest[0], rest[1]
+                rest = rest[2:]
+            interfaces, name, role, description, stateBits = rest[:5]
+            record = self.addRecord(SnapshotNode(
+                self, name=name, role=role, description=description,
+                states=statesFromBitfield(stateBits), interfaces=interfaces,
+                childCount=childCount, reference=reference))
+            record.indexInParent = indexInParent
+            parents[reference] = parentReference
+
+        if explicitChildren:
+            for reference, children in explicitChildren.items():
+                for index, child in enumerate(children):
+                    if child in self.byReference:
+                        self.byReference[child].indexInParent = index
+        for reference, parentReference in parents.items():
+            record = self.byReference[reference]
+            parent = self.byReference.get(parentReference)
+            if parent is not None:
+                record.parent = parent
+                parent._children.append(record)
+        for record in self.byReference.values():
+            record._children.sort(key=lambda child: child.indexInParent)
+            if len(record._children) < min(record.childCount, config.childrenLimit):
+                # e.g. tables, whose cells are only created on demand.
+                for child in record._children:
+                    self.forget(child)
+                del record._children[:]
+                record.complete = False
+
+        appRecord = self.byReference.get(appReference)
+        if appRecord is None:
+            return False
+        appRecord.accessible = application
+        appRecord.parent = None
+        if node is application:
+            self.root = appRecord
+        else:
+            self.root = self.recordFor(node, appRecord)
+            if self.root is None:
+                return False
+            self.root.accessible = node
+        return True
+
+    def recordFor(self, node, top=None):
+        """
+        Finds the record for a live node below top (by default the root of
+        the snapshot), or returns None if there is none.
+
+        Records are looked up by their bus reference if the bindings expose
+        it, otherwise by following the node's child indexes down from top.
+        """
+        if top is None:
+            top = self.root
+        reference = objectReference(node)
+        if reference is not None:
+            return self.byReference.get(reference)
+        path = []
+        while node != top.accessible:
+            if node is None or node.roleName == 'application':
+                return None
+            path.append(node.indexInParent)
+            node = node.parent
+        record = top
+        for index in reversed(path):
+            matches = [r for r in record.children if r.indexInParent == index]
+            if not matches:
+                return None
+            record = matches[0]
+        return record
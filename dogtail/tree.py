@@ -34,6 +34,8 @@ config.searchWarningThreshold) it will start sending warnings about the search
 to the debug log. If it still can't succeed after 'config.searchCutoffCount'
 attempts, it raises an exception containing details of the search. You can see
 all of this process in the debug log by setting 'config.debugSearching' to True
+(How long to wait between attempts and when to give up can be changed by
+setting 'config.searchRetryPolicy'; see the retry module.)
 
 We also automatically add a short delay after each action
 ('config.defaultDelay' gives the time in seconds). We'd hoped that the search
@@ -66,13 +68,22 @@ if config.checkForA11y:
     checkForA11y()
 
 import predicate
-from time import sleep
+from retry import Attempts
 from utils import doDelay
+from utils import aboutToAct
+from utils import forgetFetchedProperties
+import utils
+from utils import EventWaiter
+from utils import TextInsertionWaiter
 from utils import Blinker
 from utils import Lock
 import rawinput
 import path
+import locators
 from __builtin__ import xrange
+from collections import OrderedDict
+import threading
+from time import time
 
 from logging import debugLogger as logger
 
@@ -82,6 +93,8 @@ try:
 except ImportError:  # pragma: no cover
     raise ImportError("Error importing the AT-SPI bindings")
 
+from mirror import mirrorFor
+
 # We optionally import the bindings for libWnck.
 try:
     from gi.repository import Wnck
@@ -96,6 +109,11 @@ from gi.repository import GLib
 
 haveWarnedAboutChildrenLimit = False
 
+# Events after which a failed search is worth retrying:
+searchWakeupEvents = ('object:children-changed',
+                      'object:property-change:accessible-name',
+                      'object:state-changed')
+
 
 class SearchError(Exception):
     pass
@@ -164,27 +182,442 @@ class Action(object):
     def keyBinding(self):
         return self.__action.getKeyBinding(self.__index)
 
+    # Events after which a condition passed as Action.do(wait=...) is checked
+    # again; it is also checked every pollInterval seconds, as not every
+    # change is reported.
+    changeEvents = ('object:children-changed', 'object:state-changed',
+                    'object:property-change', 'object:text-changed',
+                    'window:create', 'window:activate')
+    pollInterval = 0.1
+
     def __str__(self):
         return "[action | %s | %s ]" % \
             (self.name, self.keyBinding)
 
-    def do(self):
+    def do(self, wait=None, timeout=None):
         """
         Performs the given tree.Action, with appropriate delays and logging.
+
+        By default, sleeps for config.actionDelay afterwards. If wait is
+        given, returns as soon as the action is seen to have taken effect
+        instead, waiting at most timeout seconds (config.actionDelay by
+        default). wait is either a callable returning True once the UI is
+        in the expected state, or the name (or a list of names) of AT-SPI
+        events the action causes in the node's application, e.g.
+        'window:create'.
         """
-        logger.log("%s on %s" % (self.name, self.node.getLogString()))
+        logger.info(lambda: "%s on %s" % (self.name, self.node.getLogString()))
         if not self.node.sensitive:
             if config.ensureSensitivity:
                 raise NotSensitiveError(self)
             else:
                 nSE = NotSensitiveError(self)
-                logger.log("Warning: " + str(nSE))
+                logger.warning("Warning: %s", nSE)
         if config.blinkOnActions:
             self.node.blink()
-        result = self.__action.doAction(self.__index)
-        doDelay(config.actionDelay)
+        aboutToAct()
+        if wait is None:
+            result = self.__action.doAction(self.__index)
+            doDelay(config.actionDelay, self.node)
+            return result
+
+        if timeout is None:
+            timeout = config.actionDelay
+        if callable(wait):
+            eventNames = self.changeEvents
+        elif isinstance(wait, basestring):
+            eventNames = (wait,)
+        else:
+            eventNames = wait
+        try:
+            application = self.node.getApplication()
+        except Exception:
+            application = None
+        waiter = EventWaiter(eventNames, application)
+        # Listen before acting, so that an event the action causes right
+        # away isn't missed.
+        waiter.start()
+        try:
+            result = self.__action.doAction(self.__index)
+            start = time()
+            if not self.__waitFor(wait, waiter, start + timeout):
+                logger.warning(lambda: "%s on %s: no effect seen after %ss" %
+                               (self.name, self.node.getLogString(), timeout))
+            elif config.debugSleep:
+                logger.debug("%s took effect after %fs", self.name, time() - start)
+        finally:
+            waiter.stop()
         return result
 
+    def __waitFor(self, wait, waiter, deadline):
+        """
+        Waits until the condition holds or one of the events is seen.
+        Returns False if the deadline passed first.
+        """
+        while True:
+            if callable(wait):
+                forgetFetchedProperties()
+                if wait():
+                    return True
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            if callable(wait):
+                waiter.wait(min(remaining, self.pollInterval))
+            elif waiter.wait(remaining):
+                return True
+
+
+class NodeProperties(object):
+
+    """
+    Properties of a node, as returned by Node.fetch(): each of them is an
+    attribute.
+    """
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def __contains__(self, name):
+        return name in self.__dict__
+
+    def __repr__(self):
+        return "<NodeProperties %s>" % ", ".join(
+            ["%s=%r" % item for item in sorted(self.__dict__.items())])
+
+
+class SearchCache(object):
+
+    """
+    Remembers where searches found their nodes, as the list of child indexes
+    leading from the node the search started at to the node found, so that
+    looking for the same thing again only costs a round trip per level.
+
+    Entries are keyed by (starting node, predicate, recursive), and the
+    least recently used ones are evicted beyond config.searchCacheSize
+    entries. A remembered node is only returned if it isn't dead and still
+    satisfies the predicate; otherwise the entry is dropped and the caller
+    does a full search.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+
+    def lookup(self, node, pred, recursive):
+        """
+        Returns the node remembered for this search, or None. If
+        config.persistentLocators is set, searches not remembered yet are
+        looked up in the locator store too (see dogtail.locators).
+        """
+        key = (node, pred, recursive)
+        path = self.entries.pop(key, None)
+        stored = False
+        if path is None and config.persistentLocators:
+            path = locators.lookup(node, pred, recursive)
+            stored = True
+        if path is None:
+            return None
+        result = self.follow(node, path, pred)
+        if result is not None:
+            self.entries[key] = path
+            return result
+        if config.debugSearching:
+            logger.log("Forgetting the stale location of %s" %
+                       pred.describeSearchResult())
+        if stored:
+            locators.forget(node, pred, recursive)
+        return None
+
+    def follow(self, node, path, pred):
+        """
+        Follows the child indexes from node, returning the node reached if
+        it is alive and satisfies the predicate, or None.
+        """
+        try:
+            for index in path:
+                node = node[index]
+            if node is not None and not node.dead and \
+                    pred.satisfiedByNode(node):
+                return node
+        except Exception:
+            pass
+        return None
+
+    def remember(self, node, pred, recursive, result):
+        """
+        Stores where a search starting at node found result.
+        """
+        try:
+            path = locators.indexPath(result, node)
+        except Exception:
+            return
+        if path is None:
+            # Not below node (e.g. a hyperlink anchor).
+            return
+        key = (node, pred, recursive)
+        self.entries.pop(key, None)
+        self.entries[key] = path
+        while len(self.entries) > max(config.searchCacheSize, 0):
+            self.entries.popitem(last=False)
+        if config.persistentLocators:
+            locators.record(node, pred, recursive, path)
+
+    def invalidate(self, node=None, pred=None):
+        """
+        Forgets the searches starting at node and/or for pred, or
+        everything if neither is given.
+        """
+        for key in self.entries.keys():
+            if (node is None or key[0] == node) and \
+                    (pred is None or key[1] == pred):
+                del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+searchCache = SearchCache()
+
+
+def isTimeout(error):
+    """
+    Is the GLib.GError of an AT-SPI call a D-Bus timeout, i.e. did the
+    application not answer (as opposed to a node having gone away)?
+    """
+    message = str(error)
+    return 'NoReply' in message or 'imeout' in message or 'timed out' in message
+
+
+# libatspi's D-Bus timeouts for method calls and for starting applications,
+# in milliseconds. libatspi can't be asked for them, so they are tracked
+# here; these are its defaults until setAtspiTimeouts() changes them.
+atspiTimeouts = (800, 15000)
+
+
+def setAtspiTimeouts(call, startup):
+    """
+    Sets libatspi's D-Bus timeouts, in milliseconds, for method calls and
+    for starting applications. Returns the previous ones, so that they can
+    be put back.
+    """
+    global atspiTimeouts
+    previous = atspiTimeouts
+    pyatspi.Atspi.set_timeout(call, startup)
+    atspiTimeouts = (call, startup)
+    return previous
+
+
+class DesktopSearch(object):
+
+    """
+    Searches below the desktop, with config.guardedDesktopSearch set, in a
+    way that a hung application can't hold up.
+
+    The whole tree of every application is fetched through its AT-SPI Cache
+    interface (see dogtail.snapshot), config.searchThreads applications at
+    a time, each worker thread having its own connection to the
+    accessibility bus (libatspi's single connection isn't safe to share
+    between threads). The snapshots are then searched one after the other,
+    in desktop order, so the first match is the first in tree order.
+    Applications without the Cache interface are walked live instead.
+
+    Every call to an application is made with a D-Bus timeout of
+    config.applicationTimeout seconds, and an application that lets a call
+    time out is left out of the rest of the search. Applications that
+    don't answer in config.applicationSkipThreshold searches in a row are
+    then skipped altogether for config.applicationSkipDuration seconds.
+    Applications whose trees merely take long to walk are never given up
+    on, as each of their calls is answered.
+    """
+
+    def __init__(self):
+        # (consecutive searches without an answer, time until which to
+        # skip) by application:
+        self.timeouts = {}
+        self.pool = None
+        self.poolSize = None
+        # The worker threads' connections to the accessibility bus:
+        self.local = threading.local()
+
+    def getPool(self):
+        size = max(config.searchThreads or 1, 1)
+        if self.pool is None or self.poolSize != size:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(size)
+            self.poolSize = size
+        return self.pool
+
+    def callTimeout(self):
+        """
+        The D-Bus timeout of calls to applications, in milliseconds.
+        """
+        return int((config.applicationTimeout or 0) * 1000) or \
+            atspiTimeouts[0]
+
+    def isSkipped(self, application):
+        (count, skippedUntil) = self.timeouts.get(application, (0, 0))
+        return skippedUntil > time()
+
+    def timedOut(self, application):
+        (count, skippedUntil) = self.timeouts.get(application, (0, 0))
+        count += 1
+        if count >= (config.applicationSkipThreshold or 1):
+            skippedUntil = time() + (config.applicationSkipDuration or 0)
+            logger.warning("Skipping an application in searches for %ss: it "
+                           "didn't answer in %d searches in a row",
+                           config.applicationSkipDuration, count)
+            count = 0
+        self.timeouts[application] = (count, skippedUntil)
+
+    def fetchItems(self, busName):
+        """
+        Gets the Cache items of the application owning busName, on this
+        thread's own connection. Runs in the worker threads; returns the
+        GLib.GError raised, if any, rather than raising it.
+        """
+        import snapshot
+        try:
+            connection = getattr(self.local, 'connection', None)
+            if connection is None or connection.is_closed():
+                connection = snapshot.connectToA11yBus()
+                self.local.connection = connection
+            return snapshot.getCacheItems(busName, connection,
+                                          self.callTimeout())
+        except GLib.GError as e:
+            return e
+
+    def fetchAll(self, applications):
+        """
+        The Cache items (or GLib.GError) of each application, or None for
+        those that can't be fetched that way.
+        """
+        import snapshot
+        busNames = []
+        for application in applications:
+            reference = None
+            if mirrorFor(application) is None:
+                reference = snapshot.objectReference(application)
+            busNames.append(reference and reference[0])
+        fetched = self.getPool().map(self.fetchItems,
+                                     [name for name in busNames if name])
+        fetched.reverse()
+        return [fetched.pop() if name else None for name in busNames]
+
+    def searchSnapshot(self, application, items, pred, recursive, first):
+        """
+        The matches below an application, found in a snapshot made of its
+        Cache items, or None if the items can't be used.
+        """
+        import snapshot
+        tree = snapshot.Snapshot(application, items=items)
+        if not tree.fromCache:
+            return None
+        return [record.node for record in
+                tree.search(tree.root, pred, recursive, first)]
+
+    def searchApplication(self, application, pred, recursive, first):
+        """
+        The matches below an application, found by walking its live tree in
+        the same order as findChild() does. GLib.GError is raised if a call
+        to the application times out.
+        """
+        test = pred
+        if isinstance(pred, predicate.Predicate):
+            test = pred.satisfiedByNode
+        mirror = mirrorFor(application)
+        if mirror is not None:
+            nodes = mirror.findChildren(application, pred, recursive, first)
+            if nodes is not None:
+                return nodes
+
+        def childrenOf(node):
+            try:
+                return [child for child in
+                        (node[i] for i in range(node.childCount))
+                        if child is not None]
+            except GLib.GError as e:
+                if isTimeout(e):
+                    raise
+            except LookupError:
+                pass
+            return []
+
+        # Walked here rather than with _iterDescendants(), which retries
+        # failed calls, so that a timeout ends the walk at once.
+        found = []
+        stack = childrenOf(application)[::-1]
+        while stack:
+            node = stack.pop()
+            try:
+                matches = test(node)
+            except GLib.GError as e:
+                if isTimeout(e):
+                    raise
+                matches = False
+            except LookupError:
+                matches = False
+            if matches:
+                found.append(node)
+                if first:
+                    break
+            if recursive:
+                stack.extend(childrenOf(node)[::-1])
+        return found
+
+    def findChildren(self, root, pred, recursive=True, first=False):
+        """
+        The nodes below root (the desktop) satisfying the predicate, in
+        tree order, or only the first of them if first is True.
+        """
+        test = pred
+        if isinstance(pred, predicate.Predicate):
+            test = pred.satisfiedByNode
+        previous = setAtspiTimeouts(self.callTimeout(), atspiTimeouts[1])
+        found = []
+        try:
+            applications = [application for application in root
+                            if application is not None and
+                            not self.isSkipped(application)]
+            fetched = [None] * len(applications)
+            if recursive:
+                fetched = self.fetchAll(applications)
+            for application, items in zip(applications, fetched):
+                try:
+                    if isinstance(items, GLib.GError) and isTimeout(items):
+                        raise items
+                    matches = []
+                    if test(application):
+                        matches.append(application)
+                    if recursive and not (first and matches):
+                        nodes = None
+                        if items and not isinstance(items, GLib.GError):
+                            nodes = self.searchSnapshot(application, items,
+                                                        pred, True, first)
+                        if nodes is None:
+                            nodes = self.searchApplication(application, pred,
+                                                           True, first)
+                        matches.extend(nodes)
+                except GLib.GError as e:
+                    if not isTimeout(e):
+                        if config.debugSearching:
+                            logger.debug("Error searching an application: %s", e)
+                        continue
+                    logger.warning("An application didn't answer within %ss; "
+                                   "searching the others",
+                                   config.applicationTimeout)
+                    self.timedOut(application)
+                    continue
+                except LookupError:
+                    continue
+                self.timeouts.pop(application, None)
+                found.extend(matches)
+                if first and found:
+                    return found[:1]
+        finally:
+            setAtspiTimeouts(*previous)
+        return found
+
+desktopSearch = DesktopSearch()
+
 
 class Node(object):
 
@@ -222,16 +655,86 @@ class Node(object):
     def dead(self):
         """Is the node dead (defunct) ?"""
         try:
-            if self.roleName == 'invalid':
+            properties = self.fetch('roleName', 'name', 'childCount', fresh=True)
+            if properties.roleName == 'invalid':
                 return True
-            self.role
-            self.name
-            if len(self) > 0:
+            if properties.childCount > 0:
                 self[0]
         except:
             return True
         return False
 
+    # How Node.fetch() gets each property; the ones that are parts of
+    # another property are worked out from that one.
+    fetchers = {
+        'name': lambda node: node.name,
+        'roleName': lambda node: node.getRoleName(),
+        'role': lambda node: node.getRole(),
+        'description': lambda node: node.description,
+        'childCount': lambda node: node.childCount,
+        'indexInParent': lambda node: node.getIndexInParent(),
+        'states': lambda node: frozenset([int(state) for state in
+                                          node.getState().getStates()]),
+        'extents': lambda node: node._fetchExtents(),
+    }
+    derivedProperties = {
+        'position': ('extents', lambda extents: extents and extents[:2]),
+        'size': ('extents', lambda extents: extents and extents[2:]),
+        'sensitive': ('states', lambda states: int(pyatspi.STATE_SENSITIVE) in states),
+        'showing': ('states', lambda states: int(pyatspi.STATE_SHOWING) in states),
+        'focusable': ('states', lambda states: int(pyatspi.STATE_FOCUSABLE) in states),
+        'focused': ('states', lambda states: int(pyatspi.STATE_FOCUSED) in states),
+        'checked': ('states', lambda states: int(pyatspi.STATE_CHECKED) in states),
+    }
+
+    def fetch(self, *names, **kwargs):
+        """
+        Fetches several properties of the node at once, returning them as
+        the attributes of a NodeProperties instance, e.g.
+
+            properties = node.fetch('name', 'roleName', 'states', 'extents')
+
+        Each underlying AT-SPI property is only queried once, however many
+        of the requested properties derive from it: 'position' and 'size'
+        come from 'extents' (which is None if the node has no Component
+        interface), and the state booleans ('sensitive', 'showing',
+        'focusable', 'focused', 'checked') come from 'states'.
+
+        The properties are cached for config.propertyCacheLifetime seconds,
+        or until dogtail next acts on the UI (see utils.aboutToAct()),
+        so that a high-level action looking at a node several times only
+        queries it once. Pass fresh=True to bypass the cache.
+        """
+        fresh = kwargs.pop('fresh', False)
+        if kwargs:
+            raise TypeError("Unexpected arguments: %s" % ", ".join(kwargs))
+        self.__setupUserData()
+        values = {}
+        cached = self.user_data.get('fetched')
+        lifetime = config.propertyCacheLifetime or 0
+        if not fresh and cached is not None and \
+                cached[0] == utils.propertyGeneration and time() - cached[1] < lifetime:
+            values = cached[2]
+        else:
+            cached = None
+        result = {}
+        for name in names:
+            if name in self.derivedProperties:
+                base, derive = self.derivedProperties[name]
+            elif name in self.fetchers:
+                base, derive = name, None
+            else:
+                raise ValueError("Unknown property: %s" % name)
+            if base not in values:
+                values[base] = self.fetchers[base](self)
+            if derive is None:
+                result[name] = values[base]
+            else:
+                result[name] = derive(values[base])
+        if cached is None:
+            self.user_data['fetched'] = (utils.propertyGeneration, time(), values)
+        return NodeProperties(result)
+
     @property
     def children(self):
         """a list of this Accessible's children"""
@@ -260,8 +763,8 @@ class Node(object):
 
         invalidChildren = childCount - len(children)
         if invalidChildren and config.debugSearching:
-            logger.log("Skipped %s invalid children of %s" %
-                       (invalidChildren, str(self)))
+            logger.debug("Skipped %s invalid children of %s",
+                         invalidChildren, self)
         try:
             ht = self.queryHypertext()
             for li in range(ht.getNLinks()):
@@ -292,14 +795,15 @@ class Node(object):
 
     # Needed to be renamed from doAction due to conflicts
     # with 'Accessibility.Accessible.doAction' in gtk3 branch
-    def doActionNamed(self, name):
+    def doActionNamed(self, name, wait=None, timeout=None):
         """
         Perform the action with the specified name. For a list of actions
-        supported by this instance, check the 'actions' property.
+        supported by this instance, check the 'actions' property. See
+        Action.do() for wait and timeout.
         """
         actions = self.actions
         if name in actions:
-            return actions[name].do()
+            return actions[name].do(wait=wait, timeout=timeout)
         raise ActionNotSupported(name, self)
 
     @property
@@ -310,15 +814,32 @@ class Node(object):
 
         'click' 'press' 'release' 'activate' 'jump' 'check' 'dock' 'undock'
         'open' 'menu'
+
+        The dictionary is built once per node, and built again only if the
+        number of actions changes or the node dies.
         """
+        self.__setupUserData()
+        cached = self.user_data.get('actions')
+        if cached is not None:
+            (action, actions) = cached
+            try:
+                # A dead node either fails these calls or says it's invalid.
+                if action.nActions == len(actions) and \
+                        self.fetch('roleName').roleName != 'invalid':
+                    return dict(actions)
+            except Exception:
+                pass
+            del self.user_data['actions']
         actions = {}
         try:
             action = self.queryAction()
             for i in range(action.nActions):
                 a = Action(self, action, i)
                 actions[action.getName(i)] = a
-        finally:
+        except Exception:
             return actions
+        self.user_data['actions'] = (action, actions)
+        return dict(actions)
 
     def combovalue():
         doc = "The value (as a string) currently selected in the combo box."
@@ -327,10 +848,10 @@ class Node(object):
             return self.name
 
         def fset(self, value):
-            logger.log("Setting combobox %s to '%s'" % (self.getLogString(),
-                                                        value))
+            logger.info(lambda: "Setting combobox %s to '%s'" %
+                        (self.getLogString(), value))
             self.childNamed(childName=value).doActionNamed('click')
-            doDelay()
+            doDelay(node=self)
 
         return property(**locals())
     combovalue = combovalue()
@@ -374,7 +895,8 @@ class Node(object):
                         txt = text[:134] + " [...]"
                     else:
                         txt = text
-                    logger.log(msg % (self.getLogString(), "'%s'" % txt))
+                    logger.debug(lambda: msg % (self.getLogString(), "'%s'" % txt))
+                aboutToAct()
                 self.queryEditableText().setTextContents(text)
             except NotImplementedError:
                 raise AttributeError("can't set attribute")
@@ -390,6 +912,7 @@ class Node(object):
             return self.queryText().caretOffset
 
         def fset(self, offset):
+            aboutToAct()
             return self.queryText().setCaretOffset(offset)
 
         return property(**locals())
@@ -402,23 +925,40 @@ class Node(object):
     @property
     def position(self):
         """A tuple containing the position of the Accessible: (x, y)"""
-        return self.queryComponent().getPosition(pyatspi.DESKTOP_COORDS)
+        position = self.fetch('position').position
+        if position is None:
+            raise NotImplementedError
+        return position
 
     @property
     def size(self):
         """A tuple containing the size of the Accessible: (w, h)"""
-        return self.queryComponent().getSize()
+        size = self.fetch('size').size
+        if size is None:
+            raise NotImplementedError
+        return size
 
     @property
     def extents(self):
         """A tuple containing the location and size of the Accessible:
         (x, y, w, h)"""
+        return self.fetch('extents').extents
+
+    def _fetchExtents(self):
         try:
             ex = self.queryComponent().getExtents(pyatspi.DESKTOP_COORDS)
             return (ex.x, ex.y, ex.width, ex.height)
         except NotImplementedError:
             return None
 
+    def __center(self):
+        """
+        The coordinates of the center of the Accessible.
+        """
+        (x, y) = self.position
+        (w, h) = self.size
+        return (x + w / 2, y + h / 2)
+
     def contains(self, x, y):
         try:
             return self.queryComponent().contains(x, y, pyatspi.DESKTOP_COORDS)
@@ -444,6 +984,7 @@ class Node(object):
 
     def grabFocus(self):
         "Attempts to set the keyboard focus to this Accessible."
+        aboutToAct()
         return self.queryComponent().grabFocus()
 
     # def blink(self, count=2):
@@ -464,37 +1005,37 @@ class Node(object):
             - 2 is middle,
             - 3 is right.
         """
-        clickX = self.position[0] + self.size[0] / 2
-        clickY = self.position[1] + self.size[1] / 2
+        clickX, clickY = self.__center()
         if config.debugSearching:
-            logger.log("raw click on %s %s at (%s,%s)" %
-                       (self.name, self.getLogString(), str(clickX), str(clickY)))
+            logger.debug(lambda: "raw click on %s %s at (%s,%s)" %
+                         (self.name, self.getLogString(), clickX, clickY))
+        aboutToAct()
         rawinput.click(clickX, clickY, button)
 
     def doubleClick(self, button=1):
         """
         Generates a raw mouse double-click event, using the specified button.
         """
-        clickX = self.position[0] + self.size[0] / 2
-        clickY = self.position[1] + self.size[1] / 2
+        clickX, clickY = self.__center()
         if config.debugSearching:
-            logger.log("raw click on %s %s at (%s,%s)" %
-                       (self.name, self.getLogString(), str(clickX), str(clickY)))
+            logger.debug(lambda: "raw click on %s %s at (%s,%s)" %
+                         (self.name, self.getLogString(), clickX, clickY))
+        aboutToAct()
         rawinput.doubleClick(clickX, clickY, button)
 
     def point(self, mouseDelay=None):
         """
         Move mouse cursor to the center of the widget.
         """
-        pointX = self.position[0] + self.size[0] / 2
-        pointY = self.position[1] + self.size[1] / 2
-        logger.log("Pointing on %s %s at (%s,%s)" %
-                   (self.name, self.getLogString(), str(pointX), str(pointY)))
-        rawinput.registry.generateMouseEvent(pointX, pointY, 'abs')
+        pointX, pointY = self.__center()
+        logger.info(lambda: "Pointing on %s %s at (%s,%s)" %
+                    (self.name, self.getLogString(), pointX, pointY))
+        aboutToAct()
+        rawinput.generateMouseEvent(pointX, pointY, 'abs')
         if mouseDelay:
-            doDelay(mouseDelay)
+            doDelay(mouseDelay, self)
         else:
-            doDelay()
+            doDelay(node=self)
 
     #
     # RelationSet
@@ -538,26 +1079,26 @@ class Node(object):
     @property
     def sensitive(self):
         """Is the Accessible sensitive (i.e. not greyed out)?"""
-        return self.getState().contains(pyatspi.STATE_SENSITIVE)
+        return self.fetch('sensitive').sensitive
 
     @property
     def showing(self):
-        return self.getState().contains(pyatspi.STATE_SHOWING)
+        return self.fetch('showing').showing
 
     @property
     def focusable(self):
         """Is the Accessible capable of having keyboard focus?"""
-        return self.getState().contains(pyatspi.STATE_FOCUSABLE)
+        return self.fetch('focusable').focusable
 
     @property
     def focused(self):
         """Does the Accessible have keyboard focus?"""
-        return self.getState().contains(pyatspi.STATE_FOCUSED)
+        return self.fetch('focused').focused
 
     @property
     def checked(self):
         """Is the Accessible a checked checkbox?"""
-        return self.getState().contains(pyatspi.STATE_CHECKED)
+        return self.fetch('checked').checked
 
     @property
     def isChecked(self):
@@ -570,14 +1111,16 @@ class Node(object):
 
     def selectAll(self):
         """Selects all children."""
+        aboutToAct()
         result = self.querySelection().selectAll()
-        doDelay()
+        doDelay(node=self)
         return result
 
     def deselectAll(self):
         """Deselects all selected children."""
+        aboutToAct()
         result = self.querySelection().clearSelection()
-        doDelay()
+        doDelay(node=self)
         return result
 
     def select(self):
@@ -586,8 +1129,9 @@ class Node(object):
             parent = self.parent
         except AttributeError:
             raise NotImplementedError
+        aboutToAct()
         result = parent.querySelection().selectChild(self.indexInParent)
-        doDelay()
+        doDelay(node=self)
         return result
 
     def deselect(self):
@@ -596,8 +1140,9 @@ class Node(object):
             parent = self.parent
         except AttributeError:
             raise NotImplementedError
+        aboutToAct()
         result = parent.querySelection().deselectChild(self.indexInParent)
-        doDelay()
+        doDelay(node=self)
         return result
 
     @property
@@ -666,31 +1211,97 @@ class Node(object):
         except NotImplementedError:
             pass
 
-    def typeText(self, string):
+    def typeText(self, string, mode=None):
         """
         Type the given text into the node, with appropriate delays and
         logging.
-        """
-        logger.log("Typing text into %s: '%s'" % (self.getLogString(), string))
 
-        if self.focusable:
-            if not self.focused:
-                try:
-                    self.grabFocus()
-                except Exception:
-                    logger.log("Node is focusable but I can't grabFocus!")
+        mode is how the text is entered, config.typingMode by default:
+        'keys', 'burst', 'insert' or 'auto' (see dogtail.config). Except in
+        'keys' mode, the text is checked to have arrived by the
+        text-changed events the node sends, rather than by sleeping, and
+        the typing speed is logged.
+        """
+        logger.info(lambda: "Typing text into %s: '%s'" %
+                    (self.getLogString(), string))
+        if not isinstance(string, unicode):
+            string = string.decode('utf-8')
+        if mode is None:
+            mode = config.typingMode or 'keys'
+        if mode == 'auto':
+            mode = self.__chooseTypingMode(string)
+        if mode not in ('keys', 'burst', 'insert'):
+            raise ValueError("Unknown typing mode: %s" % mode)
+
+        if mode != 'insert' and not self.focusable:
+            logger.log("Node is not focusable; falling back to inserting text")
+            mode = 'insert'
+        if mode != 'insert' and not self.focused:
+            try:
+                self.grabFocus()
+            except Exception:
+                logger.log("Node is focusable but I can't grabFocus!")
+        if mode == 'keys':
             rawinput.typeText(string)
+            return
+
+        aboutToAct()
+        # Tabs and newlines don't necessarily insert anything.
+        expected = len(string) - string.count('\t') - string.count('\n')
+        idleTimeout = config.actionDelay
+        start = time()
+        with TextInsertionWaiter(self) as waiter:
+            if mode == 'insert':
+                self.__insertText(string)
+            else:
+                chunkSize = max(config.typingChunkSize or len(string), 1)
+                # Keep at most one chunk in flight.
+                rawinput.typeTextBurst(
+                    string, chunkSize,
+                    lambda typed: waiter.waitFor(
+                        min(typed, expected) - chunkSize, idleTimeout))
+            inserted = waiter.waitFor(expected, idleTimeout)
+        elapsed = time() - start
+        if inserted < expected:
+            logger.warning(lambda: "Warning: only %d of %d characters were seen "
+                           "arriving in %s" %
+                           (inserted, expected, self.getLogString()))
+        logger.info("Typed %d characters in %.2fs (%.0f keys/s, %s mode)",
+                    len(string), elapsed, len(string) / max(elapsed, 1e-6), mode)
+
+    def __chooseTypingMode(self, string):
+        """
+        The typing mode 'auto' stands for with the given text.
+        """
+        if '\t' not in string and '\n' not in string:
+            try:
+                self.queryEditableText()
+                return 'insert'
+            except NotImplementedError:
+                pass
+        if len(string) > (config.typingChunkSize or 0):
+            return 'burst'
+        return 'keys'
+
+    def __insertText(self, string):
+        """
+        Inserts the text at the caret through the EditableText interface,
+        or sets it as the whole contents if the node is empty.
+        """
+        editableText = self.queryEditableText()
+        length = len(string.encode('utf-8'))
+        if not self.queryText().characterCount:
+            editableText.setTextContents(string)
+            self.caretOffset = len(string)
         else:
-            logger.log("Node is not focusable; falling back to inserting text")
-            et = self.queryEditableText()
-            et.insertText(self.caretOffset, string, len(string))
-            self.caretOffset += len(string)
-            doDelay()
+            offset = self.caretOffset
+            editableText.insertText(offset, string, length)
+            self.caretOffset = offset + len(string)
 
     def keyCombo(self, comboString):
         if config.debugSearching:
-            logger.log("Pressing keys '%s' into %s" %
-                       (comboString, self.getLogString()))
+            logger.debug(lambda: "Pressing keys '%s' into %s" %
+                         (comboString, self.getLogString()))
         if self.focusable:
             if not self.focused:
                 try:
@@ -719,6 +1330,20 @@ class Node(object):
         assert isinstance(pred, predicate.Predicate)
         return pred.satisfiedByNode(self)
 
+    def snapshot(self, useCache=True):
+        """
+        Take a snapshot of the tree below this node, returning the
+        snapshot.SnapshotNode record corresponding to this node.
+
+        The whole application is fetched in one call to the AT-SPI Cache
+        interface if possible (and if useCache is True), otherwise the live
+        tree is walked once. findChild() and findChildren() on the returned
+        record then run locally, without any D-Bus traffic; use the 'node'
+        attribute of a record to get back to the live Node.
+        """
+        import snapshot
+        return snapshot.Snapshot(self, useCache=useCache).root
+
     def dump(self, type='plain', fileName=None):
         import dump
         dumper = getattr(dump, type)
@@ -818,10 +1443,25 @@ class Node(object):
         else:
             return False
 
-    def _fastFindChild(self, pred, recursive=True):
+    def _fastFindChild(self, pred, recursive=True, maxDepth=None, pruneHidden=False):
         """
-        Searches for an Accessible using methods from pyatspi.utils
+        Searches for an Accessible using methods from pyatspi.utils, or
+        using the application's TreeMirror (and its indexes) if one is
+        running. Depth-limited and pruned searches walk the live tree.
         """
+        if maxDepth is not None or pruneHidden:
+            for child in self.iterFindChildren(pred, recursive, maxDepth,
+                                               limit=1, pruneHidden=pruneHidden):
+                return child
+            return None
+        if config.guardedDesktopSearch and self.parent is None:
+            found = desktopSearch.findChildren(self, pred, recursive, first=True)
+            return found[0] if found else None
+        mirror = mirrorFor(self)
+        if mirror is not None:
+            found = mirror.findChildren(self, pred, recursive, first=True)
+            if found is not None:
+                return found[0] if found else None
         if isinstance(pred, predicate.Predicate):
             pred = pred.satisfiedByNode
         if not recursive:
@@ -837,19 +1477,45 @@ class Node(object):
         else:
             return pyatspi.utils.findDescendant(self, pred)
 
+    def __searchScope(self):
+        """
+        The application whose events may make a search below this node
+        succeed, or None if any application's events may do so (i.e. when
+        searching from the desktop).
+        """
+        if self.parent is None:
+            return None
+        try:
+            return self.getApplication()
+        except Exception:
+            return None
+
     def findChild(self, pred, recursive=True, debugName=None,
-                  retry=True, requireResult=True):
+                  retry=True, requireResult=True, maxDepth=None, pruneHidden=False):
         """
         Search for a node satisyfing the predicate, returning a Node.
 
+        maxDepth limits how many levels below this node are searched. If
+        pruneHidden is True, nodes that aren't showing (e.g. in hidden
+        notebook pages or collapsed panes) are skipped, along with
+        everything below them.
+
         If retry is True (the default), it makes multiple attempts,
-        backing off and retrying on failure, and eventually raises a
-        descriptive exception if the search fails.
+        backing off and retrying on failure as config.searchRetryPolicy
+        says, and eventually raises a descriptive exception if the search
+        fails. If config.eventDrivenSearch is True, the waits between
+        retries end as soon as the application reports a change, and the
+        retries go on until config.searchTimeout has passed.
 
         If retry is False, it gives up after one attempt.
 
         If requireResult is True (the default), an exception is raised after all
         attempts have failed. If it is false, the function simply returns None.
+
+        If config.cacheSearches is True, where the node was found is
+        remembered (see SearchCache), and the next identical search first
+        checks whether the node is still there. With
+        config.persistentLocators, this is also remembered across runs.
         """
         def describeSearch(parent, pred, recursive, debugName):
             """
@@ -864,36 +1530,225 @@ class Node(object):
             return "%s of %s: %s" % (noun, parent.getLogString(), debugName)
 
         assert isinstance(pred, predicate.Predicate)
-        numAttempts = 0
-        while numAttempts < config.searchCutoffCount:
-            if numAttempts >= config.searchWarningThreshold or config.debugSearching:
-                logger.log("searching for %s (attempt %i)" %
-                           (describeSearch(self, pred, recursive, debugName), numAttempts))
-
-            result = self._fastFindChild(pred.satisfiedByNode, recursive)
-            if result:
-                assert isinstance(result, Node)
-                if debugName:
-                    result.debugName = debugName
-                else:
-                    result.debugName = pred.describeSearchResult()
+        useCache = (config.cacheSearches or config.persistentLocators) and \
+            maxDepth is None and not pruneHidden
+        if useCache:
+            result = searchCache.lookup(self, pred, recursive)
+            if result is not None:
+                result.debugName = debugName or pred.describeSearchResult()
                 return result
-            else:
-                if not retry:
-                    break
-                numAttempts += 1
-                if config.debugSearching or config.debugSleep:
-                    logger.log("sleeping for %f" %
-                               config.searchBackoffDuration)
-                sleep(config.searchBackoffDuration)
+        attempts = self.__searchAttempts(retry, pred)
+        try:
+            for numAttempts in attempts:
+                if numAttempts >= config.searchWarningThreshold or config.debugSearching:
+                    logger.info(lambda: "searching for %s (attempt %i)" %
+                                (describeSearch(self, pred, recursive, debugName),
+                                 numAttempts))
+
+                result = self._fastFindChild(pred, recursive, maxDepth, pruneHidden)
+                if result:
+                    assert isinstance(result, Node)
+                    if debugName:
+                        result.debugName = debugName
+                    else:
+                        result.debugName = pred.describeSearchResult()
+                    attempts.succeeded()
+                    if useCache:
+                        searchCache.remember(self, pred, recursive, result)
+                    return result
+        finally:
+            attempts.close()
         if requireResult:
             raise SearchError(describeSearch(self, pred, recursive, debugName))
 
+    def __searchAttempts(self, retry, pred=None):
+        """
+        Returns the retry.Attempts of a search, backing off between
+        attempts as config.searchRetryPolicy says. The policy learns from
+        the searches made in the same application, or, for searches on the
+        desktop, from the searches for the same predicate.
+
+        If config.eventDrivenSearch is set, the waits between attempts end
+        early when the application reports a change, and the search goes
+        on until config.searchTimeout has passed.
+        """
+        # Working out the application takes a few calls to it, so it's only
+        # done for the event waiter, or for the key once the policy needs it
+        # (see retry.Attempts).
+        scopes = []
+        if retry and config.eventDrivenSearch:
+            scopes.append(self.__searchScope())
+
+        def key():
+            if not scopes:
+                scopes.append(self.__searchScope())
+            if scopes[0] is not None:
+                return scopes[0].name
+            elif pred is not None:
+                return pred.describeSearchResult()
+
+        waiter = None
+        timeout = None
+        if retry and config.eventDrivenSearch:
+            # Listen before the first attempt, so that changes happening
+            # while we walk the tree wake up the next retry.
+            waiter = EventWaiter(searchWakeupEvents, scopes[0])
+            waiter.start()
+            timeout = config.searchTimeout
+        return Attempts(key, retry, timeout=timeout, waiter=waiter)
+
+    def _iterDescendants(self, recursive=True, maxDepth=None, pruneHidden=False):
+        """
+        Generates the children of this node, or all of its descendants
+        (depth first, in the same order as pyatspi.utils.findDescendant
+        visits them) if recursive is True, down to maxDepth levels below
+        this node if given. Invalid children are skipped, and so are
+        children that aren't showing, and their descendants, if
+        pruneHidden is True.
+
+        Transient D-Bus errors are retried in place, so the walk carries on
+        from where it was rather than starting over.
+        """
+        if not recursive:
+            maxDepth = 1
+        childCount = self.__retryTransient(lambda: self.childCount)
+        stack = [(self, 0, childCount or 0, 1)]
+        while stack:
+            (parent, index, childCount, depth) = stack.pop()
+            if index >= childCount:
+                continue
+            stack.append((parent, index + 1, childCount, depth))
+            try:
+                child = self.__retryTransient(lambda: parent[index])
+            except LookupError:
+                child = None
+            if child is None:
+                continue
+            if pruneHidden and not self.__retryTransient(lambda: child.showing):
+                continue
+            yield child
+            if maxDepth is None or depth < maxDepth:
+                grandchildCount = self.__retryTransient(lambda: child.childCount)
+                if grandchildCount:
+                    stack.append((child, 0, grandchildCount, depth + 1))
+
+    def __retryTransient(self, call, attempts=3):
+        """
+        Calls call(), retrying it if it fails with a D-Bus error, and
+        returning None if it keeps failing.
+        """
+        for attempt in range(attempts):
+            try:
+                return call()
+            except GLib.GError:
+                if config.debugSearching:
+                    logger.debug(lambda: "D-Bus error while walking %s, retrying" %
+                                 self.getLogString())
+        return None
+
+    def iterFindChildren(self, pred, recursive=True, maxDepth=None, limit=None,
+                         pruneHidden=False):
+        """
+        Generates the children/descendents satisfying the predicate, as they
+        are found. The walk stops as soon as the caller stops iterating, or
+        after limit matches if given.
+
+        maxDepth limits how many levels below this node are searched. If
+        pruneHidden is True, nodes that aren't showing are skipped, along
+        with everything below them.
+        """
+        if isinstance(pred, predicate.Predicate):
+            pred = pred.satisfiedByNode
+        if limit is not None and limit <= 0:
+            return
+        found = 0
+        for node in self._iterDescendants(recursive, maxDepth, pruneHidden):
+            try:
+                matches = pred(node)
+            except (GLib.GError, LookupError):
+                # The node went away as we looked at it.
+                matches = False
+            if matches:
+                yield node
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+    def findMany(self, preds, recursive=True, retry=True, requireResult=True):
+        """
+        Search for several nodes at once. preds is a dictionary of
+        predicates; the result is a dictionary with the same keys, giving
+        the first node satisfying each predicate.
+
+        The tree is walked once for all the predicates, stopping as soon as
+        every one of them is satisfied, rather than once per predicate as
+        separate findChild calls would. Retries (of the predicates still
+        unsatisfied) and requireResult work as in findChild. If
+        requireResult is False, unsatisfied predicates map to None.
+        """
+        pending = dict(preds)
+        for pred in pending.values():
+            assert isinstance(pred, predicate.Predicate)
+        results = {}
+
+        def describeSearch():
+            if recursive:
+                noun = "descendents"
+            else:
+                noun = "children"
+            return "%s of %s: %s" % (noun, self.getLogString(), ", ".join(
+                [pred.describeSearchResult() for pred in pending.values()]))
+
+        attempts = self.__searchAttempts(retry)
+        try:
+            for numAttempts in attempts:
+                if numAttempts >= config.searchWarningThreshold or config.debugSearching:
+                    logger.info(lambda: "searching for %s (attempt %i)" %
+                                (describeSearch(), numAttempts))
+                for node in self._iterDescendants(recursive):
+                    for key, pred in pending.items():
+                        try:
+                            matches = pred.satisfiedByNode(node)
+                        except (GLib.GError, LookupError):
+                            # The node went away as we looked at it.
+                            matches = False
+                        if matches:
+                            node.debugName = pred.describeSearchResult()
+                            results[key] = node
+                            del pending[key]
+                    if not pending:
+                        attempts.succeeded()
+                        return results
+        finally:
+            attempts.close()
+        if requireResult:
+            raise SearchError(describeSearch())
+        for key in pending:
+            results[key] = None
+        return results
+
     # The canonical "search for multiple" method:
-    def findChildren(self, pred, recursive=True):
+    def findChildren(self, pred, recursive=True, maxDepth=None, pruneHidden=False):
         """
         Find all children/descendents satisfying the predicate.
-        """
+
+        maxDepth limits how many levels below this node are searched. If
+        pruneHidden is True, nodes that aren't showing are skipped, along
+        with everything below them.
+
+        If a mirror.TreeMirror is running for the application, the search
+        is answered from it.
+        """
+        if maxDepth is not None or pruneHidden:
+            return list(self.iterFindChildren(pred, recursive, maxDepth,
+                                              pruneHidden=pruneHidden))
+        if config.guardedDesktopSearch and self.parent is None:
+            return desktopSearch.findChildren(self, pred, recursive)
+        mirror = mirrorFor(self)
+        if mirror is not None:
+            found = mirror.findChildren(self, pred, recursive)
+            if found is not None:
+                return found
         if isinstance(pred, predicate.Predicate):
             pred = pred.satisfiedByNode
         if not recursive:
@@ -908,43 +1763,46 @@ class Node(object):
                     result.append(child)
             return result
         else:
-            descendants = []
-            while True:
-                try:
-                    descendants = pyatspi.utils.findAllDescendants(self, pred)
-                    break
-                except GLib.GError:
-                    continue
-            return descendants
+            return list(self.iterFindChildren(pred, recursive))
 
     # The canonical "search above this node" method:
-    def findAncestor(self, pred):
+    def findAncestor(self, pred, maxDepth=None, pruneHidden=False):
         """
         Search up the ancestry of this node, returning the first Node
         satisfying the predicate, or None.
+
+        maxDepth limits how many levels above this node are searched. If
+        pruneHidden is True, ancestors that aren't showing are skipped.
         """
         assert isinstance(pred, predicate.Predicate)
         candidate = self.parent
+        depth = 1
         while candidate is not None:
-            if candidate.satisfies(pred):
+            if maxDepth is not None and depth > maxDepth:
+                break
+            if (not pruneHidden or candidate.showing) and candidate.satisfies(pred):
                 return candidate
             else:
                 candidate = candidate.parent
+                depth += 1
         # Not found:
         return None
 
     # Various wrapper/helper search methods:
-    def child(self, name='', roleName='', description='', label='', recursive=True, retry=True, debugName=None):
+    def child(self, name='', roleName='', description='', label='', recursive=True, retry=True, debugName=None,
+              maxDepth=None, pruneHidden=False):
         """
         Finds a child satisying the given criteria.
 
         This is implemented using findChild, and hence will automatically retry
         if no such child is found, and will eventually raise an exception. It
-        also logs the search.
+        also logs the search. See findChild for maxDepth and pruneHidden.
         """
-        return self.findChild(predicate.GenericPredicate(name=name, roleName=roleName, description=description, label=label), recursive=recursive, retry=retry, debugName=debugName)
+        return self.findChild(predicate.GenericPredicate(name=name, roleName=roleName, description=description, label=label), recursive=recursive, retry=retry, debugName=debugName,
+                              maxDepth=maxDepth, pruneHidden=pruneHidden)
 
-    def isChild(self, name='', roleName='', description='', label='', recursive=True, retry=False, debugName=None):
+    def isChild(self, name='', roleName='', description='', label='', recursive=True, retry=False, debugName=None,
+                maxDepth=None, pruneHidden=False):
         """
         Determines whether a child satisying the given criteria exists.
 
@@ -952,14 +1810,16 @@ class Node(object):
         if no such child is found. To make the function retry multiple times set retry to True.
         Returns a boolean value depending on whether the child was eventually found. Similar to
         'child', yet it catches SearchError exception to provide for False results, will raise
-        any other exceptions. It also logs the search.
+        any other exceptions. It also logs the search. See findChild for maxDepth
+        and pruneHidden.
         """
         found = True
         try:
             self.findChild(
                 predicate.GenericPredicate(
                     name=name, roleName=roleName, description=description, label=label),
-                recursive=recursive, retry=retry, debugName=debugName)
+                recursive=recursive, retry=retry, debugName=debugName,
+                maxDepth=maxDepth, pruneHidden=pruneHidden)
         except SearchError:
             found = False
         return found
@@ -23,8 +23,10 @@ gi.require_version('Gdk', '3.0')
 
 from gi.repository import Gtk
 from gi.repository import GObject
+from gi.repository import GLib
 from config import config
-from time import sleep
+from retry import Attempts
+from time import sleep, time
 from logging import debugLogger as logger
 from logging import TimeStamp
 from __builtin__ import file
@@ -84,58 +86,420 @@ def screenshot(file='screenshot.png', timeStamp=True):
     return path
 
 
-def run(string, timeout=config.runTimeout, interval=config.runInterval, desktop=None, dumb=False, appName=''):
+def run(string, timeout=config.runTimeout, interval=config.runInterval, desktop=None, dumb=False, appName='',
+        returnApplication=False):
     """
     Runs an application. [For simple command execution such as 'rm *', use os.popen() or os.system()]
-    If dumb is omitted or is False, polls at interval seconds until the application is finished starting, or until timeout is reached.
+    If dumb is omitted or is False, waits until the application is finished starting (i.e. has shown its first frame), or until timeout is reached. The application is recognized by its process id, or, if no application with that process id has shown up after half the timeout (e.g. when the command is a launcher), by its name (appName, the command by default). Startup is detected from the events the desktop and the application send; when none arrive, it is checked for every so often, as config.searchRetryPolicy says, interval being the usual delay.
     If dumb is True, returns when timeout is reached.
+    Returns the pid of the application, or, if returnApplication is True, a (pid, application) tuple, the application being the Application node (None if it wasn't found).
     """
     if not desktop:
         from tree import root as desktop
     args = string.split()
     os.environ['GTK_MODULES'] = 'gail:atk-bridge'
-    pid = subprocess.Popen(args, env=os.environ).pid
 
     if not appName:
         appName = args[0]
 
+    application = None
     if dumb:
+        pid = subprocess.Popen(args, env=os.environ).pid
         # We're starting a non-AT-SPI-aware application. Disable startup
         # detection.
-        doDelay(timeout)
+        doDelay(timeout, settle=False)
     else:
-        # Startup detection code
-        # The timing here is not totally precise, but it's good enough for now.
-        time = 0
-        while time < timeout:
-            time = time + interval
-            try:
-                for child in desktop.children[::-1]:
-                    if child.name == appName:
-                        for grandchild in child.children:
-                            if grandchild.roleName == 'frame':
-                                from procedural import focus
-                                focus.application.node = child
-                                doDelay(interval)
-                                return pid
-            except AttributeError:  # pragma: no cover
-                pass
-            doDelay(interval)
+        # Startup detection code. Listen before spawning, so that no event is
+        # missed.
+        watcher = StartupWatcher(appName, desktop)
+        watcher.start()
+        try:
+            pid = subprocess.Popen(args, env=os.environ).pid
+            application = watcher.waitFor(pid, timeout, interval)
+        finally:
+            watcher.stop()
+        if application is not None:
+            from procedural import focus
+            focus.application.node = application
+            doDelay(interval, application)
+    if returnApplication:
+        return (pid, application)
     return pid
 
 
-def doDelay(delay=None):
+def doDelay(delay=None, node=None, settle=True):
     """
     Utility function to insert a delay (with logging and a configurable
     default delay)
+
+    With config.settleDelays set, the delay is only an upper bound: it ends
+    as soon as the application of node (or, without a node, any
+    application) has sent no events for config.settleQuietPeriod seconds.
+    Pass settle=False for delays that must be slept in full.
     """
     if delay is None:
         delay = config.defaultDelay
+    if settle and config.settleDelays and delay > 0:
+        settleDelay(delay, node)
+        return
     if config.debugSleep:
         logger.log("sleeping for %f" % delay)
     sleep(delay)
 
 
+# The events that show an application is still busy reacting to input:
+settleEvents = ('object:children-changed', 'object:state-changed',
+                'object:property-change', 'object:text-changed',
+                'object:text-caret-moved', 'object:selection-changed',
+                'object:visible-data-changed', 'object:bounds-changed',
+                'window:create', 'window:destroy', 'window:activate',
+                'focus:')
+
+
+# Incremented whenever dogtail acts on the UI, which makes all the properties
+# cached by Node.fetch() stale:
+propertyGeneration = 0
+
+
+def forgetFetchedProperties():
+    """
+    Makes Node.fetch() query the properties of every node afresh.
+    """
+    global propertyGeneration
+    propertyGeneration += 1
+
+
+def aboutToAct():
+    """
+    To be called just before dogtail acts on the UI (does an action,
+    generates input, sets text...), which every way of doing so goes
+    through. Drops the properties cached by Node.fetch(), and, with
+    config.settleDelays set, makes sure the events the UI sends in response
+    are listened for, so that the delay after the action doesn't take it
+    for quiet before they're seen.
+    """
+    forgetFetchedProperties()
+    if not config.settleDelays:
+        settleListener.stop()
+        return
+    try:
+        settleListener.start()
+    except Exception as e:
+        logger.log("Can't listen to AT-SPI events (%s); not settling" % e)
+
+
+def settleDelay(maxDelay, node=None):
+    """
+    Waits until the application of node (or any application) has been
+    quiet for config.settleQuietPeriod seconds, but no longer than
+    maxDelay seconds. Returns the time waited.
+
+    The events are listened for from before the action (see aboutToAct()),
+    and for as long as config.settleDelays is set, rather than registering
+    a listener for each delay.
+    """
+    start = time()
+    application = None
+    if node is not None:
+        try:
+            application = node.getApplication()
+        except Exception:
+            pass
+    try:
+        settleListener.start()
+    except Exception as e:
+        # No AT-SPI events to go by, so sleep the old way.
+        logger.log("Can't listen to AT-SPI events (%s); not settling" % e)
+        sleep(maxDelay)
+        return maxDelay
+    settleListener.application = application
+    quietPeriod = config.settleQuietPeriod or 0
+    while True:
+        remaining = maxDelay - (time() - start)
+        if remaining <= 0:
+            break
+        if not settleListener.wait(min(quietPeriod, remaining)):
+            break
+    waited = time() - start
+    if config.debugSleep:
+        logger.log("settled after %f (at most %f)" % (waited, maxDelay))
+    return waited
+
+
+class EventWaiter(object):
+
+    """
+    Waits for AT-SPI events by spinning a GLib main loop until a matching
+    event arrives or a timeout expires. This lets callers react to a change
+    in the UI as soon as it is reported instead of sleeping a fixed time.
+
+    eventNames: the AT-SPI event types to listen for, e.g.
+    'object:children-changed'.
+    application: if given, only events coming from this application node
+    are taken into account.
+
+    Events that arrive between two calls to wait() are remembered, so that
+    changes happening while the caller is busy (e.g. walking the tree) are
+    not missed.
+    """
+
+    def __init__(self, eventNames, application=None):
+        self.eventNames = tuple(eventNames)
+        self.application = application
+        self.pending = False
+        self.listening = False
+        self.__loop = None
+        self.__timeoutId = None
+
+    def start(self):
+        """
+        Starts listening for the events.
+        """
+        if not self.listening:
+            from pyatspi import Registry as registry
+            registry.registerEventListener(self.__onEvent, *self.eventNames)
+            self.listening = True
+
+    def stop(self):
+        """
+        Stops listening for the events.
+        """
+        if self.listening:
+            from pyatspi import Registry as registry
+            registry.deregisterEventListener(self.__onEvent, *self.eventNames)
+            self.listening = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.stop()
+
+    def isRelevant(self, event):
+        """
+        Does the event come from the application we are interested in?
+        """
+        if self.application is None:
+            return True
+        try:
+            host = event.host_application
+        except AttributeError:
+            try:
+                host = event.source.getApplication()
+            except Exception:
+                # We can't tell, so rather wake up than miss a change.
+                return True
+        return host == self.application
+
+    def __onEvent(self, event):
+        if not self.isRelevant(event):
+            return
+        self.pending = True
+        if self.__loop is not None and self.__loop.is_running():
+            self.__loop.quit()
+
+    def __onTimeout(self):
+        self.__timeoutId = None
+        self.__loop.quit()
+        return False
+
+    def wait(self, timeout):
+        """
+        Waits until a relevant event arrives, or until timeout seconds have
+        passed. Returns True if an event was seen (possibly before this call
+        was made), False on timeout.
+        """
+        if not self.pending and timeout > 0:
+            self.__loop = GLib.MainLoop()
+            self.__timeoutId = GLib.timeout_add(
+                int(timeout * 1000), self.__onTimeout)
+            self.__loop.run()
+            if self.__timeoutId is not None:
+                GLib.source_remove(self.__timeoutId)
+                self.__timeoutId = None
+            self.__loop = None
+        # Changes usually come in bursts; dispatch whatever is already queued
+        # so that the next wait() isn't woken up by the same burst.
+        context = GLib.MainContext.default()
+        while context.pending():
+            context.iteration(False)
+        seen = self.pending
+        self.pending = False
+        return seen
+
+
+# Listens for settleEvents while config.settleDelays is set (see aboutToAct()):
+settleListener = EventWaiter(settleEvents)
+
+
+class StartupWatcher(EventWaiter):
+
+    """
+    Waits for an application to start up, i.e. to show its first frame.
+
+    Rather than walking all the running applications over and over, it goes
+    by the applications the desktop reports being added and the windows
+    being created, and only looks at the applications that match, by
+    process id or by name. When the process id is known, an application
+    with the right name that was already running when the watcher started
+    is only taken once nameFallbackAt has passed without the process
+    showing up (as happens when a launcher hands over to the running
+    instance). One with the right name that appears afterwards is taken
+    straight away, whatever its process id, as happens when the command is
+    a launcher that starts the application under another process.
+    """
+
+    def __init__(self, appName, desktop):
+        EventWaiter.__init__(self, ('object:children-changed:add',
+                                    'window:create'))
+        self.appName = appName
+        self.desktop = desktop
+        self.pid = None
+        self.nameFallbackAt = 0
+        self.running = []
+        self.events = []
+        self.candidates = []
+        self.namesakes = []
+
+    def start(self):
+        """
+        Starts listening, and notes the applications running already.
+        """
+        EventWaiter.start(self)
+        try:
+            self.running = self.desktop.children
+        except Exception:
+            self.running = []
+
+    def isRelevant(self, event):
+        """
+        Keeps the window creations, and the applications added to the
+        desktop (not the children added anywhere else).
+        """
+        try:
+            if event.type.startswith('window:create') or \
+                    event.source == self.desktop:
+                self.events.append(event)
+                return True
+        except Exception:
+            pass
+        return False
+
+    def consider(self, application):
+        """
+        Adds the application to the candidates if it has the process id
+        looked for, or the name and it wasn't running before, or to the
+        namesakes if it has the name but was running already.
+        """
+        if application is None or application in self.candidates or \
+                application in self.namesakes:
+            return
+        try:
+            if self.pid is not None and application.get_process_id() == self.pid:
+                self.candidates.append(application)
+            elif application.name == self.appName:
+                if self.pid is not None and application in self.running:
+                    self.namesakes.append(application)
+                else:
+                    self.candidates.append(application)
+        except Exception:
+            pass
+
+    def scan(self):
+        """
+        Looks for the application among the running ones, in case it was
+        already running, or its events were missed.
+        """
+        for child in self.desktop.children[::-1]:
+            self.consider(child)
+
+    def check(self):
+        """
+        Goes through the events received so far, returning the application
+        if it has shown a frame.
+        """
+        events = self.events
+        self.events = []
+        for event in events:
+            try:
+                if event.type.startswith('window:create'):
+                    try:
+                        application = event.host_application
+                    except AttributeError:
+                        application = event.source.getApplication()
+                    self.consider(application)
+                else:
+                    self.consider(event.any_data)
+            except Exception:
+                pass
+        candidates = self.candidates
+        if time() >= self.nameFallbackAt:
+            candidates = candidates + self.namesakes
+        for application in candidates:
+            try:
+                for child in application.children:
+                    if child.roleName == 'frame':
+                        return application
+            except Exception:
+                pass
+        return None
+
+    def waitFor(self, pid, timeout, interval):
+        """
+        Waits for the application with the given process id (or name) to
+        show a frame, for at most timeout seconds. Applications that were
+        running already are only recognized by name after half the timeout.
+        Returns the Application node, or None.
+        """
+        self.pid = pid
+        self.nameFallbackAt = time() + timeout / 2.0
+        attempts = Attempts(('startup', self.appName), interval=interval,
+                            timeout=timeout, waiter=self)
+        for numAttempts in attempts:
+            if not self.candidates and (numAttempts == 0 or not self.events):
+                self.scan()
+            application = self.check()
+            if application is not None:
+                attempts.succeeded()
+                return application
+        return None
+
+
+class TextInsertionWaiter(EventWaiter):
+
+    """
+    Counts the characters the application reports inserting into a node
+    (with object:text-changed:insert events), to check that text typed into
+    it has arrived.
+    """
+
+    def __init__(self, node):
+        EventWaiter.__init__(self, ('object:text-changed:insert',))
+        self.node = node
+        self.inserted = 0
+
+    def isRelevant(self, event):
+        try:
+            if event.source == self.node:
+                self.inserted += event.detail2
+                return True
+        except Exception:
+            pass
+        return False
+
+    def waitFor(self, count, idleTimeout):
+        """
+        Waits until count characters have been inserted, or until no
+        insertion was reported for idleTimeout seconds. Returns the number
+        of characters inserted so far.
+        """
+        while self.inserted < count:
+            if not self.wait(idleTimeout):
+                break
+        return self.inserted
+
+
 class Highlight (Gtk.Window):  # pragma: no cover
 
     def __init__(self, x, y, w, h):  # pragma: no cover
@@ -0,0 +1,343 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the dogtail.i18n module
+"""
+
+import os
+import re
+import time
+import struct
+import gettext
+import shutil
+import tempfile
+import unittest
+import dogtail.config
+import dogtail.i18n
+from dogtail.i18n import TranslatableString, safeDecode
+
+
+def oldMatchedBy(scriptString, string):
+    """
+    The way TranslatableString.matchedBy() used to work, building a regular
+    expression for every comparison.
+    """
+    def stringsMatch(inS, outS):
+        inString = str(inS)
+        outString = outS
+        if inString == outString:
+            return True
+        inString = inString + '$'
+        inString = safeDecode(inString)
+        outString = safeDecode(outString)
+        if inString[0] == '*':
+            inString = "\\" + inString
+        inString = re.sub('([\(\)])', r'\\\1', inString)
+        return re.match(inString, outString) is not None
+
+    for translatedString in scriptString.translatedStrings:
+        if stringsMatch(translatedString, string) or translatedString == string:
+            return True
+    return stringsMatch(scriptString.untranslatedString, string)
+
+
+def writeMoFile(fileName, messages):
+    """
+    Writes a gettext mo file with the given (UTF-8 encoded) translations.
+    """
+    messages = dict(messages)
+    messages[''] = 'Content-Type: text/plain; charset=UTF-8\n'
+    keys = sorted(messages.keys())
+    ids = strs = ''
+    offsets = []
+    for key in keys:
+        offsets.append((len(ids), len(key), len(strs), len(messages[key])))
+        ids += key + '\0'
+        strs += messages[key] + '\0'
+    keyStart = 7 * 4 + 16 * len(keys)
+    valueStart = keyStart + len(ids)
+    keyOffsets = []
+    valueOffsets = []
+    for (o1, l1, o2, l2) in offsets:
+        keyOffsets += [l1, o1 + keyStart]
+        valueOffsets += [l2, o2 + valueStart]
+    output = struct.pack("Iiiiiii", 0x950412de, 0, len(keys), 7 * 4,
+                         7 * 4 + len(keys) * 8, 0, 0)
+    output += struct.pack("%di" % len(keyOffsets), *keyOffsets)
+    output += struct.pack("%di" % len(valueOffsets), *valueOffsets)
+    with open(fileName, 'wb') as f:
+        f.write(output + ids + strs)
+
+
+def oldTranslationsOf(moFile, srcName):
+    """
+    The way GettextTranslationDb.getTranslationsOf() used to look up
+    mnemonics, trying an underscore at every position.
+    """
+    translations = gettext.GNUTranslations(open(moFile))
+    srcName = safeDecode(srcName)
+    results = {}
+    result = translations.ugettext(srcName)
+    if result != srcName:
+        results[result] = None
+    for index in range(len(srcName)):
+        candidate = srcName[:index] + "_" + srcName[index:]
+        result = translations.ugettext(candidate)
+        if result != candidate:
+            results[result.replace('_', '')] = True
+    return sorted(results.keys())
+
+
+class TestTranslationDb(unittest.TestCase):
+
+    messages = {'_Add': 'A_jouter', 'Add': 'Ajouter', '_Open': '_Ouvrir',
+                'Save _As': 'Enregistrer _sous', 'Save_': 'Sauver',
+                'snake_case_name': 'nom_en_serpent', '_Quit': 'Quitter',
+                'Q_uit': 'Q_uitter', 'Untranslated': 'Untranslated',
+                'Fichier _enregistr\xc3\xa9': 'Saved _file'}
+
+    def setUp(self):
+        handle, self.moFile = tempfile.mkstemp(suffix='.mo')
+        os.close(handle)
+        writeMoFile(self.moFile, self.messages)
+        self.translationDbs = list(dogtail.i18n.translationDbs)
+
+    def tearDown(self):
+        os.unlink(self.moFile)
+        dogtail.i18n.translationDbs[:] = self.translationDbs
+
+    def test_mnemonics_like_before(self):
+        db = dogtail.i18n.GettextTranslationDb(self.moFile)
+        for srcName in ['Add', 'Open', 'Save As', 'Save', 'snakecase_name',
+                        'snake_casename', 'Quit', 'Untranslated', 'Nothing',
+                        u'Fichier enregistr\xe9', '']:
+            self.assertEquals(sorted(db.getTranslationsOf(srcName)),
+                              oldTranslationsOf(self.moFile, srcName), srcName)
+
+    def test_translate_memo(self):
+        self.assertEquals(dogtail.i18n.translate('Quit'), [])
+        dogtail.i18n.translationDbs.append(
+            dogtail.i18n.GettextTranslationDb(self.moFile))
+        self.assertEquals(sorted(dogtail.i18n.translate('Quit')),
+                          [u'Quitter'])
+        self.assertTrue('Quit' in dogtail.i18n.translationMemo)
+        self.assertEquals(sorted(dogtail.i18n.translate('Quit')),
+                          [u'Quitter'])
+
+
+class TestLazyTranslationDb(unittest.TestCase):
+
+    def setUp(self):
+        self.dataDir = dogtail.config.config.dataDir
+        dogtail.config.config.dataDir = tempfile.mkdtemp()
+        self.translationCacheSize = dogtail.config.config.translationCacheSize
+        self.translationDbs = list(dogtail.i18n.translationDbs)
+        dogtail.i18n.loadedCatalogs.clear()
+        self.moFiles = []
+        for i in range(12):
+            handle, moFile = tempfile.mkstemp(suffix='.mo')
+            os.close(handle)
+            writeMoFile(moFile, TestTranslationDb.messages)
+            self.moFiles.append(moFile)
+
+    def tearDown(self):
+        for moFile in self.moFiles:
+            os.unlink(moFile)
+        dogtail.i18n.loadedCatalogs.clear()
+        dogtail.i18n.translationDbs[:] = self.translationDbs
+        dogtail.config.config.translationCacheSize = self.translationCacheSize
+        shutil.rmtree(dogtail.config.config.dataDir)
+        dogtail.config.config.dataDir = self.dataDir
+
+    def countParsing(self):
+        """
+        Makes the mo-files parsed from now on be listed in self.parsed.
+        """
+        self.parsed = []
+        GettextTranslationDb = dogtail.i18n.GettextTranslationDb
+        parsed = self.parsed
+
+        class CountingTranslationDb(GettextTranslationDb):
+            def __init__(self, moFile):
+                parsed.append(moFile)
+                GettextTranslationDb.__init__(self, moFile)
+        dogtail.i18n.GettextTranslationDb = CountingTranslationDb
+        self.addCleanup(setattr, dogtail.i18n, 'GettextTranslationDb',
+                        GettextTranslationDb)
+
+    def test_loaded_on_demand(self):
+        dbs = [dogtail.i18n.LazyTranslationDb(moFile) for moFile in self.moFiles]
+        self.assertEquals(len(dogtail.i18n.loadedCatalogs), 0)
+        self.assertEquals(dbs[0].getTranslationsOf('Quit'), [u'Quitter'])
+        self.assertEquals(dogtail.i18n.loadedCatalogs.keys(), [self.moFiles[0]])
+
+    def test_lru_cap(self):
+        dogtail.config.config.translationCacheSize = 2
+        dbs = [dogtail.i18n.LazyTranslationDb(moFile) for moFile in self.moFiles[:3]]
+        for db in dbs + [dbs[0]]:
+            self.assertEquals(db.getTranslationsOf('Quit'), [u'Quitter'])
+        self.assertEquals(dogtail.i18n.loadedCatalogs.keys(),
+                          [self.moFiles[2], self.moFiles[0]])
+
+    def test_more_catalogs_than_cap(self):
+        "Catalogs are looked up in their indexes, never parsed, within the cap."
+        dogtail.config.config.translationCacheSize = 4
+        self.countParsing()
+        dogtail.i18n.translationDbs[:] = [
+            dogtail.i18n.LazyTranslationDb(moFile) for moFile in self.moFiles]
+        for srcName in ('Quit', 'Add', 'Open', 'Save As', 'Nothing'):
+            self.assertEquals(
+                sorted(dogtail.i18n.translate(srcName)),
+                sorted(dogtail.i18n.GettextTranslationDb(
+                    self.moFiles[0]).getTranslationsOf(srcName)))
+            self.assertTrue(len(dogtail.i18n.loadedCatalogs) <= 4)
+        self.assertEquals(self.parsed, [self.moFiles[0]] * 5)
+
+    def test_parsed_without_index(self):
+        "Catalogs that can't be indexed are parsed, within the cap too."
+        dogtail.config.config.translationCacheSize = 4
+        self.countParsing()
+
+        def cantIndex(*args):
+            raise OSError("read-only")
+        getCompiledTranslationDb = dogtail.i18n.getCompiledTranslationDb
+        dogtail.i18n.getCompiledTranslationDb = cantIndex
+        try:
+            dbs = [dogtail.i18n.LazyTranslationDb(moFile) for moFile in self.moFiles]
+            for db in dbs:
+                self.assertEquals(db.getTranslationsOf('Quit'), [u'Quitter'])
+        finally:
+            dogtail.i18n.getCompiledTranslationDb = getCompiledTranslationDb
+        self.assertEquals(self.parsed, self.moFiles)
+        self.assertEquals(dogtail.i18n.loadedCatalogs.keys(), self.moFiles[-4:])
+
+    def test_broken_file(self):
+        with open(self.moFiles[0], 'w') as f:
+            f.write('not a mo file')
+        db = dogtail.i18n.LazyTranslationDb(self.moFiles[0])
+        self.assertEquals(db.getTranslationsOf('Quit'), [])
+
+
+class TestCompiledTranslationDb(unittest.TestCase):
+
+    def setUp(self):
+        self.dataDir = dogtail.config.config.dataDir
+        dogtail.config.config.dataDir = tempfile.mkdtemp()
+        self.moFiles = []
+        for messages in (TestTranslationDb.messages,
+                         {'_Add': 'Ajo_uter', 'Close': 'Fermer'}):
+            handle, moFile = tempfile.mkstemp(suffix='.mo')
+            os.close(handle)
+            writeMoFile(moFile, messages)
+            self.moFiles.append(moFile)
+
+    def tearDown(self):
+        for moFile in self.moFiles:
+            os.unlink(moFile)
+        shutil.rmtree(dogtail.config.config.dataDir)
+        dogtail.config.config.dataDir = self.dataDir
+
+    def test_same_translations(self):
+        compiled = dogtail.i18n.getCompiledTranslationDb('test', 'fr', self.moFiles)
+        dbs = [dogtail.i18n.GettextTranslationDb(moFile) for moFile in self.moFiles]
+        for srcName in ['Add', 'Open', 'Save As', 'Save', 'snakecase_name',
+                        'Quit', 'Close', 'Untranslated', 'Nothing', 'Zzz',
+                        u'Fichier enregistr\xe9']:
+            expected = set()
+            for db in dbs:
+                expected.update(db.getTranslationsOf(srcName))
+            self.assertEquals(set(compiled.getTranslationsOf(srcName)),
+                              expected, srcName)
+
+    def test_index_reused(self):
+        first = dogtail.i18n.getCompiledTranslationDb('test', 'fr', self.moFiles)
+        second = dogtail.i18n.getCompiledTranslationDb('test', 'fr', self.moFiles)
+        self.assertEquals(first.indexFile, second.indexFile)
+        other = dogtail.i18n.getCompiledTranslationDb('test', 'fr', self.moFiles[:1])
+        self.assertNotEquals(first.indexFile, other.indexFile)
+
+    def test_keyed_by_directories(self):
+        "With the directories given, the mo-files are only needed to compile"
+        calls = []
+
+        def findMoFiles():
+            calls.append(True)
+            return self.moFiles
+        directory = tempfile.mkdtemp()
+        try:
+            first = dogtail.i18n.getCompiledTranslationDb(
+                'test', 'fr', findMoFiles, [directory])
+            second = dogtail.i18n.getCompiledTranslationDb(
+                'test', 'fr', findMoFiles, [directory])
+        finally:
+            shutil.rmtree(directory)
+        self.assertEquals(first.indexFile, second.indexFile)
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(second.getTranslationsOf('Close'), [u'Fermer'])
+
+    def test_directory_made_by_another_process(self):
+        "The translations directory may appear while an index is compiled"
+        os.makedirs(os.path.join(dogtail.config.config.dataDir, 'translations'))
+        compiled = dogtail.i18n.getCompiledTranslationDb('test', 'fr', self.moFiles)
+        self.assertEquals(compiled.getTranslationsOf('Close'), [u'Fermer'])
+        self.assertEquals(os.listdir(os.path.dirname(compiled.indexFile)),
+                          [os.path.basename(compiled.indexFile)])
+
+
+class TestTranslatableString(unittest.TestCase):
+
+    patterns = ['OK', 'Save As...', 'Save.*', '*Unsaved', 'Open (1)', 'Page [0-9]+',
+                'Zoom 100%', '']
+    names = ['OK', 'OK\n', 'ok', 'Save As...', 'Save As', 'Save', 'Save All',
+             'Save\nAll', 'Save All\n', '*Unsaved', 'Unsaved', 'Open (1)', 'Open 1',
+             'Page 12', 'Page x', 'Zoom 100%', '', '\n']
+
+    def test_matches_like_before(self):
+        for pattern in self.patterns:
+            scriptString = TranslatableString(pattern)
+            for name in self.names:
+                self.assertEquals(scriptString.matches(name),
+                                  oldMatchedBy(scriptString, name),
+                                  "%r against %r" % (pattern, name))
+                self.assertEquals(scriptString.matches(safeDecode(name)),
+                                  oldMatchedBy(scriptString, name))
+
+    def test_non_ascii(self):
+        scriptString = TranslatableString(u'Fichier enregistré')
+        self.assertTrue(scriptString.matches('Fichier enregistr\xc3\xa9'))
+        self.assertTrue(scriptString.matches(u'Fichier enregistré'))
+        self.assertFalse(scriptString.matches('Fichier enregistre'))
+        scriptString = TranslatableString(u'Données.*')
+        self.assertTrue(scriptString.matches('Donn\xc3\xa9es 2'))
+        self.assertTrue(scriptString.matches(u'Données 2'))
+
+    def test_literal_strings(self):
+        self.assertEquals(TranslatableString('Open (1)').getLiteralStrings(),
+                          [u'Open (1)'])
+        self.assertEquals(TranslatableString('Save.*').getLiteralStrings(), None)
+
+    def test_many_names(self):
+        "Precompiled patterns should pick the same names out of many."
+        names = ['Item %d' % i for i in range(10000)]
+        for pattern in ('Item 9999', 'Item 9.*', 'Item [0-9]*5'):
+            scriptString = TranslatableString(pattern)
+            self.assertEquals(
+                [name for name in names if scriptString.matches(name)],
+                [name for name in names if oldMatchedBy(scriptString, name)])
+
+    @unittest.skipUnless(os.environ.get('DOGTAIL_BENCHMARKS'),
+                         "set DOGTAIL_BENCHMARKS to run benchmarks")
+    def test_benchmark(self):
+        "Time matching 100k names, the old way and the precompiled way."
+        names = ['Item %d' % i for i in range(100000)]
+        for pattern in ('Item 99999', 'Item 9.*', 'Item [0-9]*5'):
+            scriptString = TranslatableString(pattern)
+            start = time.time()
+            old = len([name for name in names if oldMatchedBy(scriptString, name)])
+            oldTime = time.time() - start
+            start = time.time()
+            new = len([name for name in names if scriptString.matches(name)])
+            newTime = time.time() - start
+            print("%-15s old: %.2fus/name, precompiled: %.2fus/name" %
+                  (pattern, oldTime * 10, newTime * 10))
+            self.assertEquals(old, new)
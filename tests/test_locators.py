@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the dogtail.locators module
+"""
+
+import os
+import shutil
+import unittest
+from dogtail.config import config
+from dogtail import locators
+
+
+class TestLocatorStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dataDir = config.dataDir
+        config.dataDir = '/tmp/dogtail-test-locators/'
+
+    def tearDown(self):
+        shutil.rmtree(config.dataDir, ignore_errors=True)
+        config.dataDir = self.dataDir
+
+    def test_save_and_load(self):
+        store = locators.LocatorStore('gtk3-demo', 'gtk3-demo-1234-5678')
+        store.record('0 recursive IsAButtonNamed(...)', [0, 2, 1], "'OK' button")
+        store.save()
+        self.assertTrue(os.path.exists(store.fileName))
+
+        store = locators.LocatorStore('gtk3-demo', 'gtk3-demo-1234-5678')
+        store.load()
+        self.assertEquals(store.lookup('0 recursive IsAButtonNamed(...)'), [0, 2, 1])
+        self.assertEquals(store.lookup('no such search'), None)
+        self.assertEquals(
+            store.locators['0 recursive IsAButtonNamed(...)']['depth'], 3)
+
+    def test_versions_are_separate(self):
+        store = locators.LocatorStore('gtk3-demo', 'build-1')
+        store.record('key', [1], 'search')
+        store.save()
+        other = locators.LocatorStore('gtk3-demo', 'build-2')
+        other.load()
+        self.assertEquals(other.lookup('key'), None)
+
+    def test_merge_and_forget(self):
+        first = locators.LocatorStore('gtk3-demo', 'build')
+        second = locators.LocatorStore('gtk3-demo', 'build')
+        first.record('first', [1], 'search')
+        first.record('stale', [2], 'search')
+        first.save()
+        second.load()
+        second.forget('stale')
+        second.record('second', [3], 'search')
+        second.save()
+
+        store = locators.LocatorStore('gtk3-demo', 'build')
+        store.load()
+        self.assertEquals(store.lookup('first'), [1])
+        self.assertEquals(store.lookup('second'), [3])
+        self.assertEquals(store.lookup('stale'), None)
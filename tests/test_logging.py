@@ -75,3 +75,65 @@ class TestLogging(unittest.TestCase):
     def test_results_logger_incorrect_dict(self):
         logger = dogtail.logging.ResultsLogger("log")
         self.assertRaises(ValueError, logger.log, "not a dict")
+
+    def test_log_in_background(self):
+        dogtail.config.config.logDebugToFile = True
+        dogtail.config.config.logInBackground = True
+        try:
+            logger = dogtail.logging.Logger("log", file=True, stdOut=False)
+            for i in range(1000):
+                logger.log("line %d" % i)
+            dogtail.logging.logWriter.flush()
+            lines = open(logger.fileName, 'r').read().splitlines()
+            self.assertEquals(lines[1:], ["line %d" % i for i in range(1000)])
+        finally:
+            dogtail.config.config.logInBackground = False
+
+    def test_stop_log_writer(self):
+        dogtail.config.config.logDebugToFile = True
+        dogtail.config.config.logInBackground = True
+        try:
+            logger = dogtail.logging.Logger("log", file=True, stdOut=False)
+            logger.log("before")
+            thread = dogtail.logging.logWriter.thread
+            dogtail.logging.logWriter.stop()
+            self.assertFalse(thread.is_alive())
+            self.assertEquals(dogtail.logging.logWriter.thread, None)
+            logger.log("after")
+            dogtail.logging.logWriter.stop()
+            lines = open(logger.fileName, 'r').read().splitlines()
+            self.assertEquals(lines[1:], ["before", "after"])
+        finally:
+            dogtail.config.config.logInBackground = False
+
+    def test_levels(self):
+        dogtail.config.config.logDebugToFile = False
+        logger = dogtail.logging.Logger("log", file=False, stdOut=True)
+        dogtail.config.config.logLevel = 'warning'
+        try:
+            self.assertEquals(trap_stdout(logger.info, 'hello world'), '')
+            self.assertEquals(trap_stdout(logger.warning, 'hello world'),
+                              'hello world')
+            self.assertEquals(trap_stdout(logger.log, 'hello world'), '')
+        finally:
+            dogtail.config.config.logLevel = 'debug'
+        self.assertEquals(trap_stdout(logger.debug, 'hello world'), 'hello world')
+
+    def test_deferred_formatting(self):
+        calls = []
+
+        def describe():
+            calls.append(True)
+            return 'expensive'
+        logger = dogtail.logging.Logger("log", file=False, stdOut=True)
+        dogtail.config.config.logDebugToFile = False
+        dogtail.config.config.logDebugToStdOut = False
+        try:
+            logger.info(describe)
+            logger.info(lambda: "%s" % describe())
+            self.assertEquals(calls, [])
+        finally:
+            dogtail.config.config.logDebugToStdOut = True
+        self.assertEquals(trap_stdout(logger.info, describe), 'expensive')
+        output = trap_stdout(lambda: logger.info('%s at (%s,%s)', 'click', 1, 2))
+        self.assertEquals(output, 'click at (1,2)')
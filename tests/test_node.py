@@ -18,6 +18,7 @@ __author__ = "Dave Malcolm <dmalcolm@redhat.com>"
 import unittest
 import dogtail.tree
 import dogtail.predicate
+import dogtail.snapshot
 import dogtail.config
 dogtail.config.config.logDebugToFile = False
 import pyatspi
@@ -154,6 +155,17 @@ class TestNodeAttributes(GtkDemoTest):
         # FIXME: should have a test case involving the complex GtkTextView
         # widget
 
+    def testBulkTyping(self):
+        "Node.typeText() should enter the same text in every mode"
+        self.runDemo('Dialog and Message Boxes')
+        wnd = self.app.window('Dialogs')
+        for mode in ('insert', 'burst', 'keys'):
+            entry = wnd.child(label='Entry 1')
+            entry.text = ''
+            entry.typeText('hello world', mode=mode)
+            self.assertEquals(entry.text, 'hello world')
+        self.assertRaises(ValueError, entry.typeText, 'hello', mode='bogus')
+
     @nottest
     def testCaretOffset(self):
         "Make sure the caret offset works as expected"
@@ -321,6 +333,55 @@ class TestNodeAttributes(GtkDemoTest):
         self.assertRaises(
             AttributeError, self.app.__setattr__, "size", (640, 480))
 
+    # fetch():
+    def testFetch(self):
+        "Node.fetch() should agree with the individual properties"
+        window = self.app.children[0]
+        properties = window.fetch('name', 'roleName', 'position', 'size',
+                                  'extents', 'showing', 'sensitive')
+        self.assertEquals(properties.name, window.name)
+        self.assertEquals(properties.roleName, window.roleName)
+        self.assertEquals(properties.extents,
+                          properties.position + properties.size)
+        self.assertEquals(properties.size, window.size)
+        self.assert_(properties.showing)
+        self.assert_('states' not in properties)
+
+    def testFetchCache(self):
+        "Node.fetch() should reuse what it fetched until the UI is acted on"
+        window = self.app.children[0]
+        dogtail.config.config.propertyCacheLifetime = 60
+        try:
+            window.fetch('name')
+            window.user_data['fetched'][2]['name'] = 'Cached'
+            self.assertEquals(window.fetch('name').name, 'Cached')
+            self.assertEquals(window.fetch('name', fresh=True).name, window.name)
+            window.user_data['fetched'][2]['name'] = 'Cached'
+            dogtail.tree.forgetFetchedProperties()
+            self.assertNotEquals(window.fetch('name').name, 'Cached')
+        finally:
+            dogtail.config.config.propertyCacheLifetime = 0.1
+
+    def testInputForgetsFetched(self):
+        "Node.fetch() shouldn't reuse what it fetched once input is generated"
+        import dogtail.rawinput
+        window = self.app.children[0]
+        dogtail.config.config.propertyCacheLifetime = 60
+        try:
+            for generateInput in (
+                    lambda: dogtail.rawinput.InputSequence().run(delay=False),
+                    lambda: dogtail.rawinput.absoluteMotion(0, 0, mouseDelay=0.01)):
+                window.fetch('name')
+                window.user_data['fetched'][2]['name'] = 'Cached'
+                generateInput()
+                self.assertNotEquals(window.fetch('name').name, 'Cached')
+        finally:
+            dogtail.config.config.propertyCacheLifetime = 0.1
+
+    def testFetchUnknown(self):
+        "Node.fetch() should refuse unknown properties"
+        self.assertRaises(ValueError, self.app.fetch, 'bogus')
+
     # 'toolkitName' (readonly string):
     def testGetToolkit(self):
         self.assertEquals(self.app.toolkitName, "gtk")
@@ -430,6 +491,123 @@ class TestSearching(GtkDemoTest):
         pageTabs = pageTabLists[1].findChildren(pred)
         self.assertEquals(len(pageTabs), 6)
 
+    def testIterFindChildren(self):
+        "iterFindChildren yields the same nodes as findChildren, lazily."
+        pred = dogtail.predicate.GenericPredicate(roleName='table cell')
+        allCells = self.app.findChildren(pred)
+        firstCells = list(self.app.iterFindChildren(pred, limit=5))
+        self.assertEquals(firstCells, allCells[:5])
+        gen = self.app.iterFindChildren(pred)
+        self.assertEquals(gen.next(), allCells[0])
+        self.assertEquals(
+            list(self.app.iterFindChildren(pred, maxDepth=1)), [])
+
+    def testDepthLimitedSearch(self):
+        "maxDepth bounds how far below the node a search goes."
+        self.assertEquals(self.app.child(roleName='frame', maxDepth=1).name,
+                          "GTK+ Code Demos")
+        self.assertFalse(self.app.isChild(roleName='page tab', maxDepth=1))
+        self.assertTrue(self.app.isChild(roleName='page tab'))
+        tab = self.app.child(roleName='page tab')
+        self.assertEquals(tab.findAncestor(
+            dogtail.predicate.GenericPredicate(roleName='application'), maxDepth=1), None)
+
+    def testPrunedSearch(self):
+        "pruneHidden only finds nodes that are showing."
+        pred = dogtail.predicate.GenericPredicate(roleName='table cell')
+        showing = self.app.findChildren(pred, pruneHidden=True)
+        self.assertTrue(len(showing) <= len(self.app.findChildren(pred)))
+        for cell in showing:
+            self.assertTrue(cell.showing)
+
+    def testFindMany(self):
+        "findMany finds the same nodes as separate findChild calls."
+        preds = {'tabList': dogtail.predicate.GenericPredicate(roleName='page tab list'),
+                 'info': dogtail.predicate.GenericPredicate('Info'),
+                 'source': dogtail.predicate.GenericPredicate('Source')}
+        found = self.app.findMany(preds)
+        for key, pred in preds.items():
+            self.assertEquals(found[key], self.app.findChild(pred))
+
+        preds['bogus'] = dogtail.predicate.GenericPredicate('no such node')
+        self.assertRaises(dogtail.tree.SearchError,
+                          self.app.findMany, preds, retry=False)
+        found = self.app.findMany(preds, retry=False, requireResult=False)
+        self.assertEquals(found['bogus'], None)
+        self.assertEquals(found['info'].name, 'Info')
+
+    def testSnapshotSearch(self):
+        "Searching a snapshot finds the same nodes as a live search."
+        pred = dogtail.predicate.GenericPredicate(roleName='page tab')
+        live = self.app.findChildren(pred)
+        snapshot = self.app.snapshot()
+        records = snapshot.findChildren(pred)
+        self.assertEquals(len(records), len(live))
+        self.assertEquals([r.name for r in records], [n.name for n in live])
+        self.assertEquals(records[0].node, live[0])
+
+    def testMirroredSearch(self):
+        "Searches answered from a TreeMirror follow changes in the app."
+        import dogtail.mirror
+        mirror = dogtail.mirror.TreeMirror(self.app)
+        mirror.start()
+        try:
+            pred = dogtail.predicate.GenericPredicate(roleName='page tab')
+            self.assertEquals(len(self.app.findChildren(pred)),
+                              len(mirror.snapshot.root.findChildren(pred)))
+            self.runDemo('Dialog and Message Boxes')
+            wnd = self.app.window('Dialogs')
+            self.assertEquals(wnd.child(label='Entry 1').roleName, 'text')
+        finally:
+            mirror.stop()
+        self.assertEquals(dogtail.mirror.mirrorFor(self.app), None)
+
+    def testEventDrivenSearch(self):
+        "A window that shows up later is found by an event-driven search."
+        dogtail.config.config.eventDrivenSearch = True
+        try:
+            self.runDemo('Dialog and Message Boxes')
+            wnd = self.app.window('Dialogs')
+            self.assertEquals(wnd.roleName, 'frame')
+            self.assertRaises(dogtail.tree.SearchError,
+                              self.app.findChild,
+                              dogtail.predicate.IsAWindowNamed('no such window'),
+                              recursive=False, retry=False)
+        finally:
+            dogtail.config.config.eventDrivenSearch = False
+
+    def testGuardedDesktopSearch(self):
+        "Guarded searches below the desktop should find the same nodes"
+        root = dogtail.tree.root
+        pred = dogtail.predicate.GenericPredicate(roleName='frame')
+        serial = root.findChildren(pred)
+        dogtail.config.config.guardedDesktopSearch = True
+        try:
+            self.assertEquals(root.findChildren(pred), serial)
+            self.assertEquals(root.findChild(pred), serial[0])
+            self.assertEquals(root.application('gtk3-demo'), self.app)
+        finally:
+            dogtail.config.config.guardedDesktopSearch = False
+
+    def testCachedSearch(self):
+        "A cached search finds the same node again, and recovers when it's gone."
+        dogtail.config.config.cacheSearches = True
+        try:
+            dogtail.tree.searchCache.clear()
+            pred = dogtail.predicate.GenericPredicate(roleName='page tab', name='Info')
+            tab = self.app.findChild(pred)
+            self.assertEquals(len(dogtail.tree.searchCache.entries), 1)
+            self.assertEquals(self.app.findChild(
+                dogtail.predicate.GenericPredicate(roleName='page tab', name='Info')), tab)
+            # A location that doesn't match anymore is dropped:
+            key = dogtail.tree.searchCache.entries.keys()[0]
+            dogtail.tree.searchCache.entries[key] = [0]
+            self.assertEquals(self.app.findChild(pred), tab)
+            dogtail.tree.searchCache.invalidate(self.app)
+            self.assertEquals(len(dogtail.tree.searchCache.entries), 0)
+        finally:
+            dogtail.config.config.cacheSearches = False
+
     # def testFindChildrenNonRecursive(self):
     #     """
     #     Ensure that there are the correct number of table cells in the Tree
@@ -453,9 +631,119 @@ class TestSearching(GtkDemoTest):
     #     self.assertEquals(len(cells), len(direct_cells))
 
 
+class FakeNode(object):
+
+    def __init__(self, name, children=()):
+        self.name = name
+        self.children = list(children)
+
+    @property
+    def childCount(self):
+        return len(self.children)
+
+    def __getitem__(self, index):
+        return self.children[index]
+
+    def __iter__(self):
+        return iter(self.children)
+
+
+class TestDesktopSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.nested = FakeNode('match 1')
+        self.sibling = FakeNode('match 2')
+        self.other = FakeNode('match 3')
+        self.root = FakeNode('main', [
+            FakeNode('app 1', [FakeNode('a', [self.nested]), self.sibling]),
+            FakeNode('app 2', [self.other])])
+        self.pred = lambda node: node.name.startswith('match')
+
+    def testTreeOrder(self):
+        "A nested descendant comes before a later sibling, as in findChild"
+        search = dogtail.tree.DesktopSearch()
+        self.assertEquals(
+            search.searchApplication(self.root[0], self.pred, True, True),
+            [self.nested])
+        self.assertEquals(search.findChildren(self.root, self.pred),
+                          [self.nested, self.sibling, self.other])
+        self.assertEquals(
+            search.findChildren(self.root, self.pred, first=True),
+            [self.nested])
+
+    def testTimeoutsRestored(self):
+        "The AT-SPI timeouts in force before a search are put back after it"
+        previous = dogtail.tree.setAtspiTimeouts(600, 20000)
+        try:
+            dogtail.tree.DesktopSearch().findChildren(self.root, self.pred)
+            self.assertEquals(dogtail.tree.atspiTimeouts, (600, 20000))
+        finally:
+            dogtail.tree.setAtspiTimeouts(*previous)
+
+
+class LabelsSnapshot(dogtail.snapshot.Snapshot):
+
+    """
+    A snapshot of labels with the given names, with no live tree behind it.
+    """
+
+    def loadFromTree(self):
+        SnapshotNode = dogtail.snapshot.SnapshotNode
+        self.root = self.addRecord(
+            SnapshotNode(self, name='app', role=pyatspi.ROLE_APPLICATION))
+        for index, name in enumerate(self.node):
+            record = self.addRecord(
+                SnapshotNode(self, name=name, role=pyatspi.ROLE_LABEL))
+            record.parent = self.root
+            record.indexInParent = index
+            self.root._children.append(record)
+
+
+class TestSnapshotIndex(unittest.TestCase):
+
+    def testTrailingNewline(self):
+        "Indexed searches match names with a trailing newline, as walks do"
+        snapshot = LabelsSnapshot(['OK', 'OK\n', 'Cancel', 'OK\n\n'],
+                                  useCache=False)
+        for name in ['OK', 'OK\n']:
+            pred = dogtail.predicate.GenericPredicate(name, roleName='label')
+            indexed = snapshot.search(snapshot.root, pred)
+            walked = snapshot.search(snapshot.root, pred.satisfiedByNode)
+            self.assertEquals(indexed, walked)
+        self.assertEquals([r.name for r in indexed], ['OK\n', 'OK\n\n'])
+
+
 class TestActions(GtkDemoTest):
     # FIXME: should test the various actions
-    pass
+
+    def testCachedActions(self):
+        "Node.actions should be built once per node"
+        tree = self.app.child(roleName="tree table")
+        item = tree.child('Dialog and Message Boxes')
+        actions = item.actions
+        self.assert_('activate' in actions)
+        self.assert_(item.actions['activate'] is actions['activate'])
+
+    def testDoUntilEvent(self):
+        "Action.do(wait=...) should return as soon as the event is seen"
+        import time
+        tree = self.app.child(roleName="tree table")
+        start = time.time()
+        tree.child('Dialog and Message Boxes').doActionNamed(
+            'activate', wait='window:create', timeout=5)
+        self.assert_(time.time() - start < 5)
+        self.app.window('Dialogs')
+
+    def testDoUntilCondition(self):
+        "Action.do(wait=...) should return as soon as the condition holds"
+        tree = self.app.child(roleName="tree table")
+        tree.child('Dialog and Message Boxes').doActionNamed(
+            'activate', timeout=5,
+            wait=lambda: self.app.findChild(
+                dogtail.predicate.IsAWindowNamed('Dialogs'), recursive=False,
+                retry=False, requireResult=False) is not None)
+        self.app.findChild(dogtail.predicate.IsAWindowNamed('Dialogs'),
+                           recursive=False, retry=False)
 
 
 class TestProcedural(GtkDemoTest):
@@ -190,3 +190,74 @@ class TestPredicate(unittest.TestCase):
             False), u'dialog("dummy name 1")')
         self.assertEquals(
             genericNamedPredicate.makeScriptVariableName(), u'dummyName1Dlg')
+
+    def test_index_hints(self):
+        self.assertEquals(
+            dogtail.predicate.IsAButtonNamed('OK').getIndexHints(),
+            ('push button', [u'OK']))
+        self.assertEquals(
+            dogtail.predicate.GenericPredicate(roleName='table cell').getIndexHints(),
+            ('table cell', None))
+        self.assertEquals(
+            dogtail.predicate.IsNamed('Save.*').getIndexHints(), (None, None))
+        self.assertEquals(
+            dogtail.predicate.GenericPredicate(label='Entry 1').getIndexHints(),
+            (None, None))
+
+    def test_equality_and_hash(self):
+        pred1 = dogtail.predicate.GenericPredicate(name='OK', roleName='push button')
+        pred2 = dogtail.predicate.GenericPredicate(name='OK', roleName='push button')
+        pred3 = dogtail.predicate.GenericPredicate(name='Cancel', roleName='push button')
+        self.assertEquals(pred1, pred2)
+        self.assertEquals(hash(pred1), hash(pred2))
+        self.assertNotEquals(pred1, pred3)
+        self.assertNotEquals(pred1, dogtail.predicate.IsAButtonNamed('OK'))
+        self.assertEquals(len(set([pred1, pred2, pred3])), 2)
+
+    def test_combinators(self):
+        ok = self.DummyNode('OK', 'push button')
+        label = self.DummyNode('OK', 'label')
+        pred = dogtail.predicate.And(dogtail.predicate.IsNamed('OK'),
+                                     dogtail.predicate.Not(
+                                         dogtail.predicate.GenericPredicate(roleName='label')))
+        self.assertTrue(pred.satisfiedByNode(ok))
+        self.assertFalse(pred.satisfiedByNode(label))
+        pred = dogtail.predicate.Or(dogtail.predicate.IsAButtonNamed('Cancel'),
+                                    dogtail.predicate.GenericPredicate(roleName='label'))
+        self.assertFalse(pred.satisfiedByNode(ok))
+        self.assertTrue(pred.satisfiedByNode(label))
+
+    def test_cheapest_checks_first(self):
+        "The role is checked before the name, and the name before the label."
+        accessed = []
+
+        class Node(object):
+
+            @property
+            def roleName(self):
+                accessed.append('roleName')
+                return 'label'
+
+            @property
+            def name(self):
+                accessed.append('name')
+                return 'OK'
+
+        dogtail.predicate.IsAButtonNamed('OK').satisfiedByNode(Node())
+        self.assertEquals(accessed, ['roleName'])
+        del accessed[:]
+        dogtail.predicate.GenericPredicate(name='OK', roleName='label').satisfiedByNode(Node())
+        self.assertEquals(accessed, ['roleName', 'name'])
+
+    def test_compound_identity_string(self):
+        "Compound predicates are identified by what they're made of."
+        def make():
+            return dogtail.predicate.And(
+                dogtail.predicate.IsNamed('OK'),
+                dogtail.predicate.Not(
+                    dogtail.predicate.GenericPredicate(roleName='label')))
+        identity = make().getIdentityString()
+        self.assertEquals(identity, make().getIdentityString())
+        self.assertFalse(' at 0x' in identity, identity)
+        self.assertTrue("IsNamed(" in identity)
+        self.assertTrue("roleName='label'" in identity)
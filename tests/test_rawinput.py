@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the dogtail.rawinput module
+"""
+
+import os
+import time
+import unittest
+import dogtail.config
+dogtail.config.config.logDebugToFile = False
+from dogtail import rawinput
+from gi.repository import Gdk
+
+
+def oldKeyNameToKeyCode(keyName):
+    """
+    The way rawinput.keyNameToKeyCode() used to work, asking Gdk every time.
+    """
+    keymap = Gdk.Keymap.get_for_display(Gdk.Display.get_default())
+    entries = keymap.get_entries_for_keyval(Gdk.keyval_from_name(keyName))
+    try:
+        return entries[1][0].keycode
+    except TypeError:
+        pass
+
+
+class TestKeyTables(unittest.TestCase):
+
+    def test_same_keysyms(self):
+        for keyName in ['a', 'Z', '1', ' ', '\n', '\t', 'enter', 'Escape',
+                        'F1', u'é', '!', 'Page_Up']:
+            self.assertEquals(rawinput.keyNameToKeySym(keyName),
+                              rawinput.computeKeySym(keyName), repr(keyName))
+
+    def test_same_keycodes(self):
+        for keyName in ['Control_L', 'Alt_L', 'Shift_L', 'Return', 'a', 'q']:
+            self.assertEquals(rawinput.keyNameToKeyCode(keyName),
+                              oldKeyNameToKeyCode(keyName))
+
+    def test_combo(self):
+        modifiers, final = rawinput.keyTables.combo('<Control><Shift>PageUp')
+        self.assertEquals(modifiers, [oldKeyNameToKeyCode('Control_L'),
+                                      oldKeyNameToKeyCode('Shift_L')])
+        self.assertEquals(final, oldKeyNameToKeyCode('Page_Up'))
+        self.assertRaises(ValueError, rawinput.keyTables.combo, '<Bogus>q')
+
+    def test_invalidate(self):
+        rawinput.keyNameToKeyCode('Control_L')
+        rawinput.keyTables.combo('<Control>q')
+        rawinput.keyTables.invalidate()
+        self.assertEquals(rawinput.keyTables.keyCodes, {})
+        self.assertEquals(rawinput.keyTables.combos, {})
+
+    def test_same_results_over_text(self):
+        "The tables should give what the old lookups gave, over a whole text."
+        text = u'The quick brown fox jumps over the lazy dog.\n' * 10
+        for char in text:
+            self.assertEquals(rawinput.keyNameToKeySym(char),
+                              rawinput.computeKeySym(char), repr(char))
+        for i in range(10):
+            self.assertEquals(rawinput.keyTables.combo('<Control><Shift>q'),
+                              ([oldKeyNameToKeyCode('Control_L'),
+                                oldKeyNameToKeyCode('Shift_L')],
+                               oldKeyNameToKeyCode('q')))
+
+    @unittest.skipUnless(os.environ.get('DOGTAIL_BENCHMARKS'),
+                         "set DOGTAIL_BENCHMARKS to run benchmarks")
+    def test_benchmark(self):
+        "Time looking up the keys of 10k characters and combos, old and new way."
+        text = u'The quick brown fox jumps over the lazy dog.\n' * 250
+        start = time.time()
+        for char in text:
+            rawinput.computeKeySym(char)
+        for i in range(1000):
+            for keyName in ('Control_L', 'Shift_L', 'q'):
+                oldKeyNameToKeyCode(keyName)
+        oldTime = time.time() - start
+        start = time.time()
+        for char in text:
+            rawinput.keyNameToKeySym(char)
+        for i in range(1000):
+            rawinput.keyTables.combo('<Control><Shift>q')
+        newTime = time.time() - start
+        print("old: %.2fms, tables: %.2fms" % (oldTime * 1000, newTime * 1000))
+
+
+class TestInputSequence(unittest.TestCase):
+
+    def test_interpolated_motion(self):
+        sequence = rawinput.InputSequence()
+        sequence.press(0, 0).motion(100, 50, duration=0.5, steps=5)
+        sequence.release(100, 50)
+        self.assertEquals(len(sequence), 7)
+        self.assertEquals([args for (offset, function, args) in sequence.events[1:6]],
+                          [(20, 10, 'abs'), (40, 20, 'abs'), (60, 30, 'abs'),
+                           (80, 40, 'abs'), (100, 50, 'abs')])
+        self.assertAlmostEquals(sequence.events[-1][0], 0.5)
+        self.assertAlmostEquals(sequence.time, 0.5)
+
+    def test_checks_coordinates(self):
+        sequence = rawinput.InputSequence()
+        self.assertRaises(ValueError, sequence.press, -1, 10)
+
+    def test_key_combo(self):
+        sequence = rawinput.InputSequence().keyCombo('<Control><Shift>q')
+        self.assertEquals(len(sequence), 5)
+
+    def test_timing(self):
+        "Events go in in order, none of them before its time."
+        calls = []
+        sequence = rawinput.InputSequence()
+        for name in 'abcd':
+            sequence.add(lambda name: calls.append((name, time.time())), name)
+            sequence.wait(0.05)
+        start = time.time()
+        sequence.run(delay=False)
+        self.assertEquals([name for (name, when) in calls], list('abcd'))
+        for index, (name, when) in enumerate(calls):
+            self.assertTrue(when - start >= index * 0.05 - 0.001)
+            if index:
+                self.assertTrue(when >= calls[index - 1][1])
+
+    def test_errors_raised(self):
+        def fail():
+            raise RuntimeError("injection failed")
+        sequence = rawinput.InputSequence().add(fail)
+        self.assertRaises(RuntimeError, sequence.run, False)
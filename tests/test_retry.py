@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the dogtail.retry module
+"""
+
+import unittest
+from dogtail.config import config
+from dogtail import retry
+
+
+class TestRetryPolicies(unittest.TestCase):
+
+    def setUp(self):
+        self.searchBackoffDuration = config.searchBackoffDuration
+        self.searchCutoffCount = config.searchCutoffCount
+
+    def tearDown(self):
+        config.searchBackoffDuration = self.searchBackoffDuration
+        config.searchCutoffCount = self.searchCutoffCount
+        config.searchRetryPolicy = 'fixed'
+
+    def test_fixed(self):
+        config.searchBackoffDuration = 0.25
+        config.searchCutoffCount = 4
+        delays = list(retry.FixedRetryPolicy().delays())
+        self.assertEquals(delays, [0.25] * 4)
+
+    def test_exponential(self):
+        policy = retry.ExponentialRetryPolicy(initial=0.01, jitter=0)
+        delays = list(policy.delays(interval=0.04, timeout=0.0))
+        self.assertEquals(delays, [])
+        delays = policy.delays(interval=0.04, timeout=10.0)
+        self.assertEquals([delays.next() for i in range(4)],
+                          [0.01, 0.02, 0.04, 0.04])
+
+    def test_jitter(self):
+        policy = retry.ExponentialRetryPolicy(initial=0.1, jitter=0.5)
+        for i in range(100):
+            delay = policy.delays(interval=1.0, timeout=10.0).next()
+            self.assertTrue(0.05 <= delay <= 0.15)
+
+    def test_adaptive_window(self):
+        policy = retry.AdaptiveRetryPolicy(initial=0.01, jitter=0)
+        self.assertEquals(policy.window('app'), None)
+        for elapsed in (2.0, 2.5, 3.0):
+            policy.record('app', elapsed)
+        self.assertEquals(policy.window('app'), (2.0, 3.0))
+        self.assertEquals(policy.window('other app'), None)
+        # Waits until just before the window, at most interval at a time,
+        # then polls densely.
+        delays = policy.delays('app', interval=5.0, timeout=10.0)
+        self.assertAlmostEquals(delays.next(), 1.99, places=2)
+
+    def test_adaptive_history(self):
+        policy = retry.AdaptiveRetryPolicy(history=5)
+        for elapsed in range(10):
+            policy.record('app', elapsed)
+        self.assertEquals(policy.latencies['app'], [5, 6, 7, 8, 9])
+
+    def test_get_policy(self):
+        config.searchRetryPolicy = 'adaptive'
+        self.assertTrue(isinstance(retry.getPolicy(), retry.AdaptiveRetryPolicy))
+        config.searchRetryPolicy = ''
+        self.assertTrue(isinstance(retry.getPolicy(), retry.FixedRetryPolicy))
+        policy = retry.ExponentialRetryPolicy()
+        config.searchRetryPolicy = policy
+        self.assertTrue(retry.getPolicy() is policy)
+
+    def test_attempts(self):
+        policy = retry.AdaptiveRetryPolicy(initial=0.001, jitter=0)
+        attempts = retry.Attempts('app', interval=0.001, timeout=1.0,
+                                  policy=policy)
+        for numAttempts in attempts:
+            if numAttempts == 3:
+                attempts.succeeded()
+                break
+        self.assertEquals(len(policy.latencies['app']), 1)
+        self.assertEquals(list(retry.Attempts(retry=False, policy=policy)), [0])
+
+    def test_lazy_key(self):
+        calls = []
+
+        def key():
+            calls.append(True)
+            return 'app'
+        policy = retry.AdaptiveRetryPolicy(initial=0.001, jitter=0)
+        attempts = retry.Attempts(key, interval=0.001, timeout=1.0,
+                                  policy=policy)
+        for numAttempts in attempts:
+            attempts.succeeded()
+            break
+        self.assertEquals(calls, [])
+        self.assertEquals(policy.latencies, {})
+        attempts = retry.Attempts(key, interval=0.001, timeout=0.01,
+                                  policy=retry.FixedRetryPolicy())
+        self.assertTrue(len(list(attempts)) > 1)
+        self.assertEquals(calls, [])
+        attempts = retry.Attempts(key, interval=0.001, timeout=1.0,
+                                  policy=policy)
+        for numAttempts in attempts:
+            if numAttempts == 2:
+                attempts.succeeded()
+                break
+        self.assertEquals(calls, [True])
+        self.assertEquals(len(policy.latencies['app']), 1)
@@ -62,3 +62,122 @@ class TestA11Y(unittest.TestCase):
 
     def test_enable_a11y(self):
         dogtail.utils.enableA11y()
+
+
+class TestSettle(GtkDemoTest):
+
+    def setUp(self):
+        GtkDemoTest.setUp(self)
+        dogtail.config.config.settleDelays = True
+
+    def tearDown(self):
+        dogtail.config.config.settleDelays = False
+        GtkDemoTest.tearDown(self)
+
+    def test_settles_early(self):
+        "A quiet application should cut the delay short"
+        import time
+        start = time.time()
+        dogtail.utils.doDelay(5, self.app)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_bounded_by_delay(self):
+        waited = dogtail.utils.settleDelay(0.2, self.app)
+        self.assertTrue(waited < 0.5)
+
+    def test_not_settling(self):
+        import time
+        start = time.time()
+        dogtail.utils.doDelay(0.5, settle=False)
+        self.assertTrue(time.time() - start >= 0.5)
+
+    def test_listens_from_before_acting(self):
+        "Events an action causes before the delay starts aren't missed"
+        dogtail.utils.aboutToAct()
+        self.assertTrue(dogtail.utils.settleListener.listening)
+        tree = self.app.child(roleName="tree table")
+        tree.child('Dialog and Message Boxes').doActionNamed('activate')
+        self.app.findChild(dogtail.predicate.IsAWindowNamed('Dialogs'),
+                           recursive=False, retry=False)
+        dogtail.config.config.settleDelays = False
+        dogtail.utils.aboutToAct()
+        self.assertFalse(dogtail.utils.settleListener.listening)
+
+
+class TestRun(unittest.TestCase):
+
+    def test_run_returns_application(self):
+        import os
+        import signal
+        import time
+        start = time.time()
+        pid, app = dogtail.utils.run('gtk3-demo', returnApplication=True)
+        try:
+            self.assertTrue(time.time() - start < dogtail.config.config.runTimeout)
+            self.assertEquals(app.name, 'gtk3-demo')
+            self.assertEquals(app.get_process_id(), pid)
+            self.assertEquals(app.children[0].roleName, 'frame')
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            time.sleep(0.5)
+
+
+class FakeNode(object):
+
+    def __init__(self, name='', roleName='', pid=None, children=()):
+        self.name = name
+        self.roleName = roleName
+        self.pid = pid
+        self.children = list(children)
+
+    def get_process_id(self):
+        return self.pid
+
+
+class TestStartupWatcher(unittest.TestCase):
+
+    def makeApplication(self, pid):
+        return FakeNode('gtk3-demo', 'application', pid,
+                        [FakeNode('GTK+ Code Demos', 'frame')])
+
+    def test_prefers_process_id(self):
+        "A running instance of the same name isn't taken for the new one"
+        import time
+        stale = self.makeApplication(100)
+        desktop = FakeNode(children=[stale])
+        watcher = dogtail.utils.StartupWatcher('gtk3-demo', desktop)
+        watcher.running = [stale]
+        watcher.pid = 200
+        watcher.nameFallbackAt = time.time() + 60
+        watcher.scan()
+        self.assertEquals(watcher.check(), None)
+        fresh = self.makeApplication(200)
+        desktop.children.append(fresh)
+        watcher.scan()
+        self.assertEquals(watcher.check(), fresh)
+
+    def test_new_namesake_taken_at_once(self):
+        "An application of that name appearing after the launch is taken"
+        import time
+        launched = self.makeApplication(300)
+        desktop = FakeNode(children=[])
+        watcher = dogtail.utils.StartupWatcher('gtk3-demo', desktop)
+        watcher.pid = 200
+        watcher.nameFallbackAt = time.time() + 60
+        desktop.children.append(launched)
+        watcher.scan()
+        self.assertEquals(watcher.check(), launched)
+
+    def test_falls_back_to_name(self):
+        "The name is enough once the process id hasn't shown up in time"
+        import time
+        running = self.makeApplication(300)
+        watcher = dogtail.utils.StartupWatcher('gtk3-demo',
+                                               FakeNode(children=[running]))
+        watcher.running = [running]
+        watcher.pid = 200
+        watcher.nameFallbackAt = time.time() + 60
+        watcher.scan()
+        self.assertEquals(watcher.check(), None)
+        watcher.nameFallbackAt = time.time()
+        self.assertEquals(watcher.check(), running)